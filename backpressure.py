@@ -0,0 +1,114 @@
+import threading
+import time
+
+# Unacknowledged bytes the relay lets one sender have in flight
+DEFAULT_MAX_IN_FLIGHT = 4 * 1024 * 1024
+
+
+class FlowControl:
+    """Backpressure for one direction of a paired relay (sender -> receiver).
+
+    Counts windowed FILECHUNK bytes forwarded to the receiver against the
+    receiver's cumulative ACKs, both in payload bytes as they cross the
+    relay (compressed chunks count their compressed size). Above ``limit`` unacknowledged bytes the
+    sender's reads are paused until ACKs bring it back under half the limit,
+    so a lagging receiver slows the sender down at the relay instead of
+    filling kernel buffers. Also records how long each side was throttled:
+    ``sender_paused`` (reads held back) and ``receiver_blocked`` (time spent
+    waiting for the receiver to take data).
+    """
+
+    def __init__(self, limit=DEFAULT_MAX_IN_FLIGHT):
+        self.limit = limit
+        self.resume_at = limit // 2
+        self.in_flight = 0
+        # stream id -> [forwarded, acked]
+        self._streams = {}
+        self._cond = threading.Condition()
+
+        self.pauses = 0
+        self.sender_paused = 0.0
+        self.receiver_blocked = 0.0
+        self._paused_since = None
+
+    def start_stream(self, stream_id, offset):
+        """Starts counting ``stream_id`` at ``offset``, for a transfer resumed part way."""
+        with self._cond:
+            counts = self._streams.pop(stream_id, None)
+            if counts is not None:
+                self.in_flight -= counts[0] - counts[1]
+            self._streams[stream_id] = [offset, offset]
+            self._cond.notify_all()
+
+    def forwarded(self, stream_id, nbytes):
+        """Counts ``nbytes`` of windowed payload forwarded for ``stream_id``."""
+        with self._cond:
+            counts = self._streams.setdefault(stream_id, [0, 0])
+            counts[0] += nbytes
+            self.in_flight += nbytes
+
+    def acked(self, stream_id, offset):
+        """Applies the receiver's cumulative ACK; returns True if reads may resume."""
+        with self._cond:
+            counts = self._streams.get(stream_id)
+            if counts is None or offset <= counts[1]:
+                return False
+            released = min(offset, counts[0]) - counts[1]
+            counts[1] += released
+            self.in_flight -= released
+            if self.in_flight <= self.resume_at:
+                self._cond.notify_all()
+                return True
+            return False
+
+    def finish_stream(self, stream_id):
+        """Forgets a stream whose transfer ended, releasing what it still held."""
+        with self._cond:
+            counts = self._streams.pop(stream_id, None)
+            if counts is not None:
+                self.in_flight -= counts[0] - counts[1]
+                self._cond.notify_all()
+
+    def reset(self):
+        """Releases everything in flight, e.g. when the receiver goes away."""
+        with self._cond:
+            self._streams.clear()
+            self.in_flight = 0
+            self._cond.notify_all()
+
+    def over_limit(self):
+        return self.in_flight > self.limit
+
+    def wait_for_room(self, timeout=1.0):
+        """Blocks the sender's reader until in-flight bytes drop below half the limit.
+
+        Returns after at most ``timeout`` seconds so the caller can re-check
+        whether the connection is still wanted.
+        """
+        with self._cond:
+            if self.in_flight <= self.limit:
+                return
+            self.pauses += 1
+            start = time.monotonic()
+            self._cond.wait_for(lambda: self.in_flight <= self.resume_at, timeout)
+            self.sender_paused += time.monotonic() - start
+
+    # Event-driven engines pause and resume transports instead of waiting
+
+    def mark_paused(self):
+        if self._paused_since is None:
+            self.pauses += 1
+            self._paused_since = time.monotonic()
+
+    def mark_resumed(self):
+        if self._paused_since is not None:
+            self.sender_paused += time.monotonic() - self._paused_since
+            self._paused_since = None
+
+    def add_receiver_blocked(self, seconds):
+        self.receiver_blocked += seconds
+
+    def summary(self):
+        return (f"sender paused {self.sender_paused:.3f}s over {self.pauses} pauses, "
+                f"receiver writes blocked {self.receiver_blocked:.3f}s, "
+                f"{self.in_flight} bytes in flight")
@@ -0,0 +1,59 @@
+"""XOR cipher benchmark: the original per-byte loop vs xorcipher.XorCipher.
+
+Checks that both produce identical bytes (including non-zero key phases)
+and reports MB/s for each. Usage: python bench_cipher.py [--size-mb 64]
+"""
+import argparse
+import os
+import time
+
+import xorcipher
+
+# Same key as clientgui3.ENCRYPTION_KEY (importing the client would need Qt)
+ENCRYPTION_KEY = b'SIMPLEKEYFORXOR123456789012345678901234567890'
+
+
+def legacy_encrypt(data, key=ENCRYPTION_KEY, offset=0):
+    """The original NetworkThread.simple_encrypt loop."""
+    encrypted = bytearray()
+    for i, byte in enumerate(data):
+        key_byte = key[(offset + i) % len(key)]
+        encrypted.append(byte ^ key_byte)
+    return bytes(encrypted)
+
+
+def throughput(func, chunks):
+    start = time.perf_counter()
+    for chunk in chunks:
+        func(chunk)
+    elapsed = time.perf_counter() - start
+    return sum(len(chunk) for chunk in chunks) / elapsed / 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--size-mb", type=int, default=64)
+    parser.add_argument("--chunk", type=int, default=65000)
+    args = parser.parse_args()
+
+    cipher = xorcipher.XorCipher(ENCRYPTION_KEY)
+
+    # Byte-identical output, at phase 0 and mid-key, for odd sizes too
+    for size in (0, 1, 44, 45, 46, 1000, args.chunk):
+        data = os.urandom(size)
+        for offset in (0, 7, 45, 12345):
+            assert cipher.apply(data, offset) == legacy_encrypt(data, offset=offset), (size, offset)
+    print("[+] Output identical to the per-byte loop")
+
+    chunk = os.urandom(args.chunk)
+    count = max(1, args.size_mb * 1024 * 1024 // args.chunk)
+    # The legacy loop is slow; time it on a slice and extrapolate the rate
+    legacy_rate = throughput(legacy_encrypt, [chunk] * max(1, count // 32))
+    fast_rate = throughput(cipher.apply, [chunk] * count)
+    print(f"{'per-byte loop':<16} {legacy_rate:>10.1f} MB/s")
+    print(f"{'XorCipher':<16} {fast_rate:>10.1f} MB/s")
+    print(f"{'speedup':<16} {fast_rate / legacy_rate:>10.1f}x")
+
+
+if __name__ == "__main__":
+    main()
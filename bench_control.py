@@ -0,0 +1,133 @@
+"""Control message parsing: the original if/elif chain vs control.py's table dispatch.
+
+Times parsing and dispatching each kind of message a client sends
+server6, three ways:
+
+  chain    the startswith/split chain handle_frame used to run on every
+           TEXT frame, message kinds tried one after another
+  text     control.parse_text, then one lookup in a handler table
+  binary   control.decode of the CONTROL frame payload, then the same table
+
+and a mix weighted like a busy relay's traffic (mostly chat and
+heartbeats). Checks first that all three extract the same fields.
+Also prints the size of each message in either form.
+
+Usage: python bench_control.py [--rounds 200000]
+"""
+import argparse
+import time
+
+import control
+
+# (kind, values) of each kind of message a client sends, with its share of the mix
+SAMPLES = [
+    (control.CHAT, ("see you at the station in ten minutes",), 60),
+    (control.PING, (), 15),
+    (control.PONG, (), 15),
+    (control.FILE, ("holiday photos 2024.zip", 734003200, "9f2c4e1a0b7d3e55", "zlib", 4), 4),
+    (control.PAIR, ("192.168.1.20",), 2),
+    (control.PAIR_ACCEPT, ("192.168.1.21",), 1),
+    (control.JOIN_TOKEN, (), 1),
+    (control.JOIN, ("7f3a9c.2d41e8b6f0a3c5d7",), 1),
+    (control.RESUME_SESSION, ("3b9f0e2c7a1d4f6b8e5c9a0d2f4b6e8c.1a2b3c4d5e6f7a8b",), 1),
+]
+
+
+def legacy_chain(text, seen):
+    """The original handle_frame chain, recording what each branch parsed."""
+    if text == "PONG":
+        seen.append(("PONG",))
+        return
+    if text == "PING":
+        seen.append(("PING",))
+        return
+    if text == "JOIN_TOKEN":
+        seen.append(("JOIN_TOKEN", ""))
+    elif text.startswith("RESUME_SESSION:"):
+        seen.append(("RESUME_SESSION", text[len("RESUME_SESSION:"):]))
+    elif text.startswith("JOIN:"):
+        seen.append(("JOIN", text[5:]))
+    elif text.startswith("PAIR:"):
+        seen.append(("PAIR", text.split(":")[1]))
+    elif text.startswith("PAIR_ACCEPT:") or text.startswith("PAIR_REJECT:"):
+        parts = text.split(":")
+        seen.append((parts[0], parts[1]))
+    elif text.startswith("FILE:"):
+        file_parts = text.split(":")
+        if len(file_parts) >= 3:
+            seen.append(("FILE", file_parts[1], int(file_parts[2]),
+                         file_parts[3] if len(file_parts) >= 4 else "",
+                         file_parts[4] if len(file_parts) >= 5 else "",
+                         int(file_parts[5]) if len(file_parts) >= 6 else 0))
+    else:
+        seen.append(("CHAT", text))
+
+
+def record(seen, message):
+    seen.append(message)
+
+
+HANDLERS = {kind: record for kind, _, _ in SAMPLES}
+
+
+def parse_text(text, seen):
+    message = control.parse_text(text, control.CHAT)
+    control.dispatch(HANDLERS, message, seen)
+
+
+def decode(payload, seen):
+    message, _ = control.decode(payload)
+    control.dispatch(HANDLERS, message, seen)
+
+
+def nanoseconds(func, inputs, rounds, repeat=5):
+    """Nanoseconds per call of ``func`` over ``inputs``, ``rounds`` calls in all; best of ``repeat`` runs."""
+    inputs = (inputs * (rounds // len(inputs) + 1))[:rounds]
+    best = float("inf")
+    for _ in range(repeat):
+        seen = []
+        start = time.perf_counter()
+        for data in inputs:
+            func(data, seen)
+        best = min(best, time.perf_counter() - start)
+    return best / len(inputs) * 1e9
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rounds", type=int, default=200000)
+    args = parser.parse_args()
+
+    texts = [control.format_text(kind, *values) for kind, values, _ in SAMPLES]
+    payloads = [control.encode(kind, *values) for kind, values, _ in SAMPLES]
+
+    # Same fields out of all three
+    for text, payload in zip(texts, payloads):
+        legacy, parsed, decoded = [], [], []
+        legacy_chain(text, legacy)
+        parse_text(text, parsed)
+        decode(payload, decoded)
+        parsed, decoded = [[(message.kind.name,) + tuple(message) for message in seen] for seen in (parsed, decoded)]
+        assert legacy == parsed == decoded, (legacy, parsed, decoded)
+    print("[+] Chain, text and binary parse the same fields")
+
+    print(f"{'message':<16} {'text B':>7} {'binary B':>9} {'chain ns':>9} {'text ns':>9} {'binary ns':>10}")
+    for (kind, _, _), text, payload in zip(SAMPLES, texts, payloads):
+        chain = nanoseconds(legacy_chain, [text], args.rounds)
+        parsed = nanoseconds(parse_text, [text], args.rounds)
+        decoded = nanoseconds(decode, [payload], args.rounds)
+        print(f"{kind.name:<16} {len(text.encode('utf-8')):>7} {len(payload):>9} "
+              f"{chain:>9.0f} {parsed:>9.0f} {decoded:>10.0f}")
+
+    mix_texts = [text for (_, _, weight), text in zip(SAMPLES, texts) for _ in range(weight)]
+    mix_payloads = [payload for (_, _, weight), payload in zip(SAMPLES, payloads) for _ in range(weight)]
+    chain = nanoseconds(legacy_chain, mix_texts, args.rounds)
+    parsed = nanoseconds(parse_text, mix_texts, args.rounds)
+    decoded = nanoseconds(decode, mix_payloads, args.rounds)
+    text_bytes = sum(len(text.encode("utf-8")) for text in mix_texts) / len(mix_texts)
+    binary_bytes = sum(len(payload) for payload in mix_payloads) / len(mix_payloads)
+    print(f"{'mix':<16} {text_bytes:>7.1f} {binary_bytes:>9.1f} {chain:>9.0f} {parsed:>9.0f} {decoded:>10.0f}")
+
+
+if __name__ == "__main__":
+    main()
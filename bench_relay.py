@@ -0,0 +1,135 @@
+"""Relay throughput benchmark: legacy recv/send vs recv_into/memoryview vs os.splice.
+
+Runs producer -> relay -> consumer over loopback TCP and reports MB/s and
+the relay thread's CPU seconds per GB for each relay path. Loopback is
+memory-bound, so the CPU column is the better guide to relay capacity.
+
+Usage: python bench_relay.py [--size-mb 512] [--chunk 65000]
+"""
+import argparse
+import socket
+import threading
+import time
+
+import framing
+import relay
+
+
+def legacy_relay(src, dst):
+    """The original server6 path: one new bytes object per recv, plain send."""
+    dropped = 0
+    while True:
+        data = src.recv(65536)
+        if not data:
+            return dropped
+        sent = dst.send(data)
+        dropped += len(data) - sent
+
+
+def buffered_relay(src, dst):
+    """Frames parsed in place and forwarded from the receive buffer."""
+    decoder = framing.FrameDecoder()
+    while decoder.recv_from(src):
+        for frame in decoder.frames():
+            header = framing.encode_header(frame.type, len(frame.payload), frame.stream_id, frame.flags)
+            framing.sendall_buffers(dst, (header, frame.payload))
+    return 0
+
+
+def splice_relay(src, dst):
+    """Headers parsed in Python, payload remainders spliced in the kernel."""
+    decoder = framing.FrameDecoder()
+    splicer = relay.SpliceRelay()
+    try:
+        while decoder.recv_from(src):
+            for frame in decoder.frames():
+                header = framing.encode_header(frame.type, len(frame.payload), frame.stream_id, frame.flags)
+                framing.sendall_buffers(dst, (header, frame.payload))
+            partial = decoder.partial_frame()
+            if partial is not None and partial[1] >= relay.MIN_SPLICE_BYTES:
+                frame, missing = partial
+                header = framing.encode_header(frame.type, len(frame.payload) + missing, frame.stream_id, frame.flags)
+                framing.sendall_buffers(dst, (header, frame.payload))
+                splicer.forward(src.fileno(), dst.fileno(), missing)
+                decoder.discard_partial()
+    finally:
+        splicer.close()
+    return 0
+
+
+def connected_pair(listener):
+    client = socket.create_connection(listener.getsockname())
+    server, _ = listener.accept()
+    return client, server
+
+
+def run(relay_func, total_bytes, chunk_size):
+    """Pushes ``total_bytes`` through ``relay_func``.
+
+    Returns (seconds, bytes received, bytes dropped, relay CPU seconds).
+    """
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(("127.0.0.1", 0))
+    listener.listen(2)
+    producer, relay_in = connected_pair(listener)
+    relay_out, consumer = connected_pair(listener)
+    listener.close()
+
+    frame = framing.encode_frame(framing.FILECHUNK, bytes(chunk_size), 1)
+    count = total_bytes // chunk_size
+    result = {}
+
+    def produce():
+        for _ in range(count):
+            producer.sendall(frame)
+        producer.close()
+
+    def forward():
+        cpu_start = time.thread_time()
+        result["dropped"] = relay_func(relay_in, relay_out)
+        result["cpu"] = time.thread_time() - cpu_start
+        relay_out.close()
+
+    received = 0
+    buf = bytearray(1 << 20)
+    start = time.perf_counter()
+    threads = [threading.Thread(target=produce), threading.Thread(target=forward)]
+    for thread in threads:
+        thread.start()
+    while n := consumer.recv_into(buf):
+        received += n
+    elapsed = time.perf_counter() - start
+    for thread in threads:
+        thread.join()
+    consumer.close()
+    relay_in.close()
+    return elapsed, received, result.get("dropped", 0), result.get("cpu", 0.0)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--size-mb", type=int, default=512)
+    parser.add_argument("--chunk", type=int, default=65000)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    paths = [("legacy recv/send", legacy_relay), ("recv_into/memoryview", buffered_relay)]
+    if relay.SPLICE_AVAILABLE:
+        paths.append(("os.splice", splice_relay))
+    else:
+        print("[*] os.splice not available, skipping splice path")
+
+    total = args.size_mb * 1024 * 1024
+    print(f"{'path':<22} {'MB/s':>10} {'CPU s/GB':>10} {'dropped bytes':>14}")
+    for name, func in paths:
+        best = None
+        for _ in range(args.repeat):
+            elapsed, received, dropped, cpu = run(func, total, args.chunk)
+            rate = received / elapsed / 1e6
+            if best is None or rate > best[0]:
+                best = (rate, cpu * 1e9 / received, dropped)
+        print(f"{name:<22} {best[0]:>10.1f} {best[1]:>10.3f} {best[2]:>14}")
+
+
+if __name__ == "__main__":
+    main()
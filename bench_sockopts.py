@@ -0,0 +1,220 @@
+"""Socket option profiles: small-message latency and bulk throughput of each.
+
+Runs three loopback tests per profile (see sockopts.PROFILES, plus the
+kernel's defaults):
+
+  burst    two small TEXT frames written back to back, then a wait for the
+           peer's reply, as a chat message followed by a control message;
+           Nagle holds the second until the first is acknowledged
+  bulk     windowed FILECHUNK frames acknowledged by the receiver, the
+           sender pushing (if corked) whenever it waits for the window
+  refs     the same with CHUNKREF-sized frames, as a file the relay has
+           cached: thousands of tiny writes that only corking coalesces
+           once Nagle is off
+  behind   a message written while bulk data to a receiver reading at
+           --rate-mb MB/s is queued; how long it takes to reach the reader
+
+Loopback has no real round trip and lots of bandwidth, so absolute numbers
+flatter every profile; the burst and behind columns show the differences
+best.
+
+Usage: python bench_sockopts.py [--size-mb 256] [--refs 100000] [--rounds 200] [--rate-mb 50]
+"""
+import argparse
+import socket
+import threading
+import time
+
+import framing
+import sockopts
+import transfer
+
+DEFAULT = "kernel default"
+CHUNK = 65000
+# Payload of a CHUNKREF: the sha256 of a cached chunk
+REF = 32
+
+
+def connected_pair(profile, peer_profile=None):
+    """A loopback connection; the client end uses ``profile``, the server end ``peer_profile`` or the same."""
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(("127.0.0.1", 0))
+    listener.listen(1)
+    client = socket.create_connection(listener.getsockname())
+    server, _ = listener.accept()
+    listener.close()
+    tuners = None
+    if profile != DEFAULT:
+        tuners = (sockopts.Tuner(client, profile), sockopts.Tuner(server, peer_profile or profile))
+    return client, server, tuners
+
+
+def burst(profile, rounds):
+    """Median milliseconds from writing two small frames to reading the reply."""
+    client, server, tuners = connected_pair(profile)
+    message = framing.encode_frame(framing.TEXT, b"MSG:hello there")
+    control = framing.encode_frame(framing.TEXT, b"ACK", 1)
+    reply = framing.encode_frame(framing.TEXT, b"ACK")
+
+    def echo():
+        decoder = framing.FrameDecoder()
+        seen = 0
+        while decoder.recv_from(server):
+            for _ in decoder.frames():
+                seen += 1
+                if seen % 2 == 0:
+                    server.sendall(reply)
+                    if tuners is not None:
+                        tuners[1].push()
+
+    thread = threading.Thread(target=echo, daemon=True)
+    thread.start()
+    decoder = framing.FrameDecoder()
+    times = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        client.sendall(message)
+        client.sendall(control)
+        if tuners is not None:
+            tuners[0].push()
+        while next(decoder.frames(), None) is None:
+            decoder.recv_from(client)
+        times.append(time.perf_counter() - start)
+    client.close()
+    thread.join()
+    server.close()
+    return sorted(times)[len(times) // 2] * 1000
+
+
+def bulk(profile, count, chunk=CHUNK):
+    """Frames per second of a windowed transfer, the receiver acknowledging every 1 MB.
+
+    The window counts ``CHUNK`` bytes per frame, as for a CHUNKREF.
+    """
+    # Like clientgui3, the receiver, which writes ACKs, never corks
+    client, server, tuners = connected_pair(profile, sockopts.BULK if profile == sockopts.BULK_CORKED else None)
+    window = transfer.SendWindow()
+    payload = bytes(chunk)
+
+    def receive():
+        decoder = framing.FrameDecoder()
+        received = acked = 0
+        while decoder.recv_from(server):
+            for frame in decoder.frames():
+                if frame.type == framing.EOF:
+                    framing.send_ack(server, 1, received)
+                    return
+                received += CHUNK
+            if received - acked >= 1024 * 1024:
+                framing.send_ack(server, 1, received)
+                acked = received
+
+    def read_acks():
+        decoder = framing.FrameDecoder()
+        try:
+            while decoder.recv_from(client):
+                for frame in decoder.frames():
+                    window.ack(framing.decode_ack(frame))
+        except OSError:
+            pass  # Closed once the transfer is done
+
+    threads = [threading.Thread(target=receive, daemon=True), threading.Thread(target=read_acks, daemon=True)]
+    for thread in threads:
+        thread.start()
+    start = time.perf_counter()
+    for _ in range(count):
+        if tuners is not None and not window.has_room(CHUNK):
+            tuners[0].push()
+        window.wait_for_room(CHUNK)
+        window.sent(CHUNK)
+        framing.send_frame(client, framing.FILECHUNK, payload, 1, framing.FLAG_WINDOWED)
+    framing.send_frame(client, framing.EOF, b"", 1)
+    if tuners is not None:
+        tuners[0].push()
+    window.wait_all_acked()
+    elapsed = time.perf_counter() - start
+    # A 1 MB ACK can already cover the last frame, so the receiver may still
+    # be reading the EOF; closing its socket under it gives EBADF
+    threads[0].join()
+    client.close()
+    server.close()
+    return count / elapsed
+
+
+def behind(profile, rate_bytes, samples):
+    """Median milliseconds a message takes to reach a reader busy with bulk data."""
+    client, server, tuners = connected_pair(profile)
+    writer = framing.LockedSocket(client)
+    running = threading.Event()
+    running.set()
+    payload = bytes(CHUNK)
+    sent_at = {}
+    delays = []
+
+    def send_bulk():
+        try:
+            while running.is_set():
+                framing.send_frame(writer, framing.FILECHUNK, payload, 1)
+        except OSError:
+            pass
+
+    def read_slowly():
+        decoder = framing.FrameDecoder(initial_size=CHUNK * 2)
+        start = time.perf_counter()
+        received = 0
+        while len(delays) < samples:
+            # Hold the reader to rate_bytes per second
+            ahead = received / rate_bytes - (time.perf_counter() - start)
+            if ahead > 0:
+                time.sleep(ahead)
+            nbytes = decoder.recv_from(server)
+            if not nbytes:
+                return
+            received += nbytes
+            for frame in decoder.frames():
+                if frame.type == framing.TEXT:
+                    delays.append(time.perf_counter() - sent_at[bytes(frame.payload)])
+
+    threads = [threading.Thread(target=send_bulk, daemon=True), threading.Thread(target=read_slowly, daemon=True)]
+    for thread in threads:
+        thread.start()
+    # Let the queues fill up first
+    time.sleep(0.5)
+    for i in range(samples):
+        text = f"MSG:{i}".encode()
+        sent_at[text] = time.perf_counter()
+        framing.send_frame(writer, framing.TEXT, text)
+        if tuners is not None:
+            tuners[0].push()
+        time.sleep(0.05)
+    threads[1].join(30)
+    running.clear()
+    client.shutdown(socket.SHUT_RDWR)
+    client.close()
+    server.close()
+    delays.sort()
+    return delays[len(delays) // 2] * 1000 if delays else float("nan")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--size-mb", type=int, default=256)
+    parser.add_argument("--refs", type=int, default=100000)
+    parser.add_argument("--rounds", type=int, default=200)
+    parser.add_argument("--rate-mb", type=float, default=50.0)
+    parser.add_argument("--samples", type=int, default=20)
+    args = parser.parse_args()
+
+    if sockopts.TCP_CORK is None or sockopts.TCP_NOTSENT_LOWAT is None:
+        print("[*] TCP_CORK or TCP_NOTSENT_LOWAT not available; those settings are skipped")
+    print(f"{'profile':<16} {'burst ms':>10} {'bulk MB/s':>10} {'refs k/s':>10} {'behind ms':>10}")
+    for profile in (DEFAULT,) + sockopts.PROFILES:
+        latency = burst(profile, args.rounds)
+        throughput = bulk(profile, args.size_mb * 1024 * 1024 // CHUNK) * CHUNK / 1e6
+        refs = bulk(profile, args.refs, REF) / 1000
+        queued = behind(profile, args.rate_mb * 1e6, args.samples)
+        print(f"{profile:<16} {latency:>10.3f} {throughput:>10.1f} {refs:>10.1f} {queued:>10.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+"""Qt event-loop latency under a flood of network updates, batched vs per-signal.
+
+Runs MessengerApp on the offscreen platform (no display needed) while a
+thread emits what a fast transfer and a chatty peer produce: per-chunk
+debug lines and progress, plus chat messages. A 5 ms timer samples how
+late the event loop runs, and the run ends once the last line is on
+screen. Reports lateness percentiles and how long the flood took to show.
+
+Usage: python bench_ui.py [--chunks 20000] [--messages 2000]
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+
+from PyQt6.QtCore import QTimer
+from PyQt6.QtWidgets import QApplication
+
+import clientgui3
+
+PROBE_INTERVAL_MS = 5
+DONE_LINE = "bench: flood finished"
+
+
+class FloodThread(clientgui3.NetworkThread):
+    """A NetworkThread that emits a transfer's worth of signals instead of connecting."""
+
+    def __init__(self, chunks, messages):
+        super().__init__("127.0.0.1", 0)
+        self.chunks = chunks
+        self.messages = messages
+
+    def run(self):
+        every = max(1, self.chunks // max(1, self.messages))
+        for i in range(self.chunks):
+            self.debug_message.emit("chunk", f"Received encrypted chunk: 65000 bytes")
+            self.debug_message.emit("chunk", f"Wrote chunk: 65000 bytes, total: {i * 65000}/{self.chunks * 65000}")
+            progress = i * 100 // self.chunks
+            self.file_progress.emit(progress, f"Receiving: {progress}%")
+            if i % every == 0:
+                self.update_message.emit(f"Received: message {i // every}")
+        self.file_received.emit(DONE_LINE)
+
+
+def last_line(log):
+    messages = log.read(len(log) - 1, 1)
+    return messages[0].text if messages else ""
+
+
+def run(batch_updates, chunks, messages):
+    # A scratch history, so the run neither reads nor grows the real one
+    window = clientgui3.MessengerApp(batch_updates=batch_updates, history_dir=tempfile.mkdtemp())
+    # Replace the real connection with the flood
+    window.network_thread.stop()
+    window.network_thread.wait()
+    flood = FloodThread(chunks, messages)
+    window.attach_network_thread(flood)
+
+    lateness = []
+    last = [time.perf_counter()]
+
+    def probe():
+        now = time.perf_counter()
+        lateness.append(max(0.0, now - last[0] - PROBE_INTERVAL_MS / 1000))
+        last[0] = now
+        if last_line(window.message_log) == DONE_LINE:
+            QApplication.instance().quit()
+
+    timer = QTimer()
+    timer.timeout.connect(probe)
+    timer.start(PROBE_INTERVAL_MS)
+
+    start = time.perf_counter()
+    flood.start()
+    QApplication.instance().exec()
+    elapsed = time.perf_counter() - start
+    timer.stop()
+    flood.wait()
+    lines = len(window.message_log)
+    window.close()
+    return elapsed, sorted(lateness), lines
+
+
+def percentile(values, fraction):
+    return values[min(len(values) - 1, int(len(values) * fraction))] * 1000 if values else 0.0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--chunks", type=int, default=20000)
+    parser.add_argument("--messages", type=int, default=2000)
+    args = parser.parse_args()
+
+    app = QApplication(sys.argv[:1])
+    print(f"{'mode':<12} {'shown after':>12} {'p50 late':>10} {'p99 late':>10} {'max late':>10} {'lines':>7}")
+    for name, batch_updates in (("per-signal", False), ("batched", True)):
+        elapsed, lateness, lines = run(batch_updates, args.chunks, args.messages)
+        print(f"{name:<12} {elapsed:>11.2f}s {percentile(lateness, 0.5):>8.1f}ms "
+              f"{percentile(lateness, 0.99):>8.1f}ms {percentile(lateness, 1.0):>8.1f}ms {lines:>7}")
+    del app
+
+
+if __name__ == "__main__":
+    main()
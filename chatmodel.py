@@ -0,0 +1,122 @@
+import time
+from collections import OrderedDict
+
+from PyQt6.QtCore import QAbstractListModel, QEvent, QModelIndex, Qt
+from PyQt6.QtWidgets import QAbstractItemView, QHeaderView, QTableView
+
+# Messages read from the log at a time, and how many such pages are kept
+PAGE_SIZE = 256
+CACHED_PAGES = 8
+
+
+class MessageListModel(QAbstractListModel):
+    """List model over a ``history.MessageLog``, read a page at a time.
+
+    Only the row count is known up front; rows are read from the log when
+    the view asks for them, PAGE_SIZE at a time, and the last CACHED_PAGES
+    pages are kept. Shown in a MessageView, a conversation costs the same
+    to open for ten messages as for a million.
+    """
+
+    def __init__(self, log=None, parent=None):
+        super().__init__(parent)
+        self._log = log
+        # Rows before this one were cleared from the view but stay in the log
+        self._first = 0
+        self._rows = len(log) if log is not None else 0
+        self._pages = OrderedDict()
+
+    @property
+    def log(self):
+        return self._log
+
+    def set_log(self, log):
+        """Shows another conversation."""
+        self.beginResetModel()
+        self._log = log
+        self._first = 0
+        self._rows = len(log) if log is not None else 0
+        self._pages.clear()
+        self.endResetModel()
+
+    def clear(self):
+        """Hides the messages shown so far; the log keeps them."""
+        self.beginResetModel()
+        self._first = self._rows
+        self._pages.clear()
+        self.endResetModel()
+
+    def refresh(self):
+        """Picks up messages appended to the log since the last call."""
+        rows = len(self._log) if self._log is not None else 0
+        if rows <= self._rows:
+            return
+        # The last page may have been cached while it was still filling up
+        self._pages.pop(self._rows // PAGE_SIZE, None)
+        self.beginInsertRows(QModelIndex(), self._rows - self._first, rows - self._first - 1)
+        self._rows = rows
+        self.endInsertRows()
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else self._rows - self._first
+
+    def message(self, row):
+        """Returns the ``history.Message`` shown in ``row``, or None."""
+        n = self._first + row
+        if row < 0 or n >= self._rows:
+            return None
+        number = n // PAGE_SIZE
+        page = self._pages.get(number)
+        if page is None:
+            page = self._log.read(number * PAGE_SIZE, PAGE_SIZE)
+            self._pages[number] = page
+            if len(self._pages) > CACHED_PAGES:
+                self._pages.popitem(last=False)
+        else:
+            self._pages.move_to_end(number)
+        offset = n - number * PAGE_SIZE
+        return page[offset] if offset < len(page) else None
+
+    def data(self, index, role=Qt.ItemDataRole.DisplayRole):
+        if not index.isValid():
+            return None
+        if role == Qt.ItemDataRole.DisplayRole:
+            message = self.message(index.row())
+            return message.text if message is not None else None
+        if role == Qt.ItemDataRole.ToolTipRole:
+            message = self.message(index.row())
+            if message is not None and message.timestamp:
+                return time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(message.timestamp))
+        return None
+
+
+class MessageView(QTableView):
+    """Shows a MessageListModel as a plain list of fixed-height rows.
+
+    QListView lays out every row whenever rows are added, even with
+    uniform item sizes, so each new message costs time proportional to the
+    history. A table whose rows all have the same fixed height only keeps
+    the row count, so opening, scrolling and appending stay constant time.
+    """
+
+    def __init__(self, model, parent=None):
+        super().__init__(parent)
+        self.setModel(model)
+        self.setShowGrid(False)
+        self.setWordWrap(False)
+        self.setSelectionBehavior(QAbstractItemView.SelectionBehavior.SelectRows)
+        self.horizontalHeader().hide()
+        self.horizontalHeader().setStretchLastSection(True)
+        rows = self.verticalHeader()
+        rows.hide()
+        rows.setSectionResizeMode(QHeaderView.ResizeMode.Fixed)
+        self._fit_rows()
+
+    def _fit_rows(self):
+        self.verticalHeader().setDefaultSectionSize(self.fontMetrics().height() + 4)
+
+    def changeEvent(self, event):
+        # Rows follow the font, including one set by a style sheet
+        if event.type() == QEvent.Type.FontChange:
+            self._fit_rows()
+        super().changeEvent(event)
@@ -0,0 +1,159 @@
+import hashlib
+import os
+import threading
+from collections import Counter, OrderedDict
+
+DEFAULT_MAX_BYTES = 1024 * 1024 * 1024
+
+# Chunks are keyed by the sha256 of their (encrypted) payload
+HASH_SIZE = hashlib.sha256().digest_size
+
+
+def chunk_hash(payload):
+    return hashlib.sha256(payload).digest()
+
+
+class ChunkCache:
+    """Relay-side store of FILECHUNK payloads, keyed by their sha256.
+
+    Payloads are cached exactly as they cross the relay, i.e. encrypted,
+    so a hit is the same bytes the sender would have sent. Each chunk is a
+    file named by its hash under ``directory``; the index is rebuilt from
+    the directory on start, oldest first, so the cache survives restarts.
+    Once the total exceeds ``max_bytes`` the least recently used chunks are
+    deleted.
+
+    A sender first asks which of its next chunks are cached (``pin``). The
+    chunks reported present are pinned for that transfer until it fetches
+    them with ``take`` or the transfer ends (``release``), so eviction can
+    never break a promise already made.
+    """
+
+    def __init__(self, directory, max_bytes=DEFAULT_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        # hash -> size, least recently used first
+        self._entries = OrderedDict()
+        # hash -> number of outstanding pins
+        self._pinned = Counter()
+        # owner -> Counter of hashes it has pinned
+        self._owners = {}
+        self._lock = threading.Lock()
+
+        os.makedirs(directory, exist_ok=True)
+        self._load()
+
+    def _load(self):
+        found = []
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            try:
+                key = bytes.fromhex(name)
+                st = os.stat(path)
+            except (ValueError, OSError):
+                continue
+            if len(key) == HASH_SIZE:
+                found.append((st.st_mtime, key, st.st_size))
+        for _, key, size in sorted(found):
+            self._entries[key] = size
+            self.total_bytes += size
+        self._evict()
+
+    def for_worker(self, worker_id):
+        """Returns a cache of the same size in a per-worker subdirectory."""
+        return ChunkCache(os.path.join(self.directory, f"worker-{worker_id}"), self.max_bytes)
+
+    def _path(self, key):
+        return os.path.join(self.directory, key.hex())
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def put(self, key, payload):
+        """Stores ``payload`` under ``key`` unless it is already cached."""
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return
+        tmp_path = f"{self._path(key)}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(payload)
+        os.replace(tmp_path, self._path(key))
+        with self._lock:
+            if key not in self._entries:
+                self._entries[key] = len(payload)
+                self.total_bytes += len(payload)
+            self._evict()
+
+    def _evict(self):
+        """Deletes least recently used, unpinned chunks until under the limit."""
+        if self.total_bytes <= self.max_bytes:
+            return
+        for key in list(self._entries):
+            if self.total_bytes <= self.max_bytes:
+                break
+            if self._pinned[key]:
+                continue
+            self.total_bytes -= self._entries.pop(key)
+            try:
+                os.remove(self._path(key))
+            except OSError:
+                pass
+
+    def pin(self, owner, keys):
+        """Returns which of ``keys`` are cached, pinning those for ``owner``."""
+        present = []
+        with self._lock:
+            pins = self._owners.setdefault(owner, Counter())
+            for key in keys:
+                if key in self._entries:
+                    self._entries.move_to_end(key)
+                    self._pinned[key] += 1
+                    pins[key] += 1
+                    present.append(True)
+                else:
+                    present.append(False)
+        return present
+
+    def take(self, owner, key):
+        """Returns a chunk ``owner`` pinned, releasing the pin; None if it was not pinned."""
+        with self._lock:
+            pins = self._owners.get(owner)
+            if not pins or not pins[key]:
+                return None
+        # The pin keeps _evict away from the file until it has been read
+        try:
+            with open(self._path(key), "rb") as f:
+                return f.read()
+        except OSError:
+            return None
+        finally:
+            with self._lock:
+                # Unless release dropped the owner's pins meanwhile
+                if self._owners.get(owner) is pins and pins[key]:
+                    self._unpin(pins, key)
+
+    def _unpin(self, pins, key):
+        pins[key] -= 1
+        if not pins[key]:
+            del pins[key]
+        self._pinned[key] -= 1
+        if not self._pinned[key]:
+            del self._pinned[key]
+
+    def release(self, owner):
+        """Drops every pin ``owner`` still holds, e.g. when its transfer ends."""
+        with self._lock:
+            pins = self._owners.pop(owner, None)
+            if pins:
+                for key in list(pins.elements()):
+                    self._unpin(pins, key)
+                self._evict()
+
+    def owners(self):
+        with self._lock:
+            return list(self._owners)
@@ -0,0 +1,57 @@
+import threading
+
+
+class ClientIndex:
+    """Secondary index from a lookup key (IP, later identity) to live addresses.
+
+    Kept up to date on connect and disconnect so pairing requests resolve in
+    O(1) instead of scanning every connected client. Addresses under one key
+    stay in connection order, so when several clients share an IP a lookup
+    deterministically returns the earliest live one, as the old linear scan
+    over ``clients`` did.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # key -> {address: None}, insertion-ordered
+        self._by_key = {}
+        # address -> keys it is indexed under
+        self._keys = {}
+
+    def add(self, address, *keys):
+        """Indexes ``address`` under each of ``keys``."""
+        with self._lock:
+            for key in keys:
+                self._by_key.setdefault(key, {})[address] = None
+            self._keys.setdefault(address, set()).update(keys)
+
+    def remove(self, address):
+        """Drops ``address`` from every key it was indexed under."""
+        with self._lock:
+            for key in self._keys.pop(address, ()):
+                addresses = self._by_key.get(key)
+                if addresses is None:
+                    continue
+                addresses.pop(address, None)
+                if not addresses:
+                    del self._by_key[key]
+
+    def lookup(self, key, exclude=None):
+        """Returns the earliest live address for ``key`` other than ``exclude``, or None."""
+        with self._lock:
+            addresses = self._by_key.get(key)
+            if not addresses:
+                return None
+            # At most two entries are looked at, whatever the fan-in
+            for address in addresses:
+                if address != exclude:
+                    return address
+            return None
+
+    def lookup_all(self, key):
+        """Returns every live address for ``key`` in connection order."""
+        with self._lock:
+            return list(self._by_key.get(key, ()))
+
+    def __len__(self):
+        return len(self._keys)
@@ -1,17 +1,54 @@
 import os
 import sys
+import time
+import argparse
+import queue
+import select
 import socket
 import base64
+import itertools
+import threading
 from PyQt6.QtWidgets import (
     QApplication, QWidget, QLabel, QVBoxLayout, QPushButton, QLineEdit, QMessageBox, 
-    QInputDialog, QFileDialog, QTextEdit, QHBoxLayout, QScrollArea, QProgressBar
+    QInputDialog, QFileDialog, QHBoxLayout, QScrollArea, QProgressBar
 )
-from PyQt6.QtCore import QThread, pyqtSignal, Qt
+from PyQt6.QtCore import QThread, QTimer, pyqtSignal, Qt
 from PyQt6.QtGui import QFont
 
+import chatmodel
+import chunkcache
+import compression
+import control
+import filewriter
+import framing
+import heartbeat
+import history
+import reconnect
+import resume
+import sockopts
+import transfer
+import uibatch
+import xorcipher
+
 # Simple encryption/decryption key (a simple XOR key)
 ENCRYPTION_KEY = b'SIMPLEKEYFORXOR123456789012345678901234567890'
 
+# Plaintext bytes per FILECHUNK, leaving room for the header
+CHUNK_SIZE = 65000
+
+# Chunks whose hashes are sent to the relay's chunk cache in one query
+CACHE_BATCH = 64
+
+# Server and receiver replies handed to a sending transfer, besides a plain ACK
+TRANSFER_REPLIES = ("ACK:", "ERROR:", "RESUME:", "PARALLEL", "JOIN_TOKEN:", "VERIFIED", "VERIFY_FAILED")
+
+# Heartbeats, sent without waiting so a blocked socket never holds up the reader
+PING_FRAME = framing.encode_frame(framing.TEXT, heartbeat.PING.encode("utf-8"))
+PONG_FRAME = framing.encode_frame(framing.TEXT, heartbeat.PONG.encode("utf-8"))
+
+# Slowest rate a receiver is expected to hash a finished parallel transfer at
+VERIFY_BYTES_PER_SECOND = 10 * 1024 * 1024
+
 # Network Thread to handle server communication
 class NetworkThread(QThread):
     update_message = pyqtSignal(str)
@@ -19,13 +56,40 @@ class NetworkThread(QThread):
     pair_request = pyqtSignal(str)
     file_received = pyqtSignal(str)
     file_progress = pyqtSignal(int, str)
+    # Per-chunk detail as (key, line); only the latest line per key is shown
+    debug_message = pyqtSignal(str, str)
 
-    def __init__(self, host, port):
+    def __init__(self, host, port, window_size=transfer.DEFAULT_WINDOW, durability=filewriter.DEFAULT_DURABILITY,
+                 codec=compression.NONE, compress_level=None, streams=0, auto_reconnect=True):
         super().__init__()
         self.host = host
         self.port = port
+        # Lost connections are retried with backoff until stopped, and the
+        # relay restores our pairing from the session token it gave us
+        self.auto_reconnect = auto_reconnect
+        self.backoff = reconnect.Backoff()
+        self.stopped = threading.Event()
+        self.session_token = None
+        # Files whose sending a disconnect cut short, sent again (and
+        # resumed by the receiver) once the pairing is back
+        self.interrupted_sends = []
+        # Files to send, in order, on one sender thread: the receiver takes
+        # one file at a time, and the GUI never waits for a transfer
+        self.send_queue = queue.Queue()
+        threading.Thread(target=self.send_queued, name="sender", daemon=True).start()
+        # Bytes in flight per outgoing file; 0 falls back to stop-and-wait
+        self.window_size = window_size
         self.client_socket = None
+        # Socket options of the connection, switched while files move
+        self.tuner = None
+        self._receiving_file = False
         self.running = True
+        self.cipher = xorcipher.XorCipher(ENCRYPTION_KEY)
+        # Compression offered for outgoing files, if the receiver supports it
+        self.codec = codec
+        self.compress_level = compress_level
+        # Connections a windowed file is split over; 0 picks by file size
+        self.streams = streams
             
         # File receiving state
         self.receiving_file = False
@@ -33,160 +97,626 @@ class NetworkThread(QThread):
         self.current_file_path = ""
         self.current_file_size = 0
         self.received_bytes = 0
+        # Received files are written and synced on their own thread
+        self.durability = durability
+        self.file_writer = None
+        # Resume state of the file being received, when its sender gave a transfer id
+        self.receive_manifest = None
+        self.resume_hasher = None
+        # Codec agreed for the file being received, and its position in
+        # payload bytes as they crossed the wire: the unit of its ACKs, which
+        # the sender's window and the relay's backpressure count alike
+        self.receive_codec = None
+        self.received_wire_bytes = 0
+        # A file sent in parallel: the stream it was announced on, its
+        # ranges once known, and the sender's sha256 of the whole file
+        self.parallel_stream_id = None
+        self.receive_ranges = None
+        self.expected_digest = None
+
+        # Outgoing transfers get their own stream ids; the reader thread
+        # hands each the server's replies through a queue of its own, so
+        # no transfer takes another's replies
+        self.stream_ids = itertools.count(1)
+        self.transfer_replies = {}
+        # Windowed transfers in progress, by stream id
+        self.send_windows = {}
 
     def run(self):
+        while True:
+            started = time.monotonic()
+            self.serve_connection()
+            if not self.running or not self.auto_reconnect:
+                break
+            if time.monotonic() - started >= reconnect.STABLE_AFTER:
+                self.backoff.reset()
+            delay = self.backoff.next_delay()
+            self.connection_status.emit(f"Reconnecting in {delay:.2f}s...")
+            if self.stopped.wait(delay):
+                break
+
+    def serve_connection(self):
+        """Connects to the server and handles its frames until the connection ends."""
+        connected = False
         try:
-            self.client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            # Reader thread and sending threads share the socket for writes
+            self.client_socket = framing.LockedSocket(socket.socket(socket.AF_INET, socket.SOCK_STREAM))
+            self.tuner = sockopts.Tuner(self.client_socket.sock)
             self.client_socket.connect((self.host, self.port))
+            connected = True
             self.connection_status.emit(f"Connected to {self.host}:{self.port}")
+            if self.session_token is not None:
+                # Ask the relay to pair us with our peer again
+                framing.send_text(self.client_socket, f"RESUME_SESSION:{self.session_token}")
 
+            # Frames are parsed in place, so partial and merged reads are handled
+            decoder = framing.FrameDecoder()
+            last_heard = time.monotonic()
             while self.running:
-                message_data = self.client_socket.recv(65536)  # Use larger buffer size
-                if not message_data:
+                # A server quiet for a heartbeat interval is asked to answer,
+                # and given up on (and reconnected to) if it stays silent
+                if not select.select([self.client_socket], [], [], heartbeat.DEFAULT_HEARTBEAT_INTERVAL)[0]:
+                    if time.monotonic() - last_heard >= heartbeat.DEFAULT_IDLE_TIMEOUT:
+                        raise ConnectionError("Server stopped responding")
+                    self.client_socket.send_nowait(PING_FRAME)
+                    self.tuner.push()
+                    continue
+                if not decoder.recv_from(self.client_socket):
                     break
-                
-                # Try to decode as text first
-                try:
-                    # If we're in file receiving mode
-                    if self.receiving_file:
-                        try:
-                            # First, check if it's a text message like EOF
-                            try:
-                                message_str = message_data.decode('utf-8')
-                                
-                                # Check for EOF marker
-                                if message_str == "EOF":
-                                    # File transfer is complete - close the file
-                                    if hasattr(self, 'current_file') and self.current_file:
-                                        self.current_file.close()
-                                        
-                                        # Verify file was created with content
-                                        if os.path.exists(self.current_file_path):
-                                            file_size = os.path.getsize(self.current_file_path)
-                                            self.file_received.emit(f"File saved to {self.current_file_path} ({file_size} bytes)")
-                                        else:
-                                            self.file_received.emit(f"Error: File not created at {self.current_file_path}")
-                                    
-                                    self.file_progress.emit(100, "Complete")
-                                    
-                                    # Reset file receiving state
-                                    self.receiving_file = False
-                                    self.current_file_path = ""
-                                    self.current_file_size = 0
-                                    self.received_bytes = 0
-                                    continue
-                            except UnicodeDecodeError:
-                                # This is binary data (most likely a file chunk)
-                                pass
-                            
-                            # If it's not EOF, then it's file data
-                            if message_data.startswith(b'FILECHUNK:'):
-                                # Extract binary data after the marker
-                                binary_data = message_data[10:]  # Skip "FILECHUNK:"
-                                
-                                # Decrypt the binary data
-                                decrypted_data = self.simple_decrypt(binary_data)
-                                
-                                self.file_received.emit(f"Received encrypted chunk: {len(binary_data)} bytes")
-                                
-                                if hasattr(self, 'current_file') and self.current_file:
-                                    # Write the chunk to file
-                                    self.current_file.write(decrypted_data)
-                                    self.current_file.flush()  # Force flush to disk
-                                    os.fsync(self.current_file.fileno())  # Ensure it's written to disk
-                                    
-                                    # Update progress
-                                    self.received_bytes += len(decrypted_data)
-                                    if self.current_file_size > 0:
-                                        progress = min(99, int((self.received_bytes / self.current_file_size) * 100))
-                                        self.file_progress.emit(progress, f"Receiving: {progress}%")
-                                        
-                                    self.file_received.emit(f"Wrote chunk: {len(decrypted_data)} bytes, total: {self.received_bytes}/{self.current_file_size}")
-                                    
-                                # Continue to next message
-                                continue
-                                
-                        except Exception as e:
-                            self.file_received.emit(f"Error processing file data: {str(e)}")
-                        
-                        # Continue to next message
-                        continue
-                    
-                    # Regular message handling for non-file-transfer mode
-                    message = message_data.decode('utf-8')
-                    
-                    # Handle various message types (PAIR, FILE, etc.)
-                    if message.startswith("MSG:"):
-                        # Extract the actual message content
-                        actual_message = message[4:]  # Skip "MSG:" prefix
-                        self.update_message.emit(f"Received: {actual_message}")
-                    elif message.startswith("PAIR_REQUEST:"):
-                        sender_ip = message.split(":")[1]
-                        self.pair_request.emit(sender_ip)
-                    elif message.startswith("PAIR_SUCCESS"):
-                        self.connection_status.emit("Pairing successful!")
-                    elif message.startswith("PAIR_FAILED"):
-                        self.connection_status.emit("Pairing failed. Try again.")
-                    elif message.startswith("FILE:"):
-                        file_parts = message.split(":")
-                        if len(file_parts) >= 3:
-                            file_name = file_parts[1]
-                            file_size = int(file_parts[2])
-                            self.start_receiving_file(file_name, file_size)
-                    elif message == "ACK":
-                        # Simply acknowledge - don't need to display this
-                        pass
-                    else:
-                        self.update_message.emit(f"Server: {message}")
-                        
-                except UnicodeDecodeError:
-                    # This is binary data outside file mode - unusual but handle it
-                    self.connection_status.emit(f"Received unexpected binary data: {len(message_data)} bytes")
-                
-                except Exception as e:
-                    self.connection_status.emit(f"Error processing message: {str(e)}")
-                    
+                last_heard = time.monotonic()
+
+                for frame in decoder.frames():
+                    self.handle_frame(frame)
+                # ACKs and replies written meanwhile must not wait behind
+                # the cork of a file we are sending
+                self.tuner.push()
+
         except Exception as e:
             self.connection_status.emit(f"Error: {str(e)}")
         finally:
             if self.client_socket:
                 self.client_socket.close()
-            self.connection_status.emit("Disconnected from server")
+            self.abort_transfers("Disconnected from server", transfer.TransferDisconnected)
+            if connected:
+                self.connection_status.emit("Disconnected from server")
+
+    def abort_transfers(self, reason, error=transfer.TransferAborted):
+        """Fails the transfers in progress with ``error``; what was received is kept so it can resume."""
+        for window in list(self.send_windows.values()):
+            window.abort(reason, error)
+        if self.file_writer is not None:
+            self.file_writer.abort()
+            self.file_writer = None
+            self.receiving_file = False
+
+    def handle_frame(self, frame):
+        """Dispatches one frame received from the server."""
+        try:
+            if frame.type == framing.FILECHUNK:
+                if not self.receiving_file or (self.receive_ranges is not None
+                                               and frame.stream_id not in self.receive_ranges):
+                    self.connection_status.emit(f"Received unexpected file data: {len(frame.payload)} bytes")
+                    return
+                if self.file_writer is None:
+                    # The sender skipped the resume handshake, so start from 0
+                    self.open_file_writer(0)
+
+                # Decrypt the binary data; compression was applied before
+                # encryption, so it is undone after
+                decrypted_data = self.simple_decrypt(frame.payload)
+                self.received_wire_bytes += len(frame.payload)
+                if frame.flags & framing.FLAG_COMPRESSED:
+                    try:
+                        if self.receive_codec is None:
+                            raise ValueError("no codec was agreed for this transfer")
+                        decrypted_data = compression.decompress(self.receive_codec, decrypted_data,
+                                                                framing.MAX_PAYLOAD)
+                    except ValueError as e:
+                        self.file_received.emit(f"Error decompressing {self.current_file_path}: {str(e)}")
+                        self.file_writer.abort()
+                        self.file_writer = None
+                        self.receiving_file = False
+                        self.file_progress.emit(0, "Failed")
+                        return
+
+                self.debug_message.emit("chunk", f"Received encrypted chunk: {len(frame.payload)} bytes")
+
+                if self.file_writer is not None:
+                    # Queue the chunk for the writer thread; how often it is
+                    # synced to disk depends on the durability mode
+                    try:
+                        if self.receive_ranges is not None:
+                            # Ranges interleave, so each chunk goes to its own position
+                            position = self.receive_ranges.position(frame.stream_id)
+                            acked = self.receive_ranges.add(frame.stream_id, len(decrypted_data),
+                                                            len(frame.payload))
+                            self.file_writer.write_at(position, decrypted_data)
+                        else:
+                            self.file_writer.write(decrypted_data)
+                            acked = self.received_wire_bytes
+                    except (OSError, ValueError) as e:
+                        self.file_received.emit(f"Error writing {self.current_file_path}: {str(e)}")
+                        self.file_writer.abort()
+                        self.file_writer = None
+                        self.receiving_file = False
+                        self.file_progress.emit(0, "Failed")
+                        return
+
+                    # Update progress
+                    self.received_bytes += len(decrypted_data)
+                    if self.current_file_size > 0:
+                        progress = min(99, int((self.received_bytes / self.current_file_size) * 100))
+                        status = f"Receiving: {progress}%"
+                        if self.receive_codec is not None:
+                            status += f" ({self.received_wire_bytes} bytes compressed from {self.received_bytes})"
+                        self.file_progress.emit(progress, status)
+
+                    self.debug_message.emit("chunk", f"Wrote chunk: {len(decrypted_data)} bytes, total: {self.received_bytes}/{self.current_file_size}")
+
+                    # Cumulative ACK lets a windowed sender keep going
+                    if frame.flags & framing.FLAG_WINDOWED:
+                        framing.send_ack(self.client_socket, frame.stream_id, acked)
+
+            elif frame.type == framing.EOF:
+                if not self.receiving_file:
+                    return
+                if self.receive_ranges is not None:
+                    # Every range ends with its own EOF; the file is done
+                    # once all of them and the digest are in
+                    self.finish_parallel_file()
+                    return
+
+                # File transfer is complete - flush, sync and close the file
+                if self.file_writer is None:
+                    self.open_file_writer(0)
+                if self.file_writer is not None:
+                    writer, self.file_writer = self.file_writer, None
+                    try:
+                        file_size = writer.close()
+                    except OSError as e:
+                        self.file_received.emit(f"Error: could not save {self.current_file_path}: {str(e)}")
+                        self.file_progress.emit(0, "Failed")
+                        self.receiving_file = False
+                        return
+                    if self.receive_manifest is not None:
+                        # Complete: the partial file becomes the real one
+                        os.replace(self.receive_manifest.partial_path, self.current_file_path)
+                        self.receive_manifest.remove()
+                        self.receive_manifest = None
+                    self.file_received.emit(f"File saved to {self.current_file_path} ({file_size} bytes)")
+
+                self.file_progress.emit(100, "Complete")
+
+                # Reset file receiving state
+                self.receiving_file = False
+                self.current_file_path = ""
+                self.current_file_size = 0
+                self.received_bytes = 0
+
+            elif frame.type == framing.ACK:
+                window = self.send_windows.get(frame.stream_id)
+                if window is not None:
+                    window.ack(framing.decode_ack(frame))
+
+            elif frame.type == framing.CACHE_HAVE:
+                # Answer to a sending transfer's cache query
+                self.put_transfer_reply(frame.stream_id, bytes(frame.payload))
+
+            elif frame.type == framing.CONTROL:
+                message, _ = control.decode(frame.payload)
+                if not control.dispatch(self.CONTROL_HANDLERS, message, self, frame):
+                    self.connection_status.emit(f"Received unexpected {message.kind.name} message")
+
+            elif frame.type == framing.TEXT:
+                message = str(frame.payload, 'utf-8')
+
+                # Control messages in text form go to the same handlers as
+                # binary ones; the rest are transfer handshakes and server text
+                parsed = control.parse_text(message)
+                if parsed is not None and control.dispatch(self.CONTROL_HANDLERS, parsed, self, frame):
+                    pass
+                elif message.startswith("RANGES:"):
+                    if self.receiving_file and frame.stream_id == self.parallel_stream_id:
+                        self.start_parallel_file(message[len("RANGES:"):], frame.stream_id)
+                elif message.startswith("DIGEST:"):
+                    if self.receive_ranges is not None and frame.stream_id == self.parallel_stream_id:
+                        self.expected_digest = message[len("DIGEST:"):]
+                        self.finish_parallel_file()
+                elif message.startswith("RESUME_FROM:"):
+                    # The sender's answer to our offer: where its chunks start
+                    if self.receiving_file and self.file_writer is None:
+                        self.open_file_writer(int(message.split(":")[1]))
+                elif message.startswith("ERROR:") and frame.stream_id in self.send_windows:
+                    # The relay gave up a transfer that stopped moving
+                    self.send_windows[frame.stream_id].abort(message)
+                elif message == "ACK" or message.startswith(TRANSFER_REPLIES):
+                    # Replies for a file transfer go to the sending side;
+                    # chat ACKs need no display
+                    if frame.stream_id:
+                        self.put_transfer_reply(frame.stream_id, message)
+                else:
+                    self.update_message.emit(f"Server: {message}")
+
+            else:
+                self.connection_status.emit(f"Received unknown frame type {frame.type}: {len(frame.payload)} bytes")
+
+        except UnicodeDecodeError:
+            # Text frames must carry UTF-8
+            self.connection_status.emit(f"Received undecodable text: {len(frame.payload)} bytes")
+
+        except control.ControlError as e:
+            self.connection_status.emit(f"Received malformed control message: {str(e)}")
 
-    def simple_encrypt(self, data):
-        """Simple XOR encryption for data"""
+        except ConnectionError:
+            # Replies can no longer be sent; end the connection and reconnect
+            raise
+
+        except Exception as e:
+            self.connection_status.emit(f"Error processing message: {str(e)}")
+
+    def handle_msg(self, frame, message):
+        # Chat relayed from our peer
+        self.update_message.emit(f"Received: {message.text}")
+
+    def handle_ping(self, frame, message):
+        # Skipped if a sender is writing; that reaches the server just as well
+        self.client_socket.send_nowait(PONG_FRAME)
+
+    def handle_pong(self, frame, message):
+        pass
+
+    def handle_pair_request(self, frame, message):
+        self.pair_request.emit(message.ip)
+
+    def handle_pair_success(self, frame, message):
+        self.connection_status.emit("Pairing successful!")
+
+    def handle_pair_failed(self, frame, message):
+        self.connection_status.emit("Pairing failed. Try again.")
+
+    def handle_session(self, frame, message):
+        # Presented after a reconnect to get this pairing back
+        self.session_token = message.token
+
+    def handle_session_resumed(self, frame, message):
+        self.connection_status.emit("Pairing restored")
+        self.resend_interrupted()
+
+    def handle_session_wait(self, frame, message):
+        self.connection_status.emit("Waiting for peer to reconnect...")
+
+    def handle_session_failed(self, frame, message):
+        self.session_token = None
+        self.connection_status.emit("Could not restore pairing. Pair again.")
+
+    def handle_peer_disconnected(self, frame, message):
+        self.abort_transfers("Peer disconnected")
+        self.connection_status.emit("Peer disconnected, waiting for it to reconnect...")
+
+    def handle_file(self, frame, message):
+        # Senders that can resume add a transfer id, then optionally the
+        # codec they would like to compress with and the number of streams
+        # they would like to split it over
+        self.start_receiving_file(message.name, message.size, frame.stream_id, message.transfer_id or None,
+                                  message.codec or None, message.streams or 1)
+
+    # Control messages from the server or our peer, in either form; called
+    # as ``handler(self, frame, message)``
+    CONTROL_HANDLERS = {
+        control.MSG: handle_msg,
+        control.PING: handle_ping,
+        control.PONG: handle_pong,
+        control.PAIR_REQUEST: handle_pair_request,
+        control.PAIR_SUCCESS: handle_pair_success,
+        control.PAIR_FAILED: handle_pair_failed,
+        control.SESSION: handle_session,
+        control.SESSION_RESUMED: handle_session_resumed,
+        control.SESSION_WAIT: handle_session_wait,
+        control.SESSION_FAILED: handle_session_failed,
+        control.PEER_DISCONNECTED: handle_peer_disconnected,
+        control.FILE: handle_file,
+    }
+
+    def simple_encrypt(self, data, offset=0):
+        """Simple XOR encryption for data.
+
+        ``offset`` continues the key phase from an earlier chunk; chunks sent
+        by send_file each restart the key at 0, as peers expect.
+        """
         if isinstance(data, str):
             data = data.encode('utf-8')
-            
-        encrypted = bytearray()
-        for i, byte in enumerate(data):
-            key_byte = ENCRYPTION_KEY[i % len(ENCRYPTION_KEY)]
-            encrypted.append(byte ^ key_byte)
-        return bytes(encrypted)
+
+        return self.cipher.apply(data, offset)
     
-    def simple_decrypt(self, data):
+    def simple_decrypt(self, data, offset=0):
         """Simple XOR decryption for data"""
         # XOR decryption is the same as encryption
-        return self.simple_encrypt(data)
+        return self.simple_encrypt(data, offset)
+
+    @property
+    def receiving_file(self):
+        return self._receiving_file
+
+    @receiving_file.setter
+    def receiving_file(self, receiving):
+        # The connection is tuned for bulk data while a file comes in
+        if receiving != self._receiving_file and self.tuner is not None:
+            if receiving:
+                self.tuner.start(sockopts.BULK)
+            else:
+                self.tuner.finish(sockopts.BULK)
+        self._receiving_file = receiving
 
     def send_message(self, message):
         if self.client_socket:
-            self.client_socket.send(message.encode('utf-8'))
+            framing.send_text(self.client_socket, message)
+            # Sent mid-transfer, it must not wait behind the cork
+            self.tuner.push()
+
+    def send_control(self, kind, *values):
+        """Sends a control message (see control.py) in binary form."""
+        if self.client_socket:
+            framing.send_control(self.client_socket, kind, *values)
+            self.tuner.push()
+
+    def put_transfer_reply(self, stream_id, message):
+        replies = self.transfer_replies.get(stream_id)
+        # Late replies from a transfer that already ended are dropped
+        if replies is not None:
+            replies.put(message)
+
+    def wait_transfer_reply(self, stream_id, timeout=30):
+        """Waits for the next ACK/ERROR the server sends for a transfer."""
+        try:
+            return self.transfer_replies[stream_id].get(timeout=timeout)
+        except queue.Empty:
+            raise TimeoutError("Timed out waiting for ACK") from None
+
+    def encode_chunk(self, chunk, compressor):
+        """Returns ``(payload, flags)`` for sending ``chunk``: compressed if worth it, then encrypted."""
+        flags = 0
+        if compressor is not None:
+            chunk, compressed = compressor.compress(chunk)
+            if compressed:
+                flags = framing.FLAG_COMPRESSED
+        return self.simple_encrypt(chunk), flags
+
+    def read_chunks(self, f, chunk_size, compressor):
+        """Yields ``(payload, length, flags, ref)`` for the rest of ``f``; ``ref`` is always None."""
+        while chunk := f.read(chunk_size):
+            payload, flags = self.encode_chunk(chunk, compressor)
+            yield payload, len(chunk), flags, None
+
+    def cached_chunks(self, f, stream_id, chunk_size, compressor):
+        """Yields ``(payload, length, flags, ref)`` for the rest of ``f``.
+
+        Chunks are read CACHE_BATCH at a time and their hashes are sent to
+        the relay one batch before the batch is sent, so its answer is
+        usually back by the time it is needed. Chunks the relay holds come
+        with the ``ref`` to send in a CHUNKREF instead of the payload. A relay without a cache answers
+        with an empty CACHE_HAVE, after which no more queries are made.
+        """
+        use_cache = True
+        pending = None
+        while True:
+            chunks = list(itertools.islice(self.read_chunks(f, chunk_size, compressor), CACHE_BATCH))
+            batch = None
+            if chunks:
+                hashes = None
+                if use_cache:
+                    hashes = [chunkcache.chunk_hash(chunk[0]) for chunk in chunks]
+                    framing.send_frame(self.client_socket, framing.CACHE_QUERY, b"".join(hashes), stream_id)
+                batch = (chunks, hashes)
+
+            if pending is not None:
+                chunks_ahead, hashes = pending
+                present = b""
+                if hashes is not None:
+                    self.tuner.push()
+                    try:
+                        present = self.wait_transfer_reply(stream_id)
+                    except TimeoutError:
+                        present = b""
+                    if isinstance(present, str):
+                        raise RuntimeError(present)
+                    if len(present) != len(hashes):
+                        use_cache = False
+                        present = b""
+                for i, (payload, length, flags, _) in enumerate(chunks_ahead):
+                    yield payload, length, flags, hashes[i] if present and present[i] else None
+
+            if batch is None:
+                return
+            pending = batch
+
+    def read_reply(self, sock, timeout=30):
+        """Reads the next text frame the server sends on a data connection."""
+        decoder = framing.FrameDecoder()
+        sock.settimeout(timeout)
+        try:
+            while decoder.recv_from(sock):
+                for frame in decoder.frames():
+                    if frame.type == framing.TEXT:
+                        return str(frame.payload, 'utf-8')
+        finally:
+            sock.settimeout(None)
+        raise ConnectionError("Server closed the data connection")
+
+    def open_data_connections(self, stream_id, count):
+        """Opens up to ``count`` more connections joined to this one; returns those that joined.
+
+        In cluster mode a connection may land on another worker, which
+        refuses the join, so fewer than ``count`` may come back.
+        """
+        if count <= 0:
+            return []
+        framing.send_text(self.client_socket, "JOIN_TOKEN", stream_id)
+        reply = self.wait_transfer_reply(stream_id)
+        if not reply.startswith("JOIN_TOKEN:"):
+            return []
+        token = reply[len("JOIN_TOKEN:"):]
+
+        joined = []
+        for _ in range(count):
+            sock = framing.LockedSocket(socket.socket(socket.AF_INET, socket.SOCK_STREAM))
+            try:
+                sock.connect((self.host, self.port))
+                framing.send_text(sock, f"JOIN:{token}")
+                if self.read_reply(sock) == "JOIN_SUCCESS":
+                    joined.append(sock)
+                    continue
+            except OSError:
+                sock.close()
+                break
+            sock.close()
+        return joined
+
+    def send_range(self, sock, file_path, stream_id, offset, length, window, compressor, report):
+        """Sends bytes ``offset`` to ``offset + length`` of a file as windowed stream ``stream_id``."""
+        tuner = self.tuner if sock is self.client_socket else sockopts.Tuner(sock.sock)
+        tuner.start(sockopts.BULK_CORKED)
+        try:
+            with open(file_path, "rb") as f:
+                f.seek(offset)
+                remaining = length
+                while remaining:
+                    chunk = f.read(min(CHUNK_SIZE, remaining))
+                    if not chunk:
+                        raise ValueError(f"{file_path} shrank while it was being sent")
+                    remaining -= len(chunk)
+                    payload, flags = self.encode_chunk(chunk, compressor)
+                    if not window.has_room(len(payload)):
+                        tuner.push()
+                    window.wait_for_room(len(payload))
+                    window.sent(len(payload))
+                    framing.send_frame(sock, framing.FILECHUNK, payload, stream_id, flags | framing.FLAG_WINDOWED)
+                    report(len(chunk))
+            framing.send_frame(sock, framing.EOF, b"", stream_id)
+        finally:
+            tuner.finish(sockopts.BULK_CORKED)
+        window.wait_all_acked()
+
+    def send_parallel(self, file_path, file_size, stream_id, streams, compress):
+        """Sends a file as byte ranges over up to ``streams`` connections at once.
+
+        The connection the file was announced on carries the first range
+        and the others join it with a token from the server, which relays
+        them into the same pairing. Each range is its own windowed stream
+        with its own window, so together they keep ``streams`` windows in
+        flight. If fewer connections could be opened, the file is split over
+        those that were. The receiver checks the whole file against our
+        sha256 once every range is in.
+        """
+        file_name = os.path.basename(file_path)
+
+        # The digest is computed while the ranges are sent
+        digest = {}
+
+        def hash_file():
+            try:
+                digest["sha256"] = resume.hash_prefix(file_path, file_size).hexdigest()
+            except (OSError, ValueError) as e:
+                digest["error"] = e
+
+        hasher = threading.Thread(target=hash_file, name=f"hash-{file_name}", daemon=True)
+        hasher.start()
+
+        connections = [self.client_socket] + self.open_data_connections(stream_id, streams - 1)
+        ranges = {next(self.stream_ids): span for span in transfer.split_ranges(file_size, len(connections))}
+        windows = {range_stream: transfer.SendWindow(self.window_size) for range_stream in ranges}
+        compressors = [compression.ChunkCompressor(self.codec, self.compress_level) if compress else None
+                       for _ in ranges]
+        errors = []
+        sent = [0]
+        lock = threading.Lock()
+
+        def report(nbytes):
+            with lock:
+                sent[0] += nbytes
+                progress = int((sent[0] / file_size) * 100)
+                status = f"Sending: {progress}% over {len(connections)} streams"
+                if compress:
+                    status += (f" ({sum(c.compressed_bytes for c in compressors)} bytes compressed"
+                               f" from {sum(c.original_bytes for c in compressors)})")
+            self.file_progress.emit(progress, status)
+
+        def run(*args):
+            try:
+                self.send_range(*args)
+            except Exception as e:
+                errors.append(e)
+                # One failed range fails the file; don't let the others wait it out
+                for window in windows.values():
+                    window.abort(str(e))
+
+        try:
+            framing.send_text(self.client_socket, f"RANGES:{transfer.format_ranges(ranges)}", stream_id)
+            reply = self.wait_transfer_reply(stream_id)
+            if reply != "ACK":
+                raise RuntimeError(f"Receiver refused the ranges: {reply}")
+
+            self.send_windows.update(windows)
+            senders = [threading.Thread(target=run, name=f"send-{range_stream}",
+                                        args=(sock, file_path, range_stream, offset, length,
+                                              windows[range_stream], compressor, report))
+                       for sock, (range_stream, (offset, length)), compressor
+                       in zip(connections, ranges.items(), compressors)]
+            for sender in senders:
+                sender.start()
+            for sender in senders:
+                sender.join()
+        finally:
+            for range_stream in ranges:
+                self.send_windows.pop(range_stream, None)
+            for sock in connections[1:]:
+                sock.close()
+        if errors:
+            raise errors[0]
+
+        hasher.join()
+        if "error" in digest:
+            raise digest["error"]
+        framing.send_text(self.client_socket, f"DIGEST:{digest['sha256']}", stream_id)
+        # The receiver reads the whole file back before it answers
+        reply = self.wait_transfer_reply(stream_id, timeout=30 + file_size / VERIFY_BYTES_PER_SECOND)
+        if reply != "VERIFIED":
+            raise RuntimeError(f"Receiver could not verify '{file_name}': {reply}")
+
+        self.connection_status.emit(f"File '{file_name}' sent successfully over {len(connections)} streams.")
+        self.file_progress.emit(100, "Complete")
+
+    def parallel_streams(self, file_size):
+        """Returns how many connections to offer for sending ``file_size`` bytes."""
+        if self.window_size <= 0:
+            # Parallel ranges rely on the receiver's per-stream ACKs
+            return 1
+        return self.streams or transfer.auto_streams(file_size)
 
     def send_file(self, file_path):
+        """Sends a file now, on the calling thread; see ``queue_file``."""
+        stream_id = None
         try:
             if self.client_socket and os.path.exists(file_path):
                 file_name = os.path.basename(file_path)
                 file_size = os.path.getsize(file_path)
+                stream_id = next(self.stream_ids)
+                # Before the header goes out, so no reply can arrive first
+                self.transfer_replies[stream_id] = queue.Queue()
+                streams = self.parallel_streams(file_size)
 
-                # Step 1: Send file header and get acknowledgment
-                file_header = f"FILE:{file_name}:{file_size}"
-                self.client_socket.send(file_header.encode())
+                # Step 1: Send file header and get acknowledgment; the transfer
+                # id lets the receiver recognise a partial copy from an earlier
+                # try, then come the codec and number of streams we would like.
+                # In binary form, so the name may hold any character
+                codec = self.codec if self.codec != compression.NONE or streams > 1 else ""
+                framing.send_control(self.client_socket, control.FILE, file_name, file_size,
+                                     resume.transfer_id(file_path), codec, streams if streams > 1 else 0,
+                                     stream_id=stream_id)
                 
                 # Wait for ACK from server before proceeding
                 ack_received = False
                 try:
-                    ack_data = self.client_socket.recv(4096).decode()
+                    ack_data = self.wait_transfer_reply(stream_id)
                     if ack_data == "ACK":
                         ack_received = True
                 except Exception as e:
@@ -196,43 +726,114 @@ class NetworkThread(QThread):
                 if not ack_received:
                     self.connection_status.emit("Did not receive ACK from server.")
                     return
-                
+
+                # The receiver answers too: ACK to start from the beginning, or
+                # RESUME:<offset>:<sha256> if it holds part of this transfer
+                offset = 0
+                try:
+                    reply = self.wait_transfer_reply(stream_id)
+                except Exception as e:
+                    self.connection_status.emit(f"Error waiting for receiver: {str(e)}")
+                    return
+                # A receiver that accepts our codec names it at the end of its reply
+                compressor = None
+                if self.codec != compression.NONE and reply.endswith(f":{self.codec}"):
+                    reply = reply[:-len(self.codec) - 1]
+                    compressor = compression.ChunkCompressor(self.codec, self.compress_level)
+                    self.connection_status.emit(f"Compressing '{file_name}' with {self.codec}")
+                if reply == "PARALLEL":
+                    self.send_parallel(file_path, file_size, stream_id, streams, compressor is not None)
+                    return
+                if reply.startswith("RESUME:"):
+                    _, offered, digest = reply.split(":")
+                    # Only resume if its bytes are really the start of our file
+                    if resume.verify_offer(file_path, int(offered), digest):
+                        offset = int(offered)
+                        self.connection_status.emit(f"Resuming '{file_name}' at {offset} of {file_size} bytes")
+                elif reply != "ACK":
+                    self.connection_status.emit(f"Receiver refused file: {reply}")
+                    return
+                framing.send_text(self.client_socket, f"RESUME_FROM:{offset}", stream_id)
+
                 # Update progress display
-                self.file_progress.emit(0, "Starting")
-                sent_bytes = 0
-
-                # Step 2: Send file in manageable chunks
-                with open(file_path, "rb") as f:
-                    # Use a larger chunk size for better performance
-                    chunk_size = 65000  # 64KB-ish chunks (with room for header)
-                    
-                    # Send the file in chunks
-                    while chunk := f.read(chunk_size):
-                        # Encrypt the chunk
-                        encrypted_chunk = self.simple_encrypt(chunk)
-                        
-                        # Prefix with FILECHUNK: marker
-                        chunk_with_marker = b'FILECHUNK:' + encrypted_chunk
-                        
-                        # Send the encrypted chunk
-                        self.client_socket.send(chunk_with_marker)
-                        
-                        # Wait for ACK after each chunk for better reliability
-                        try:
-                            ack = self.client_socket.recv(4096).decode()
-                            if ack != "ACK":
-                                self.connection_status.emit(f"Warning: Expected ACK, got: {ack}")
-                        except Exception as e:
-                            self.connection_status.emit(f"Error getting chunk ACK: {str(e)}")
-                        
-                        # Update progress
-                        sent_bytes += len(chunk)
-                        progress = int((sent_bytes / file_size) * 100)
-                        self.file_progress.emit(progress, f"Sending: {progress}%")
-                
-                # Step 3: Send EOF marker to signal end of transfer
-                self.client_socket.send(b"EOF")
-                    
+                self.file_progress.emit(int((offset / file_size) * 100) if file_size else 0, "Starting")
+                sent_bytes = offset
+
+                # Windowed mode keeps several chunks in flight and relies on
+                # the receiver's cumulative ACKs instead of one relay ACK per chunk
+                window = None
+                if self.window_size > 0:
+                    window = transfer.SendWindow(self.window_size, offset)
+                    self.send_windows[stream_id] = window
+
+                # Windowed chunks are corked into full segments and pushed
+                # whenever we wait; stop-and-wait waits after every chunk
+                profile = sockopts.BULK_CORKED if window is not None else sockopts.BULK
+                tuner = self.tuner
+                tuner.start(profile)
+                try:
+                    # Step 2: Send file in manageable chunks
+                    with open(file_path, "rb") as f:
+                        f.seek(offset)
+                        # Use a larger chunk size for better performance
+                        chunk_size = CHUNK_SIZE
+
+                        if window is not None:
+                            # Chunks come with the relay's cache answer; cached
+                            # ones are sent as a hash instead of the data
+                            chunks = self.cached_chunks(f, stream_id, chunk_size, compressor)
+                        else:
+                            chunks = self.read_chunks(f, chunk_size, compressor)
+
+                        # Send the file in chunks
+                        for encrypted_chunk, chunk_length, flags, ref in chunks:
+                            if window is not None:
+                                # Only block once the window is full; the window
+                                # counts payload bytes as the receiver gets
+                                # them, from us or from the relay's cache
+                                if not window.has_room(len(encrypted_chunk)):
+                                    tuner.push()
+                                window.wait_for_room(len(encrypted_chunk))
+                                window.sent(len(encrypted_chunk))
+                                if ref is not None:
+                                    framing.send_frame(self.client_socket, framing.CHUNKREF, ref,
+                                                       stream_id, flags | framing.FLAG_WINDOWED)
+                                else:
+                                    framing.send_frame(self.client_socket, framing.FILECHUNK, encrypted_chunk,
+                                                       stream_id, flags | framing.FLAG_WINDOWED)
+                            else:
+                                # Send the encrypted chunk in its own frame
+                                framing.send_frame(self.client_socket, framing.FILECHUNK, encrypted_chunk,
+                                                   stream_id, flags)
+
+                                # Wait for ACK after each chunk for better reliability
+                                try:
+                                    ack = self.wait_transfer_reply(stream_id)
+                                    if ack != "ACK":
+                                        self.connection_status.emit(f"Warning: Expected ACK, got: {ack}")
+                                except Exception as e:
+                                    self.connection_status.emit(f"Error getting chunk ACK: {str(e)}")
+
+                            # Update progress
+                            sent_bytes += chunk_length
+                            progress = int((sent_bytes / file_size) * 100)
+                            status = f"Sending: {progress}%"
+                            if compressor is not None:
+                                status += (f" ({compressor.compressed_bytes} bytes compressed"
+                                           f" from {compressor.original_bytes})")
+                            self.file_progress.emit(progress, status)
+
+                    # Step 3: Send EOF marker to signal end of transfer
+                    framing.send_frame(self.client_socket, framing.EOF, b"", stream_id)
+                    tuner.push()
+
+                    # Report success only once the receiver holds every byte
+                    if window is not None:
+                        window.wait_all_acked()
+                finally:
+                    self.send_windows.pop(stream_id, None)
+                    tuner.finish(profile)
+
                 self.connection_status.emit(f"File '{file_name}' sent successfully.")
                 self.file_progress.emit(100, "Complete")
             else:
@@ -240,23 +841,71 @@ class NetworkThread(QThread):
         except Exception as e:
             self.connection_status.emit(f"Error sending file: {str(e)}")
             self.file_progress.emit(0, "Failed")
+            # Only a lost connection is worth another try once it is back; a
+            # receiver that stalled (TimeoutError) or a transfer the relay
+            # gave up is not sent again behind the user's back
+            if self.auto_reconnect and isinstance(e, (ConnectionError, transfer.TransferDisconnected)):
+                if file_path not in self.interrupted_sends:
+                    self.interrupted_sends.append(file_path)
+        finally:
+            if stream_id is not None:
+                self.transfer_replies.pop(stream_id, None)
+
+    def queue_file(self, file_path):
+        """Sends a file on the sender thread, after those queued before it."""
+        self.send_queue.put(file_path)
+
+    def send_queued(self):
+        while (file_path := self.send_queue.get()) is not None:
+            self.send_file(file_path)
+
+    def resend_interrupted(self):
+        """Queues the files a disconnect interrupted to be sent again."""
+        paths, self.interrupted_sends = self.interrupted_sends, []
+        for path in paths:
+            self.queue_file(path)
+
+    def start_receiving_file(self, file_name, file_size, stream_id=0, transfer_id=None, codec=None, streams=1):
+        """Prepare to receive a file.
 
-    def start_receiving_file(self, file_name, file_size):
-        """Prepare to receive a file."""
+        With a ``transfer_id`` the file is received into ``<name>.part`` with
+        a manifest next to it; if a verified partial copy of the same
+        transfer is already there, the sender is offered to resume from it.
+        A ``codec`` offered by the sender is accepted if we support it.
+        Senders offering several ``streams`` are accepted with PARALLEL and
+        send byte ranges instead, which are not resumed.
+        """
         try:
             # Get Desktop path - works on Windows, Linux and macOS
             desktop = os.path.join(os.path.expanduser("~"), "Desktop")
             file_path = os.path.join(desktop, file_name)
 
+            # A new announcement replaces a transfer that never finished
+            if self.file_writer is not None:
+                self.file_writer.abort()
+                self.file_writer = None
+
             # Initialize file receiving variables
             self.receiving_file = True
             self.current_file_path = file_path
             self.current_file_size = file_size
             self.received_bytes = 0
+            self.received_wire_bytes = 0
+            self.receive_codec = codec if codec in compression.CODECS else None
+            accepted = f":{self.receive_codec}" if self.receive_codec is not None else ""
             
-            # Create the file and open it for writing
-            self.current_file = open(file_path, 'wb')
-            
+            self.parallel_stream_id = stream_id if streams > 1 else None
+            self.receive_ranges = None
+            self.expected_digest = None
+
+            # The file is opened once the sender says where it starts
+            self.receive_manifest = None
+            self.resume_hasher = None
+            offer = 0
+            if transfer_id and streams <= 1:
+                self.receive_manifest, self.resume_hasher = resume.find_resumable(file_path, transfer_id, file_size)
+                offer = self.receive_manifest.offset
+
             # Notify the user
             self.file_received.emit(f"Receiving file '{file_name}' ({file_size} bytes)...")
             self.file_progress.emit(0, "Started")
@@ -264,23 +913,136 @@ class NetworkThread(QThread):
             # Add debug message
             self.file_received.emit(f"File will be saved to: {file_path}")
             
-            # Send ACK to indicate we're ready to receive the file
-            self.client_socket.send("ACK".encode())
-            
+            # Send ACK to indicate we're ready to receive the file, or offer
+            # the part we already hold
+            if streams > 1:
+                framing.send_text(self.client_socket, f"PARALLEL{accepted}", stream_id)
+            elif offer:
+                self.file_received.emit(f"Found {offer} bytes of '{file_name}' from an earlier transfer")
+                framing.send_text(self.client_socket, f"RESUME:{offer}:{self.receive_manifest.digest}{accepted}",
+                                  stream_id)
+            else:
+                framing.send_text(self.client_socket, f"ACK{accepted}", stream_id)
+
         except Exception as e:
             self.file_received.emit(f"Error preparing to receive file: {str(e)}")
             self.receiving_file = False
             self.file_progress.emit(0, "Failed")
 
+    def start_parallel_file(self, ranges, stream_id):
+        """Opens the file for the byte ranges a parallel sender announced."""
+        try:
+            self.receive_ranges = transfer.ReceivedRanges(transfer.parse_ranges(ranges), self.current_file_size)
+            # Written out of order into <name>.part, renamed once verified
+            self.file_writer = filewriter.FileWriter(self.current_file_path + resume.PARTIAL_SUFFIX,
+                                                     self.current_file_size, self.durability)
+        except (OSError, ValueError) as e:
+            self.file_received.emit(f"Error preparing to receive file: {str(e)}")
+            framing.send_text(self.client_socket, f"ERROR: {str(e)}", stream_id)
+            self.receiving_file = False
+            self.receive_ranges = None
+            self.file_progress.emit(0, "Failed")
+            return
+        self.file_received.emit(f"Receiving in {len(self.receive_ranges)} parallel ranges")
+        framing.send_text(self.client_socket, "ACK", stream_id)
+
+    def finish_parallel_file(self):
+        """Completes a parallel transfer once every range and the sender's digest are in.
+
+        Syncing and re-reading the file to check it can take a while, so it
+        is done on a thread of its own; the sender is told VERIFIED or
+        VERIFY_FAILED.
+        """
+        if not self.receive_ranges.complete or self.expected_digest is None:
+            return
+        writer, self.file_writer = self.file_writer, None
+        verify = threading.Thread(
+            target=self.verify_parallel_file, name=f"verify-{os.path.basename(self.current_file_path)}",
+            args=(writer, self.current_file_path, self.current_file_size, self.expected_digest,
+                  self.parallel_stream_id),
+            daemon=True)
+
+        # Reset file receiving state
+        self.receiving_file = False
+        self.receive_ranges = None
+        self.expected_digest = None
+        self.parallel_stream_id = None
+        self.current_file_path = ""
+        self.current_file_size = 0
+        self.received_bytes = 0
+        verify.start()
+
+    def verify_parallel_file(self, writer, file_path, file_size, digest, stream_id):
+        try:
+            writer.close()
+            verified = resume.hash_prefix(writer.path, file_size).hexdigest() == digest
+            if verified:
+                os.replace(writer.path, file_path)
+            else:
+                os.remove(writer.path)
+        except (OSError, ValueError) as e:
+            self.file_received.emit(f"Error: could not save {file_path}: {str(e)}")
+            verified = False
+
+        if verified:
+            self.file_received.emit(f"File saved to {file_path} ({file_size} bytes, sha256 verified)")
+            self.file_progress.emit(100, "Complete")
+            framing.send_text(self.client_socket, "VERIFIED", stream_id)
+        else:
+            self.file_received.emit(f"Error: {file_path} does not match the sender's copy")
+            self.file_progress.emit(0, "Failed")
+            framing.send_text(self.client_socket, "VERIFY_FAILED", stream_id)
+
+    def open_file_writer(self, offset):
+        """Opens the file being received, appending at ``offset`` when resuming."""
+        manifest = self.receive_manifest
+        if manifest is None:
+            # Sender cannot resume; write the target directly
+            self.file_writer = filewriter.FileWriter(self.current_file_path, self.current_file_size, self.durability)
+            self.received_bytes = self.received_wire_bytes = 0
+            return
+
+        if offset == 0 or offset != manifest.offset:
+            # Starting over, e.g. the sender's file did not match our copy
+            offset = 0
+            self.resume_hasher = manifest.reset()
+        self.file_writer = filewriter.FileWriter(
+            manifest.partial_path, self.current_file_size, self.durability, offset=offset,
+            hasher=self.resume_hasher, on_sync=manifest.update)
+        # ACKs count payload bytes on from the resume offset
+        self.received_bytes = self.received_wire_bytes = offset
+        if offset and self.current_file_size > 0:
+            progress = min(99, int((offset / self.current_file_size) * 100))
+            self.file_progress.emit(progress, f"Resumed at {progress}%")
+
     def stop(self):
         self.running = False
+        self.stopped.set()
+        # The sender thread ends after the files already queued
+        self.send_queue.put(None)
         self.quit()
 
 
 # GUI Application
 class MessengerApp(QWidget):
-    def __init__(self):
+    def __init__(self, durability=filewriter.DEFAULT_DURABILITY, codec=compression.NONE, compress_level=None,
+                 streams=0, batch_updates=True, history_dir=history.DEFAULT_DIRECTORY):
         super().__init__()
+        self.durability = durability
+        self.codec = codec
+        self.compress_level = compress_level
+        self.streams = streams
+        # Every line shown is kept on disk, one log per peer
+        self.history_dir = history_dir
+        self.message_log = None
+
+        # Network updates are collected and applied once per frame, so a
+        # flood of chunks or messages cannot swamp the event loop
+        self.ui_updates = uibatch.UpdateBatcher() if batch_updates else None
+        if self.ui_updates is not None:
+            self.update_timer = QTimer(self)
+            self.update_timer.timeout.connect(self.flush_updates)
+            self.update_timer.start(1000 // uibatch.FRAME_RATE)
         self.setWindowTitle("Messenger App")
         self.setGeometry(100, 100, 500, 600)
 
@@ -290,12 +1052,14 @@ class MessengerApp(QWidget):
         self.status_label = QLabel("Status: Not connected")
         self.layout.addWidget(self.status_label)
         
-        # Message display area
-        self.message_display = QTextEdit()
-        self.message_display.setReadOnly(True)
+        # Message display area; rows are read from the history as they
+        # scroll into view
+        self.message_model = chatmodel.MessageListModel(parent=self)
+        self.message_display = chatmodel.MessageView(self.message_model)
         self.message_display.setFont(QFont("Courier New", 10))
         self.message_display.setMinimumHeight(300)
         self.layout.addWidget(self.message_display)
+        self.open_conversation(history.SERVER_CONVERSATION)
         
         # File transfer progress
         self.progress_label = QLabel("File Transfer:")
@@ -347,19 +1111,50 @@ class MessengerApp(QWidget):
             if hasattr(self, 'network_thread') and self.network_thread:
                 self.network_thread.stop()
             
-            self.network_thread = NetworkThread("127.0.0.1", 12345)
-            self.network_thread.update_message.connect(self.add_message)
-            self.network_thread.connection_status.connect(self.update_status)
-            self.network_thread.pair_request.connect(self.handle_pair_request)
-            self.network_thread.file_received.connect(self.add_message)
-            self.network_thread.file_progress.connect(self.update_progress)
+            self.attach_network_thread(NetworkThread("127.0.0.1", 12345, durability=self.durability,
+                                                     codec=self.codec, compress_level=self.compress_level,
+                                                     streams=self.streams))
             self.network_thread.start()
             
             self.update_status("Connecting to server...")
         except Exception as e:
             self.update_status(f"Connection error: {str(e)}")
 
+    def attach_network_thread(self, thread):
+        """Routes a network thread's signals to the display."""
+        self.network_thread = thread
+        # Pair requests open a dialog, so they stay queued to the GUI thread
+        thread.pair_request.connect(self.handle_pair_request)
+        if self.ui_updates is None:
+            thread.update_message.connect(self.add_message)
+            thread.connection_status.connect(self.update_status)
+            thread.file_received.connect(self.add_message)
+            thread.file_progress.connect(self.update_progress)
+            thread.debug_message.connect(lambda key, line: self.add_message(line))
+            return
+        # The batcher is thread-safe, so it is called straight from the
+        # network thread instead of through the event loop
+        direct = Qt.ConnectionType.DirectConnection
+        thread.update_message.connect(self.ui_updates.add_line, direct)
+        thread.connection_status.connect(self.ui_updates.set_status, direct)
+        thread.file_received.connect(self.ui_updates.add_line, direct)
+        thread.file_progress.connect(self.ui_updates.set_progress, direct)
+        thread.debug_message.connect(self.ui_updates.add_debug, direct)
+
+    def flush_updates(self):
+        """Applies what the network thread reported since the last frame."""
+        batch = self.ui_updates.drain()
+        if batch.status is not None:
+            self.status_label.setText(f"Status: {batch.status}")
+        if batch.progress is not None:
+            self.update_progress(*batch.progress)
+        if batch.lines:
+            self.show_lines(batch.lines)
+
     def update_status(self, status):
+        if self.ui_updates is not None:
+            self.ui_updates.set_status(status)
+            return
         self.status_label.setText(f"Status: {status}")
         # Also add to message display
         self.add_message(f"System: {status}")
@@ -371,14 +1166,35 @@ class MessengerApp(QWidget):
 
     def add_message(self, message):
         """Add a message to the text display area."""
-        self.message_display.append(message)
+        if self.ui_updates is not None:
+            # Shown with the next frame, in order with network updates
+            self.ui_updates.add_line(message)
+        else:
+            self.show_lines([message])
+
+    def show_lines(self, lines):
+        """Appends lines to the conversation's history and scrolls to the bottom."""
+        self.message_log.extend(lines)
+        self.message_model.refresh()
         # Auto-scroll to the bottom
-        scrollbar = self.message_display.verticalScrollBar()
-        scrollbar.setValue(scrollbar.maximum())
+        self.message_display.scrollToBottom()
+
+    def open_conversation(self, peer):
+        """Shows the history with ``peer``; new lines are added to it."""
+        if self.message_log is not None and self.message_log.peer == peer:
+            return
+        if self.message_log is not None and self.ui_updates is not None:
+            # Lines already reported belong to the conversation they came in
+            self.flush_updates()
+        old_log, self.message_log = self.message_log, history.MessageLog(self.history_dir, peer)
+        self.message_model.set_log(self.message_log)
+        self.message_display.scrollToBottom()
+        if old_log is not None:
+            old_log.close()
 
     def clear_messages(self):
-        """Clear all messages from the display area."""
-        self.message_display.clear()
+        """Clear all messages from the display area; the history keeps them."""
+        self.message_model.clear()
 
     def send_message(self):
         if not hasattr(self, 'network_thread') or not self.network_thread:
@@ -388,7 +1204,7 @@ class MessengerApp(QWidget):
             
         message = self.message_input.text().strip()
         if message:
-            self.network_thread.send_message(message)
+            self.network_thread.send_control(control.CHAT, message)
             # Add the sent message to our display
             self.add_message(f"You: {message}")
             self.message_input.clear()
@@ -403,7 +1219,8 @@ class MessengerApp(QWidget):
             
         ip, ok = QInputDialog.getText(self, 'Pair with Peer', 'Enter IP address of peer:')
         if ok:
-            self.network_thread.send_message(f"PAIR:{ip}")
+            self.open_conversation(ip)
+            self.network_thread.send_control(control.PAIR, ip)
             self.update_status(f"Pairing with {ip}...")
 
     def send_file(self):
@@ -415,22 +1232,49 @@ class MessengerApp(QWidget):
         file_path, _ = QFileDialog.getOpenFileName(self, "Select File to Send")
         if file_path:
             self.add_message(f"Sending file: {os.path.basename(file_path)}")
-            self.network_thread.send_file(file_path)
+            self.network_thread.queue_file(file_path)
 
     def handle_pair_request(self, sender_ip):
         reply = QMessageBox.question(self, "Pair Request", f"Accept pair request from {sender_ip}?", QMessageBox.StandardButton.Yes | QMessageBox.StandardButton.No)
         if reply == QMessageBox.StandardButton.Yes:
-            self.network_thread.send_message(f"PAIR_ACCEPT:{sender_ip}")
+            self.open_conversation(sender_ip)
+            self.network_thread.send_control(control.PAIR_ACCEPT, sender_ip)
         else:
-            self.network_thread.send_message(f"PAIR_REJECT:{sender_ip}")
+            self.network_thread.send_control(control.PAIR_REJECT, sender_ip)
 
     def closeEvent(self, event):
         if hasattr(self, 'network_thread') and self.network_thread:
             self.network_thread.stop()
+        if self.ui_updates is not None:
+            self.update_timer.stop()
+            self.flush_updates()
+        self.message_log.close()
 
 
 if __name__ == "__main__":
-    app = QApplication(sys.argv)
-    window = MessengerApp()
+    parser = argparse.ArgumentParser(description="Messenger client")
+    parser.add_argument("--fsync", choices=filewriter.DURABILITY_MODES, default=filewriter.DEFAULT_DURABILITY,
+                        help="when received files are synced to disk: every chunk, periodically or at EOF")
+    parser.add_argument("--compress", choices=(compression.NONE,) + compression.CODECS, default=compression.NONE,
+                        help="codec offered for sent files; used only if the receiver accepts it")
+    parser.add_argument("--compress-level", type=int,
+                        help="compression level (default depends on the codec)")
+    parser.add_argument("--streams", type=int, default=0,
+                        help="connections to split each sent file over (default: by file size, "
+                             f"one per {transfer.MIN_RANGE // (1024 * 1024)} MiB up to {transfer.MAX_STREAMS})")
+    parser.add_argument("--history-dir", default=history.DEFAULT_DIRECTORY,
+                        help="where conversations are kept")
+    # Anything else is left for Qt
+    args, qt_args = parser.parse_known_args()
+    if args.streams < 0:
+        parser.error("--streams must not be negative")
+    if args.compress != compression.NONE:
+        try:
+            compression.ChunkCompressor(args.compress, args.compress_level)
+        except ValueError as e:
+            parser.error(str(e))
+    app = QApplication(sys.argv[:1] + qt_args)
+    window = MessengerApp(args.fsync, args.compress, args.compress_level, args.streams,
+                          history_dir=args.history_dir)
     window.show()
     sys.exit(app.exec())
\ No newline at end of file
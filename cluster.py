@@ -0,0 +1,408 @@
+import json
+import multiprocessing
+import os
+import shutil
+import signal
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+import backpressure
+import framing
+import relay
+import server6
+from client_index import ClientIndex
+
+# Frame types used between workers; clients never see them
+LINK_DELIVER = 16  # Address line, then a complete client frame to write to that client
+LINK_PAIRED = 17   # JSON [local address, remote address, remote worker]
+LINK_GONE = 18     # JSON address of a client that disconnected from its worker
+
+# A delivered frame carries a full client frame plus the address line
+LINK_MAX_PAYLOAD = framing.MAX_PAYLOAD + framing.HEADER_SIZE + 256
+
+
+def encode_address(address):
+    return f"{address[0]}|{address[1]}".encode("ascii")
+
+
+def decode_address(data):
+    ip, port = bytes(data).decode("ascii").rsplit("|", 1)
+    return ip, int(port)
+
+
+def send_json(sock, frame_type, value, stream_id=0):
+    framing.send_frame(sock, frame_type, json.dumps(value).encode("utf-8"), stream_id)
+
+
+def load_json(frame):
+    return json.loads(bytes(frame.payload))
+
+
+class Coordinator:
+    """Pairing lookups shared by every worker, served from the parent process.
+
+    Workers register and unregister the clients they accept and ask here
+    which client (and which worker) an IP resolves to. Requests and replies
+    are JSON in TEXT frames over a unix socket; each worker keeps one
+    connection open, and everything it registered is dropped if that
+    connection goes away.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.index = ClientIndex()
+        # address -> id of the worker holding its connection
+        self.owners = {}
+        self._lock = threading.Lock()
+        self._listener = None
+
+    def listen(self):
+        """Binds the socket; done before forking so workers can connect at once."""
+        self._listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._listener.bind(self.path)
+        self._listener.listen(64)
+
+    def serve_forever(self):
+        while True:
+            conn, _ = self._listener.accept()
+            threading.Thread(target=self._serve, args=(conn,), daemon=True).start()
+
+    def _serve(self, conn):
+        decoder = framing.FrameDecoder()
+        worker = None
+        try:
+            while decoder.recv_from(conn):
+                for frame in decoder.frames():
+                    op, worker, *args = load_json(frame)
+                    send_json(conn, framing.TEXT, self.handle(op, worker, *args), frame.stream_id)
+        except (OSError, ValueError, framing.ProtocolError) as e:
+            server6.log.error(f"[-] Coordinator connection error: {e}")
+        finally:
+            conn.close()
+            if worker is not None:
+                self.drop_worker(worker)
+
+    def handle(self, op, worker, *args):
+        """Applies one request from ``worker`` and returns the reply."""
+        if op == "register":
+            address, keys = tuple(args[0]), args[1]
+            with self._lock:
+                self.owners[address] = worker
+            self.index.add(address, *keys)
+            return True
+        if op == "unregister":
+            address = tuple(args[0])
+            self.index.remove(address)
+            with self._lock:
+                self.owners.pop(address, None)
+            return True
+        if op == "lookup":
+            key, exclude = args[0], args[1] and tuple(args[1])
+            address = self.index.lookup(key, exclude=exclude)
+            if address is None:
+                return None
+            with self._lock:
+                owner = self.owners.get(address)
+            return None if owner is None else [address, owner]
+        if op == "lookup_all":
+            return self.index.lookup_all(args[0])
+        raise ValueError(f"Unknown coordinator request {op!r}")
+
+    def drop_worker(self, worker):
+        """Forgets every client of a worker that exited."""
+        with self._lock:
+            gone = [address for address, owner in self.owners.items() if owner == worker]
+            for address in gone:
+                del self.owners[address]
+        for address in gone:
+            self.index.remove(address)
+        if gone:
+            server6.log.error(f"[-] Worker {worker} went away, dropped {len(gone)} clients")
+
+
+class CoordinatorClient:
+    """One worker's connection to the coordinator; calls are serialized."""
+
+    def __init__(self, path, worker_id):
+        self.worker_id = worker_id
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(path)
+        self._decoder = framing.FrameDecoder()
+        self._lock = threading.Lock()
+
+    def call(self, op, *args):
+        with self._lock:
+            send_json(self.sock, framing.TEXT, [op, self.worker_id, *args])
+            while (frame := self._decoder.next_frame()) is None:
+                if not self._decoder.recv_from(self.sock):
+                    raise ConnectionError("Cluster coordinator went away")
+            return load_json(frame)
+
+
+class ClusterIndex:
+    """Drop-in for ``server6.client_index`` that resolves across all workers.
+
+    Only clients connected to this worker are registered with the
+    coordinator; lookups may return clients of other workers, whose owner
+    is remembered so ``Worker.attach`` can reach them.
+    """
+
+    def __init__(self, coordinator):
+        self.coordinator = coordinator
+        # Addresses connected to this worker
+        self.local = set()
+        # Remote address -> worker id, learned from lookups and pairings
+        self.owners = {}
+
+    def add(self, address, *keys):
+        self.local.add(address)
+        self.coordinator.call("register", address, keys)
+
+    def remove(self, address):
+        self.owners.pop(address, None)
+        if address in self.local:
+            self.local.discard(address)
+            self.coordinator.call("unregister", address)
+
+    def lookup(self, key, exclude=None):
+        reply = self.coordinator.call("lookup", key, exclude)
+        if reply is None:
+            return None
+        address, owner = tuple(reply[0]), reply[1]
+        if address not in self.local:
+            self.owners[address] = owner
+        return address
+
+    def lookup_all(self, key):
+        return [tuple(address) for address in self.coordinator.call("lookup_all", key)]
+
+    def owner(self, address):
+        return self.owners.get(address)
+
+    def __len__(self):
+        return len(self.local)
+
+
+class RemoteClient:
+    """Stands in ``server6.clients`` for a client connected to another worker.
+
+    Whatever the relay writes to it is wrapped in a LINK_DELIVER frame and
+    written to that worker, which passes the bytes on unchanged.
+    """
+
+    def __init__(self, link, address):
+        self.link = link
+        self.address = address
+        self._prefix = encode_address(address) + b"\n"
+
+    def sendall(self, data):
+        self.sendall_buffers((data,))
+
+    def sendall_buffers(self, buffers):
+        length = len(self._prefix) + sum(len(buf) for buf in buffers)
+        header = framing.encode_header(LINK_DELIVER, length)
+        framing.sendall_buffers(self.link, (header, self._prefix, *buffers))
+
+
+class Worker:
+    """Cluster hooks for one server6 worker process (``server6.cluster``).
+
+    Listens on a unix socket of its own for frames from other workers and
+    connects to theirs lazily, the first time one of its clients pairs with
+    a client over there.
+    """
+
+    def __init__(self, worker_id, run_dir):
+        self.worker_id = worker_id
+        self.run_dir = run_dir
+        self.coordinator = CoordinatorClient(os.path.join(run_dir, "coordinator.sock"), worker_id)
+        self.index = ClusterIndex(self.coordinator)
+        # worker id -> LockedSocket to it
+        self.links = {}
+        self._links_lock = threading.Lock()
+        # Remote addresses with a RemoteClient in server6.clients
+        self.proxies = set()
+
+    def link_path(self, worker_id):
+        return os.path.join(self.run_dir, f"worker-{worker_id}.sock")
+
+    def start(self):
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        listener.bind(self.link_path(self.worker_id))
+        listener.listen(64)
+        threading.Thread(target=self._accept_links, args=(listener,), daemon=True).start()
+
+    def link(self, worker_id):
+        """Returns the connection to ``worker_id``, opening it on first use."""
+        with self._links_lock:
+            link = self.links.get(worker_id)
+            if link is None:
+                sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                sock.connect(self.link_path(worker_id))
+                link = self.links[worker_id] = framing.LockedSocket(sock)
+            return link
+
+    # Hooks called by server6
+
+    def attach(self, address):
+        """Makes a client of another worker reachable through ``server6.clients``."""
+        owner = self.index.owner(address)
+        if owner is None or owner == self.worker_id:
+            return
+        # Proxies from lookups that never led to a pairing are not needed any more
+        for stale in [a for a in self.proxies if a not in server6.paired_clients]:
+            self._drop_proxy(stale)
+        server6.clients[address] = RemoteClient(self.link(owner), address)
+        self.proxies.add(address)
+
+    def paired(self, address, client_addr):
+        """Tells the worker holding ``client_addr`` that it is now paired with ``address``."""
+        owner = self.index.owner(client_addr)
+        if client_addr in self.proxies and owner is not None:
+            send_json(self.link(owner), LINK_PAIRED, [client_addr, address, self.worker_id])
+
+    def client_gone(self, address):
+        """Tells the worker of a remote peer that local client ``address`` disconnected."""
+        if address not in self.index.local:
+            return
+        peer = server6.paired_clients.get(address)
+        if peer not in self.proxies:
+            return
+        owner = self.index.owner(peer)
+        try:
+            if owner is not None:
+                send_json(self.link(owner), LINK_GONE, address)
+        except OSError as e:
+            server6.log.error(f"[-] Could not notify worker {owner} about {address}: {e}")
+        self._drop_proxy(peer)
+
+    def _drop_proxy(self, address):
+        self.proxies.discard(address)
+        server6.clients.pop(address, None)
+        server6.flow_controls.pop(address, None)
+        server6.connection_bytes.remove(address)
+        self.index.owners.pop(address, None)
+
+    # Frames from other workers
+
+    def _accept_links(self, listener):
+        while True:
+            conn, _ = listener.accept()
+            threading.Thread(target=self._serve_link, args=(conn,), daemon=True).start()
+
+    def _serve_link(self, conn):
+        decoder = framing.FrameDecoder(max_payload=LINK_MAX_PAYLOAD)
+        try:
+            while decoder.recv_from(conn):
+                for frame in decoder.frames():
+                    self.handle_link_frame(frame)
+        except (OSError, framing.ProtocolError) as e:
+            server6.log.error(f"[-] Worker link error: {e}")
+        finally:
+            conn.close()
+
+    def handle_link_frame(self, frame):
+        if frame.type == LINK_DELIVER:
+            split = bytes(frame.payload[:256]).index(b"\n")
+            target = decode_address(frame.payload[:split])
+            data = frame.payload[split + 1:]
+            connection = server6.clients.get(target)
+            if connection is None or target not in self.index.local:
+                return
+            try:
+                connection.sendall(data)
+            except OSError as e:
+                server6.log.error(f"[-] Error delivering to {target}: {e}")
+                return
+            # A receiver's ACK releases the sender's in-flight bytes here,
+            # on the worker that reads from the sender
+            _, _, frame_type, _, stream_id, _ = framing.HEADER.unpack_from(data)
+            if frame_type == framing.ACK:
+                offset = framing.ACK_PAYLOAD.unpack_from(data, framing.HEADER_SIZE)[0]
+                flow = server6.get_flow(target)
+                if flow.acked(stream_id, offset):
+                    server6.resume_sender(target, flow)
+
+        elif frame.type == LINK_PAIRED:
+            local, remote, owner = load_json(frame)
+            local, remote = tuple(local), tuple(remote)
+            if local not in server6.clients:
+                return
+            self.index.owners[remote] = owner
+            server6.clients[remote] = RemoteClient(self.link(owner), remote)
+            self.proxies.add(remote)
+            server6.paired_clients[local] = remote
+            server6.paired_clients[remote] = local
+            server6.release_flow(local)
+            server6.log.info(f"[+] {local} paired with {remote} on worker {owner}")
+
+        elif frame.type == LINK_GONE:
+            address = tuple(load_json(frame))
+            if address in self.proxies:
+                server6.remove_client(address)
+                self._drop_proxy(address)
+
+
+def exit_with_parent(parent_pid, interval=1.0):
+    """Stops a worker whose parent died without terminating it (e.g. SIGKILL)."""
+    while os.getppid() == parent_pid:
+        time.sleep(interval)
+    os._exit(1)
+
+
+def run_worker(worker_id, run_dir, host, port, splice, in_flight, metrics_file=None, metrics_interval=10.0):
+    """Entry point of a forked worker: a threaded server6 sharing the port."""
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    threading.Thread(target=exit_with_parent, args=(os.getppid(),), daemon=True).start()
+    server6.max_in_flight = in_flight
+    worker = Worker(worker_id, run_dir)
+    server6.client_index = worker.index
+    server6.cluster = worker
+    if server6.chunk_cache is not None:
+        # Each worker evicts on its own, so they must not share files
+        server6.chunk_cache = server6.chunk_cache.for_worker(worker_id)
+    worker.start()
+    if metrics_file:
+        # One snapshot per worker, e.g. relay.prom -> relay-worker0.prom
+        root, ext = os.path.splitext(metrics_file)
+        server6.registry.export_every(f"{root}-worker{worker_id}{ext}", metrics_interval)
+    server6.start_threaded_server(host, port, splice, reuse_port=True)
+
+
+def start_cluster(host="0.0.0.0", port=12345, workers=2, splice=relay.SPLICE_AVAILABLE,
+                  in_flight=backpressure.DEFAULT_MAX_IN_FLIGHT, metrics_file=None, metrics_interval=10.0):
+    """Forks ``workers`` threaded servers on one port and coordinates their pairing.
+
+    The kernel spreads incoming connections over the workers with
+    SO_REUSEPORT. Clients paired on the same worker relay exactly as in a
+    single process; pairs split across workers relay through a unix socket
+    between the two workers.
+    """
+    run_dir = tempfile.mkdtemp(prefix="server6-cluster-")
+    coordinator = Coordinator(os.path.join(run_dir, "coordinator.sock"))
+    coordinator.listen()
+
+    # Workers are stopped with the parent, however it is stopped
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    context = multiprocessing.get_context("fork")
+    processes = [
+        context.Process(target=run_worker,
+                        args=(worker_id, run_dir, host, port, splice, in_flight, metrics_file, metrics_interval),
+                        name=f"server6-worker-{worker_id}", daemon=True)
+        for worker_id in range(workers)
+    ]
+    for process in processes:
+        process.start()
+    server6.log.info(f"[*] Started {workers} workers on {host}:{port}")
+
+    try:
+        coordinator.serve_forever()
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.join()
+        shutil.rmtree(run_dir, ignore_errors=True)
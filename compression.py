@@ -0,0 +1,93 @@
+import bz2
+import lzma
+import zlib
+
+# Codec names as offered in the FILE header; NONE means chunks are sent as is
+NONE = "none"
+ZLIB = "zlib"
+LZMA = "lzma"
+BZ2 = "bz2"
+CODECS = (ZLIB, LZMA, BZ2)
+
+# Level used when none is given, and the valid range, per codec
+DEFAULT_LEVELS = {ZLIB: 6, LZMA: 6, BZ2: 9}
+LEVEL_RANGES = {ZLIB: range(0, 10), LZMA: range(0, 10), BZ2: range(1, 10)}
+
+# Each chunk's compressibility is estimated from this many leading bytes
+SAMPLE_SIZE = 4096
+# A chunk is only sent compressed if it shrinks to at most this fraction
+MAX_RATIO = 0.9
+
+
+def _compress(codec, data, level):
+    if codec == ZLIB:
+        return zlib.compress(data, level)
+    if codec == LZMA:
+        return lzma.compress(data, preset=level)
+    return bz2.compress(data, compresslevel=level)
+
+
+def _decompressor(codec):
+    if codec == ZLIB:
+        return zlib.decompressobj()
+    if codec == LZMA:
+        return lzma.LZMADecompressor()
+    return bz2.BZ2Decompressor()
+
+
+class ChunkCompressor:
+    """Compresses file chunks one at a time for a transfer.
+
+    Every chunk is compressed on its own, so it can still be decrypted,
+    acknowledged, cached and resumed from independently of the others.
+    Before spending ``codec``'s full effort on a chunk, its first
+    SAMPLE_SIZE bytes go through zlib's fastest level; chunks that do not
+    look compressible (already compressed media, archives, random data) are
+    sent as they are, and so are chunks the codec fails to shrink below
+    MAX_RATIO.
+
+    ``original_bytes`` and ``compressed_bytes`` count what went in and what
+    is put on the wire.
+    """
+
+    def __init__(self, codec, level=None):
+        if codec not in CODECS:
+            raise ValueError(f"Unknown codec {codec!r}, expected one of {CODECS}")
+        if level is None:
+            level = DEFAULT_LEVELS[codec]
+        if level not in LEVEL_RANGES[codec]:
+            raise ValueError(f"Level {level} is out of range for {codec}")
+        self.codec = codec
+        self.level = level
+        self.original_bytes = 0
+        self.compressed_bytes = 0
+
+    def compress(self, chunk):
+        """Returns ``(data, compressed)``: the bytes to send and whether they are compressed."""
+        self.original_bytes += len(chunk)
+        data, compressed = chunk, False
+        sample = chunk[:SAMPLE_SIZE]
+        if sample and len(zlib.compress(sample, 1)) <= len(sample) * MAX_RATIO:
+            packed = _compress(self.codec, chunk, self.level)
+            if len(packed) <= len(chunk) * MAX_RATIO:
+                data, compressed = packed, True
+        self.compressed_bytes += len(data)
+        return data, compressed
+
+
+def decompress(codec, data, max_length):
+    """Returns the chunk compressed in ``data``.
+
+    Raises ValueError if it is corrupt or would expand beyond ``max_length``
+    bytes, so a hostile sender cannot make the receiver inflate a bomb.
+    """
+    if codec not in CODECS:
+        raise ValueError(f"Unknown codec {codec!r}")
+    decompressor = _decompressor(codec)
+    try:
+        chunk = decompressor.decompress(data, max_length)
+    except (zlib.error, lzma.LZMAError, OSError) as e:
+        raise ValueError(f"Corrupt {codec} chunk: {e}") from None
+    if not decompressor.eof or decompressor.unused_data or getattr(decompressor, "unconsumed_tail", b""):
+        raise ValueError(f"{codec} chunk is truncated or larger than {max_length} bytes")
+    return chunk
@@ -0,0 +1,229 @@
+from collections import namedtuple
+
+# Control messages in binary form: a kind code, then the kind's fields in
+# the order of its schema. Numbers and string lengths are varints (7 bits
+# per byte, low bits first), so short strings and small numbers take one
+# byte of overhead, and strings may hold any character, colons included.
+# In server6's protocol a message is the payload of a CONTROL frame; on
+# the raw sockets of server3 it is prefixed with MAGIC, a byte that never
+# starts UTF-8 text.
+MAGIC = b"\xc1"
+
+# Field types
+STR = "str"  # UTF-8 text
+INT = "int"  # Unsigned integer
+
+# Builds a message from a tuple of values, skipping namedtuple's own checks
+_new = tuple.__new__
+
+
+class ControlError(ValueError):
+    """Raised for a control message that does not match its schema."""
+
+
+class Kind:
+    """One kind of control message: its name (the text prefix), code and fields.
+
+    ``fields`` is a sequence of ``(name, type)`` pairs. Decoded messages
+    are instances of ``message``, a namedtuple of the fields whose ``kind``
+    is this Kind. Text forms put the fields after the name, each after a
+    colon; the first ``required`` (by default all) must be there, those
+    missing at the end are empty (0 for numbers), and the last one takes
+    the rest of the text.
+    """
+
+    __slots__ = ("name", "code", "fields", "required", "strings", "defaults", "message", "empty")
+
+    def __init__(self, name, code, fields=(), required=None):
+        self.name = name
+        self.code = code
+        self.fields = tuple(fields)
+        self.required = len(self.fields) if required is None else required
+        # Per field, whether it is a string rather than a number
+        self.strings = tuple(field_type == STR for _, field_type in self.fields)
+        self.defaults = tuple("" if string else 0 for string in self.strings)
+        self.message = namedtuple(name, [field for field, _ in self.fields])
+        self.message.kind = self
+        # Shared by every message of the kind with all fields empty, e.g. every PING
+        self.empty = _new(self.message, self.defaults)
+
+    def __call__(self, *values):
+        """Returns a message of this kind; missing trailing fields are empty."""
+        return _new(self.message, values + self.defaults[len(values):])
+
+    def __repr__(self):
+        return f"Kind({self.name})"
+
+
+# The schema. Codes are part of the wire format: never reuse or renumber one
+PAIR = Kind("PAIR", 1, [("ip", STR)])
+PAIR_REQUEST = Kind("PAIR_REQUEST", 2, [("ip", STR)])
+PAIR_ACCEPT = Kind("PAIR_ACCEPT", 3, [("ip", STR)])
+PAIR_REJECT = Kind("PAIR_REJECT", 4, [("ip", STR)])
+PAIR_SUCCESS = Kind("PAIR_SUCCESS", 5)
+PAIR_FAILED = Kind("PAIR_FAILED", 6)
+# transfer_id and codec are empty and streams 0 when the sender offers none
+FILE = Kind("FILE", 7, [("name", STR), ("size", INT), ("transfer_id", STR), ("codec", STR), ("streams", INT)],
+            required=2)
+# Chat relayed to the peer; CHAT is what a client sends, which in text form
+# is any text that is not another message
+MSG = Kind("MSG", 8, [("text", STR)])
+CHAT = Kind("CHAT", 9, [("text", STR)])
+# server3's chat, answered by the server itself
+MESSAGE = Kind("MESSAGE", 10, [("text", STR)])
+PING = Kind("PING", 11)
+PONG = Kind("PONG", 12)
+SESSION = Kind("SESSION", 13, [("token", STR)])
+SESSION_RESUMED = Kind("SESSION_RESUMED", 14)
+SESSION_WAIT = Kind("SESSION_WAIT", 15)
+SESSION_FAILED = Kind("SESSION_FAILED", 16)
+RESUME_SESSION = Kind("RESUME_SESSION", 17, [("token", STR)])
+PEER_DISCONNECTED = Kind("PEER_DISCONNECTED", 18)
+# A request when the token is empty, the server's answer otherwise
+JOIN_TOKEN = Kind("JOIN_TOKEN", 19, [("token", STR)], required=0)
+JOIN = Kind("JOIN", 20, [("token", STR)])
+
+KINDS = (PAIR, PAIR_REQUEST, PAIR_ACCEPT, PAIR_REJECT, PAIR_SUCCESS, PAIR_FAILED, FILE, MSG, CHAT, MESSAGE,
+         PING, PONG, SESSION, SESSION_RESUMED, SESSION_WAIT, SESSION_FAILED, RESUME_SESSION,
+         PEER_DISCONNECTED, JOIN_TOKEN, JOIN)
+BY_CODE = {kind.code: kind for kind in KINDS}
+# CHAT has no text form of its own
+BY_NAME = {kind.name: kind for kind in KINDS if kind is not CHAT}
+
+
+def _varint(value):
+    if 0 <= value < 0x80:
+        return bytes((value,))
+    if value < 0:
+        raise ControlError(f"Cannot encode negative number {value}")
+    out = bytearray()
+    while value >= 0x80:
+        out.append(value & 0x7F | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+
+def _read_varint(data, offset):
+    """Returns the varint at ``offset`` of ``data`` and the offset after it."""
+    value = shift = 0
+    while True:
+        byte = data[offset]
+        offset += 1
+        value |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return value, offset
+        shift += 7
+
+
+def encode(kind, *values):
+    """Returns the binary form of a ``kind`` message; missing trailing fields are empty."""
+    if len(values) > len(kind.fields):
+        raise ControlError(f"{kind.name} has {len(kind.fields)} fields, got {len(values)}")
+    values += kind.defaults[len(values):]
+    parts = [bytes((kind.code,))]
+    for string, value in zip(kind.strings, values):
+        if string:
+            data = value.encode("utf-8")
+            parts.append(_varint(len(data)))
+            parts.append(data)
+        else:
+            parts.append(_varint(value))
+    return b"".join(parts)
+
+
+def decode(data, offset=0):
+    """Decodes the binary message at ``offset`` of ``data``; returns ``(message, end offset)``.
+
+    Whatever follows the message in ``data`` is left alone, so it may be
+    followed by e.g. the start of a file.
+    """
+    if type(data) is not bytes:
+        data = bytes(data)
+    try:
+        kind = BY_CODE.get(data[offset])
+        if kind is None:
+            raise ControlError(f"Unknown control message code {data[offset]}")
+        offset += 1
+        if not kind.strings:
+            return kind.empty, offset
+        values = []
+        for string in kind.strings:
+            # Most numbers and lengths fit the first byte
+            value = data[offset]
+            if value < 0x80:
+                offset += 1
+            else:
+                value, offset = _read_varint(data, offset)
+            if string:
+                end = offset + value
+                if end > len(data):
+                    raise ControlError(f"{kind.name}.{kind.fields[len(values)][0]} runs past the end of the message")
+                value = data[offset:end].decode("utf-8")
+                offset = end
+            values.append(value)
+    except IndexError:
+        raise ControlError("Control message is truncated") from None
+    except UnicodeDecodeError:
+        raise ControlError("Control message holds text that is not UTF-8") from None
+    return _new(kind.message, values), offset
+
+
+def _parse_fields(kind, rest):
+    """Returns the ``kind`` message whose text form has ``rest`` after the name, or None if it does not fit."""
+    if not kind.fields:
+        return None
+    if len(kind.fields) == 1 and kind.strings[0]:
+        return _new(kind.message, (rest,))
+    parts = rest.split(":", len(kind.fields) - 1)
+    if len(parts) < kind.required:
+        return None
+    try:
+        values = [part if string else int(part) for string, part in zip(kind.strings, parts)]
+    except ValueError:
+        return None
+    return _new(kind.message, (*values, *kind.defaults[len(values):]))
+
+
+def parse_text(text, default=None, kinds=None):
+    """Parses the colon-separated text form of a message, e.g. ``PAIR:10.0.0.2``.
+
+    Only a message of ``kinds`` (by default any) in exactly its text form
+    counts: ``PING`` is one, but ``PING:x``, or ``FILE:notes`` without a
+    size, is not. Anything else is returned as a ``default`` message
+    holding all of the text (e.g. CHAT), or as None.
+    """
+    name, colon, rest = text.partition(":")
+    kind = BY_NAME.get(name)
+    message = None
+    if kind is not None and (kinds is None or kind in kinds):
+        if colon:
+            message = _parse_fields(kind, rest)
+        elif not kind.required:
+            message = kind.empty
+    if message is None and default is not None:
+        message = _new(default.message, (text,))
+    return message
+
+
+def format_text(kind, *values):
+    """Returns the text form of a message, for peers that only speak text."""
+    values += kind.defaults[len(values):]
+    # Trailing empty fields are left out, as older peers expect
+    while values and not values[-1]:
+        values = values[:-1]
+    if kind is CHAT:
+        return values[0] if values else ""
+    return ":".join((kind.name,) + tuple(str(value) for value in values))
+
+
+def dispatch(handlers, message, *args):
+    """Calls the handler of ``message.kind`` from ``handlers`` with ``*args, message``.
+
+    Returns False if there is none.
+    """
+    handler = handlers.get(message.kind)
+    if handler is None:
+        return False
+    handler(*args, message)
+    return True
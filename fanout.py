@@ -0,0 +1,158 @@
+import socket
+import struct
+import tempfile
+import threading
+from collections import deque
+
+# What to do when a client's outbound queue is full
+DROP = "drop"              # Discard the new message for that client only
+DISCONNECT = "disconnect"  # Close the slow client
+SPILL = "spill"            # Queue the overflow in a temporary file on disk
+POLICIES = (DROP, DISCONNECT, SPILL)
+
+DEFAULT_MAX_BYTES = 1024 * 1024
+# Queued messages a writer sends with one sendall, up to about this many bytes
+BATCH_BYTES = 64 * 1024
+
+# Length prefix of each message in a spill file
+_SPILL_RECORD = struct.Struct("!I")
+
+
+class Outbox:
+    """Bounded outbound queue for one connection, drained by its own writer thread.
+
+    Senders only append a reference to an already-encoded message, so a slow
+    receiver never blocks anyone else; the writer thread does the blocking
+    ``sendall``, of everything queued meanwhile (up to BATCH_BYTES) at once,
+    so a burst of small messages costs one write. When more than
+    ``max_bytes`` are waiting, ``policy`` decides
+    whether the message is dropped, the client disconnected, or the overflow
+    spilled to disk (and replayed in order once the socket catches up).
+    """
+
+    def __init__(self, sock, name, max_bytes=DEFAULT_MAX_BYTES, policy=DROP, spill_dir=None):
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown slow-consumer policy {policy!r}, expected one of {POLICIES}")
+        self.sock = sock
+        self.name = name
+        self.max_bytes = max_bytes
+        self.policy = policy
+        self.spill_dir = spill_dir
+
+        self.queued_bytes = 0
+        self.dropped = 0
+        self.spilled = 0
+        self.closed = False
+
+        self._queue = deque()
+        self._cond = threading.Condition()
+        # Spill file and its unread record count, while overflowing to disk
+        self._spill = None
+        self._spill_pending = 0
+        self._spill_read_pos = 0
+
+        self._thread = threading.Thread(target=self._run, name=f"writer-{name}", daemon=True)
+        self._thread.start()
+
+    def put(self, data):
+        """Queues ``data`` for sending; returns False if it was not accepted."""
+        with self._cond:
+            if self.closed:
+                return False
+            # Once spilling, everything goes to disk so order is kept
+            if self._spill is None and self.queued_bytes + len(data) <= self.max_bytes:
+                self._queue.append(data)
+                self.queued_bytes += len(data)
+                self._cond.notify()
+                return True
+
+            if self.policy == DROP:
+                self.dropped += 1
+                return False
+            if self.policy == DISCONNECT:
+                print(f"[!] Disconnecting slow client {self.name} ({self.queued_bytes} bytes queued)")
+                self._close_locked()
+                return False
+
+            self._spill_write(data)
+            self._cond.notify()
+            return True
+
+    def _spill_write(self, data):
+        if self._spill is None:
+            self._spill = tempfile.TemporaryFile(dir=self.spill_dir)
+            self._spill_read_pos = 0
+        self._spill.seek(0, 2)
+        self._spill.write(_SPILL_RECORD.pack(len(data)))
+        self._spill.write(data)
+        self._spill_pending += 1
+        self.spilled += 1
+
+    def _spill_read(self):
+        """Returns the oldest spilled message, dropping the file once it is empty."""
+        self._spill.seek(self._spill_read_pos)
+        (length,) = _SPILL_RECORD.unpack(self._spill.read(_SPILL_RECORD.size))
+        data = self._spill.read(length)
+        self._spill_read_pos = self._spill.tell()
+        self._spill_pending -= 1
+        if not self._spill_pending:
+            self._spill.close()
+            self._spill = None
+        return data
+
+    def _next(self):
+        """Blocks for the next messages to send, joined into one buffer; None once closed."""
+        with self._cond:
+            while not self.closed:
+                if self._queue:
+                    batch = [self._queue.popleft()]
+                    size = len(batch[0])
+                    while self._queue and size + len(self._queue[0]) <= BATCH_BYTES:
+                        batch.append(self._queue.popleft())
+                        size += len(batch[-1])
+                    self.queued_bytes -= size
+                    return batch[0] if len(batch) == 1 else b"".join(batch)
+                if self._spill is not None:
+                    return self._spill_read()
+                self._cond.wait()
+            return None
+
+    def _run(self):
+        while (data := self._next()) is not None:
+            try:
+                self.sock.sendall(data)
+            except OSError:
+                self.close()
+
+    def _close_locked(self):
+        if self.closed:
+            return
+        self.closed = True
+        self._queue.clear()
+        self.queued_bytes = 0
+        if self._spill is not None:
+            self._spill.close()
+            self._spill = None
+        self._cond.notify_all()
+        try:
+            # Wakes the connection's reader so it cleans up too
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def close(self):
+        """Stops the writer and discards anything still queued."""
+        with self._cond:
+            self._close_locked()
+
+
+def broadcast(outboxes, data, exclude=None):
+    """Queues one already-encoded message on every outbox except ``exclude``.
+
+    The same bytes object is shared by all queues; returns how many accepted it.
+    """
+    accepted = 0
+    for outbox in list(outboxes):
+        if outbox is not exclude and outbox.put(data):
+            accepted += 1
+    return accepted
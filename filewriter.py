@@ -0,0 +1,448 @@
+import errno
+import os
+import queue
+import threading
+import time
+from collections import deque
+
+# When received data is forced to disk
+FSYNC_CHUNK = "chunk"        # After every chunk: slowest, loses nothing on a crash
+FSYNC_PERIODIC = "periodic"  # At most every sync_interval seconds, and at EOF
+FSYNC_EOF = "eof"            # Once, when the transfer completes
+DURABILITY_MODES = (FSYNC_CHUNK, FSYNC_PERIODIC, FSYNC_EOF)
+
+DEFAULT_DURABILITY = FSYNC_PERIODIC
+DEFAULT_SYNC_INTERVAL = 1.0
+# Received bytes held in memory before the network thread waits for the disk
+DEFAULT_MAX_QUEUED = 16 * 1024 * 1024
+
+# WriterPool defaults: threads doing the disk writes of all uploads, bytes
+# received with one recv_into, and buffers an upload may have waiting for
+# the disk before its network thread waits for one to come back
+DEFAULT_WRITERS = 4
+DEFAULT_CHUNK_SIZE = 256 * 1024
+DEFAULT_BUFFERS = 16
+
+
+def _open(path, offset):
+    """Opens ``path`` for writing at ``offset``, cutting it back to there."""
+    if not offset:
+        return open(path, "wb")
+    f = open(path, "r+b")
+    f.truncate(offset)
+    f.seek(offset)
+    return f
+
+
+def _preallocate(f, size):
+    if size <= 0 or not hasattr(os, "posix_fallocate"):
+        return
+    try:
+        os.posix_fallocate(f.fileno(), 0, size)
+    except OSError as e:
+        # Filesystems without fallocate support still work, just unallocated;
+        # a disk that is too small is worth failing on now
+        if e.errno == errno.ENOSPC:
+            f.close()
+            raise
+
+
+class FileWriter:
+    """Writes one received file on a dedicated thread.
+
+    The network thread hands chunks over with ``write`` and goes straight
+    back to reading the socket; the writer thread does the blocking writes
+    and fsyncs. ``durability`` picks how often data is forced to disk (see
+    DURABILITY_MODES). The target is preallocated to the announced size with
+    posix_fallocate where available, so the filesystem can lay it out in one
+    piece and a full disk is reported before any data is written.
+
+    Up to ``max_queued`` bytes may wait for the disk; beyond that ``write``
+    blocks, which in turn slows the sender through TCP flow control.
+    ``written`` and ``synced`` are the file offsets written and known to be
+    on disk.
+
+    To continue an interrupted transfer, pass the ``offset`` to append at
+    (the file is cut back to it). With ``hasher`` every written byte is fed
+    to that hashlib object, and ``on_sync(offset, hexdigest)`` is called
+    after each sync, which is how resume manifests stay in step with the
+    disk.
+
+    A file that arrives in several ranges at once is written with
+    ``write_at`` instead, at explicit positions in the preallocated file;
+    ``written`` then counts bytes written rather than an offset. The two
+    styles are not meant to be mixed in one file.
+    """
+
+    def __init__(self, path, size=0, durability=DEFAULT_DURABILITY, sync_interval=DEFAULT_SYNC_INTERVAL,
+                 max_queued=DEFAULT_MAX_QUEUED, offset=0, hasher=None, on_sync=None):
+        if durability not in DURABILITY_MODES:
+            raise ValueError(f"Unknown durability mode {durability!r}, expected one of {DURABILITY_MODES}")
+        self.path = path
+        self.size = size
+        self.durability = durability
+        self.sync_interval = sync_interval
+        self.max_queued = max_queued
+
+        self.hasher = hasher
+        self.on_sync = on_sync
+
+        self.written = offset
+        self.synced = offset
+        self.error = None
+        self._synced_at = time.monotonic()
+
+        self._file = _open(path, offset)
+        _preallocate(self._file, size)
+        self._queue = deque()
+        self._queued_bytes = 0
+        self._closing = False
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name=f"writer-{os.path.basename(path)}", daemon=True)
+        self._thread.start()
+
+    def write(self, data):
+        """Queues ``data`` to be appended; raises if an earlier write failed."""
+        self._put(None, data)
+
+    def write_at(self, position, data):
+        """Queues ``data`` to be written at ``position``; raises if an earlier write failed."""
+        self._put(position, data)
+
+    def _put(self, position, data):
+        with self._cond:
+            while self._queued_bytes >= self.max_queued and self.error is None:
+                self._cond.wait()
+            if self.error is not None:
+                raise self.error
+            self._queue.append((position, data))
+            self._queued_bytes += len(data)
+            self._cond.notify_all()
+
+    def _next(self, timeout):
+        """Returns the queued chunks, [] on timeout, or None once closed and drained."""
+        with self._cond:
+            if not self._queue and not self._closing:
+                self._cond.wait(timeout)
+            if not self._queue:
+                return None if self._closing else []
+            chunks = list(self._queue)
+            self._queue.clear()
+            self._queued_bytes = 0
+            self._cond.notify_all()
+            return chunks
+
+    def _run(self):
+        timeout = self.sync_interval if self.durability == FSYNC_PERIODIC else None
+        try:
+            while (chunks := self._next(timeout)) is not None:
+                for position, chunk in chunks:
+                    if position is None:
+                        self._file.write(chunk)
+                    elif hasattr(os, "pwrite"):
+                        os.pwrite(self._file.fileno(), chunk, position)
+                    else:
+                        self._file.seek(position)
+                        self._file.write(chunk)
+                    self.written += len(chunk)
+                    if self.hasher is not None:
+                        self.hasher.update(chunk)
+                    if self.durability == FSYNC_CHUNK:
+                        self._sync()
+                if (self.durability == FSYNC_PERIODIC and self.written > self.synced
+                        and time.monotonic() - self._synced_at >= self.sync_interval):
+                    self._sync()
+        except Exception as e:
+            with self._cond:
+                self.error = e
+                self._queue.clear()
+                self._queued_bytes = 0
+                self._cond.notify_all()
+
+    def _sync(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self.synced = self.written
+        self._synced_at = time.monotonic()
+        if self.on_sync is not None:
+            self.on_sync(self.synced, self.hasher.hexdigest() if self.hasher is not None else None)
+
+    def close(self):
+        """Writes what is queued, syncs, trims any unused preallocation and closes.
+
+        Returns the number of bytes in the file; raises if a write failed.
+        """
+        self._stop()
+        try:
+            if self.error is None:
+                self._file.truncate(self.written)
+                self._sync()
+        finally:
+            self._file.close()
+        if self.error is not None:
+            raise self.error
+        return self.written
+
+    def abort(self):
+        """Stops after the chunks already queued; the file is kept.
+
+        What was written is synced (and reported to ``on_sync``) so an
+        interrupted transfer can resume from it.
+        """
+        self._stop()
+        try:
+            if self.error is None:
+                self._file.truncate(self.written)
+                if self.on_sync is not None and self.written > self.synced:
+                    self._sync()
+        except OSError:
+            pass
+        finally:
+            self._file.close()
+
+    def _stop(self):
+        with self._cond:
+            self._closing = True
+            self._cond.notify_all()
+        self._thread.join()
+
+
+class WriterPool:
+    """A few disk-writer threads shared by every upload a server receives.
+
+    Where FileWriter gives each file a thread and copies of the received
+    chunks, ``open`` here returns a PooledFile whose network thread reads
+    straight into the file's reusable buffers (``recv_into``) and queues
+    them for the writer the file was given, the one with the fewest files.
+    A file has at most ``buffers`` buffers of ``chunk_size`` bytes; when all
+    of them wait for the disk, its reader waits for one to be written,
+    which slows the sender through TCP flow control. One writer per file
+    keeps its chunks in order; a slow disk holds up the files on that
+    writer but never a socket read.
+    """
+
+    def __init__(self, writers=DEFAULT_WRITERS, chunk_size=DEFAULT_CHUNK_SIZE, buffers=DEFAULT_BUFFERS,
+                 durability=DEFAULT_DURABILITY, sync_interval=DEFAULT_SYNC_INTERVAL):
+        if durability not in DURABILITY_MODES:
+            raise ValueError(f"Unknown durability mode {durability!r}, expected one of {DURABILITY_MODES}")
+        self.chunk_size = chunk_size
+        self.buffers = buffers
+        self.durability = durability
+        self.sync_interval = sync_interval
+        self._lock = threading.Lock()
+        self._writers = [_PoolWriter(self, number) for number in range(writers)]
+
+    def open(self, path, size=0, offset=0, hasher=None, on_sync=None, name=None):
+        """Starts writing ``path``; the arguments are as for FileWriter."""
+        with self._lock:
+            writer = min(self._writers, key=lambda w: len(w.files))
+            pooled = PooledFile(writer, path, size, offset, hasher, on_sync, name)
+            writer.files.add(pooled)
+        return pooled
+
+    def files(self):
+        """The files being written, for reporting."""
+        with self._lock:
+            return [pooled for writer in self._writers for pooled in writer.files]
+
+    def queued(self):
+        """Received chunks waiting for the disk, over all files."""
+        return sum(writer.queue.qsize() for writer in self._writers)
+
+    def _closed(self, pooled):
+        with self._lock:
+            pooled.writer.files.discard(pooled)
+
+
+class PooledFile:
+    """One file written by a WriterPool; see ``WriterPool.open``.
+
+    The network thread takes a buffer with ``buffer()``, receives into it
+    and passes it to ``submit`` with the byte count (or back to ``release``
+    if nothing came). ``write`` copies in bytes received some other way.
+    ``received`` and ``written`` count bytes handed over and on their way to
+    disk, ``synced`` the file offset known to be on disk.
+
+    The timings tell where an upload's time goes: ``network_wait`` is spent
+    by the reader waiting for a buffer, because the disk is behind;
+    ``disk_time`` by the writer writing and syncing. ``depth`` is how many
+    buffers are queued now and ``peak_depth`` the most there ever were.
+    """
+
+    def __init__(self, writer, path, size, offset, hasher, on_sync, name):
+        self.writer = writer
+        self.path = path
+        self.name = name or os.path.basename(path)
+        self.size = size
+        self.hasher = hasher
+        self.on_sync = on_sync
+        self.received = 0
+        self.written = offset
+        self.synced = offset
+        self.error = None
+
+        self.started = time.monotonic()
+        self.network_wait = 0.0
+        self.disk_time = 0.0
+        self.depth = 0
+        self.peak_depth = 0
+
+        self._file = _open(path, offset)
+        _preallocate(self._file, size)
+        self._synced_at = self.started
+        self._free = []
+        self._allocated = 0
+        self._cond = threading.Condition()
+
+    def buffer(self):
+        """Returns a free buffer, waiting while all of them are queued; raises if a write failed."""
+        with self._cond:
+            if not self._free and self._allocated >= self.writer.pool.buffers and self.error is None:
+                waited = time.monotonic()
+                while not self._free and self.error is None:
+                    self._cond.wait()
+                self.network_wait += time.monotonic() - waited
+            if self.error is not None:
+                raise self.error
+            if self._free:
+                return self._free.pop()
+            self._allocated += 1
+        return bytearray(self.writer.pool.chunk_size)
+
+    def release(self, buf):
+        """Gives back a buffer from ``buffer`` that holds nothing to write."""
+        with self._cond:
+            self._free.append(buf)
+            self._cond.notify()
+
+    def submit(self, buf, nbytes):
+        """Queues the first ``nbytes`` of ``buf`` to be appended to the file."""
+        with self._cond:
+            self.depth += 1
+            self.peak_depth = max(self.peak_depth, self.depth)
+        self.received += nbytes
+        self.writer.queue.put((self, buf, nbytes))
+
+    def write(self, data):
+        """Queues a copy of ``data`` to be appended; raises if an earlier write failed."""
+        data = memoryview(data)
+        while data:
+            buf = self.buffer()
+            n = min(len(buf), len(data))
+            buf[:n] = data[:n]
+            self.submit(buf, n)
+            data = data[n:]
+
+    def throughput(self):
+        """Bytes received per second since the file was opened."""
+        return self.received / max(time.monotonic() - self.started, 1e-9)
+
+    def summary(self):
+        elapsed = time.monotonic() - self.started
+        return (f"{self.received} bytes in {elapsed:.2f}s ({self.throughput() / 1e6:.1f} MB/s), "
+                f"waited {self.network_wait:.2f}s for the disk, disk busy {self.disk_time:.2f}s, "
+                f"peak queue {self.peak_depth}/{self.writer.pool.buffers}")
+
+    def _done(self, buf):
+        """Called by the writer once a buffer is written."""
+        with self._cond:
+            self.depth -= 1
+            self._free.append(buf)
+            self._cond.notify_all()
+
+    def _fail(self, error):
+        with self._cond:
+            self.error = error
+            self._cond.notify_all()
+
+    def _drain(self):
+        with self._cond:
+            while self.depth and self.error is None:
+                self._cond.wait()
+
+    def _sync(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self.synced = self.written
+        self._synced_at = time.monotonic()
+        if self.on_sync is not None:
+            self.on_sync(self.synced, self.hasher.hexdigest() if self.hasher is not None else None)
+
+    def close(self):
+        """Waits for the queued buffers, syncs, trims any unused preallocation and closes.
+
+        Returns the number of bytes in the file; raises if a write failed.
+        """
+        self._drain()
+        self.writer.pool._closed(self)
+        try:
+            if self.error is None:
+                self._file.truncate(self.written)
+                self._sync()
+        finally:
+            self._file.close()
+        if self.error is not None:
+            raise self.error
+        return self.written
+
+    def abort(self):
+        """Stops after the buffers already queued; the file is kept, synced for resuming."""
+        self._drain()
+        self.writer.pool._closed(self)
+        try:
+            if self.error is None:
+                self._file.truncate(self.written)
+                if self.on_sync is not None and self.written > self.synced:
+                    self._sync()
+        except OSError:
+            pass
+        finally:
+            self._file.close()
+
+
+class _PoolWriter:
+    """Writes the queued buffers of its share of a WriterPool's files, in order."""
+
+    def __init__(self, pool, number):
+        self.pool = pool
+        self.files = set()
+        self.queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name=f"disk-writer-{number}", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        timeout = self.pool.sync_interval if self.pool.durability == FSYNC_PERIODIC else None
+        while True:
+            try:
+                pooled, buf, nbytes = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                # Quiet for a while; sync what the files still hold in the page cache
+                with self.pool._lock:
+                    files = list(self.files)
+                for pooled in files:
+                    if pooled.written > pooled.synced and pooled.error is None:
+                        self._timed(pooled, pooled._sync)
+                continue
+            if pooled.error is None:
+                self._timed(pooled, self._write, pooled, memoryview(buf)[:nbytes])
+            pooled._done(buf)
+
+    def _write(self, pooled, data):
+        pooled._file.write(data)
+        pooled.written += len(data)
+        if pooled.hasher is not None:
+            pooled.hasher.update(data)
+        durability = self.pool.durability
+        if durability == FSYNC_CHUNK or (durability == FSYNC_PERIODIC
+                                         and time.monotonic() - pooled._synced_at >= self.pool.sync_interval):
+            pooled._sync()
+
+    def _timed(self, pooled, func, *args):
+        started = time.monotonic()
+        try:
+            func(*args)
+        except Exception as e:
+            # Fails this file alone (a disk error, or e.g. its on_sync callback
+            # raising); the thread goes on writing the others
+            pooled._fail(e)
+        pooled.disk_time += time.monotonic() - started
@@ -0,0 +1,281 @@
+import socket
+import struct
+import threading
+from collections import namedtuple
+
+import control
+
+# Every frame starts with this fixed header:
+#   magic (1) | version (1) | type (1) | flags (1) | stream id (4) | length (4)
+MAGIC = 0xA6
+VERSION = 1
+HEADER = struct.Struct("!BBBBII")
+HEADER_SIZE = HEADER.size
+
+# Largest payload a peer may announce; bigger frames are a protocol error
+MAX_PAYLOAD = 1 << 20
+
+# Frame types
+TEXT = 1       # UTF-8 control and chat text (PAIR:, FILE:, MSG:, ACK, ...)
+FILECHUNK = 2  # Opaque (encrypted) file data for the transfer in stream_id
+EOF = 3        # End of the transfer in stream_id
+ACK = 4        # Cumulative count of payload bytes the receiver holds for stream_id
+CACHE_QUERY = 5  # Sender -> relay: sha256 hashes of upcoming FILECHUNK payloads
+CACHE_HAVE = 6   # Relay -> sender: one byte per queried hash, 1 if cached (empty: no cache)
+CHUNKREF = 7     # Sender -> relay: send the cached FILECHUNK with this sha256 instead
+CONTROL = 8      # A control message in binary form (see control.py), the compact TEXT alternative
+
+# Frame flags
+FLAG_WINDOWED = 0x01  # FILECHUNK is acknowledged by the receiver, not the relay
+FLAG_COMPRESSED = 0x02  # FILECHUNK holds the chunk compressed with the transfer's codec
+
+# Payload of an ACK frame
+ACK_PAYLOAD = struct.Struct("!Q")
+
+Frame = namedtuple("Frame", ["type", "flags", "stream_id", "payload"])
+
+
+class ProtocolError(Exception):
+    """Raised when the peer sends bytes that are not a valid frame."""
+
+
+def encode_header(frame_type, length, stream_id=0, flags=0):
+    """Returns the packed header for a frame with a payload of ``length`` bytes."""
+    return HEADER.pack(MAGIC, VERSION, frame_type, flags, stream_id, length)
+
+
+def encode_frame(frame_type, payload=b"", stream_id=0, flags=0):
+    """Returns a complete frame as one bytes object."""
+    return encode_header(frame_type, len(payload), stream_id, flags) + payload
+
+
+def sendall_buffers(sock, buffers):
+    """Writes several buffers back to back with ``sendall`` semantics.
+
+    Uses the socket's own ``sendall_buffers`` if it has one (see
+    ``LockedSocket``), otherwise gathers them with ``sendmsg`` where the
+    platform supports it.
+    """
+    writer = getattr(sock, "sendall_buffers", None)
+    if writer is not None:
+        writer(buffers)
+        return
+    if not hasattr(sock, "sendmsg"):
+        for buf in buffers:
+            sock.sendall(buf)
+        return
+    views = [memoryview(buf).cast("B") for buf in buffers if len(buf)]
+    while views:
+        sent = sock.sendmsg(views)
+        # Drop whatever was fully written and trim a partial write
+        while sent and sent >= len(views[0]):
+            sent -= len(views.pop(0))
+        if sent:
+            views[0] = views[0][sent:]
+
+
+def send_frame(sock, frame_type, payload=b"", stream_id=0, flags=0):
+    """Writes one frame with ``sendall`` semantics.
+
+    Small payloads are joined with the header into a single write; large ones
+    are written straight from the caller's buffer so they are never copied.
+    """
+    header = encode_header(frame_type, len(payload), stream_id, flags)
+    if len(payload) <= 4096:
+        sock.sendall(header + payload)
+    else:
+        sendall_buffers(sock, (header, payload))
+
+
+def send_text(sock, text, stream_id=0):
+    """Sends a TEXT frame carrying ``text``."""
+    send_frame(sock, TEXT, text.encode("utf-8"), stream_id)
+
+
+def send_control(sock, kind, *values, stream_id=0):
+    """Sends a CONTROL frame carrying a ``kind`` message with ``values``."""
+    send_frame(sock, CONTROL, control.encode(kind, *values), stream_id)
+
+
+def send_ack(sock, stream_id, offset):
+    """Acknowledges every payload byte of ``stream_id`` before ``offset``."""
+    send_frame(sock, ACK, ACK_PAYLOAD.pack(offset), stream_id)
+
+
+def decode_ack(frame):
+    """Returns the acknowledged offset carried by an ACK frame."""
+    return ACK_PAYLOAD.unpack(frame.payload)[0]
+
+
+class LockedSocket:
+    """Socket wrapper that serializes writes from several threads.
+
+    Every ``sendall``/``sendall_buffers`` call is written whole, so frames
+    sent by different threads never interleave on the wire. Reads and any
+    other attribute go straight to the wrapped socket.
+    """
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.write_lock = threading.Lock()
+
+    def sendall(self, data):
+        with self.write_lock:
+            self.sock.sendall(data)
+
+    def sendall_buffers(self, buffers):
+        with self.write_lock:
+            sendall_buffers(self.sock, buffers)
+
+    def send_nowait(self, data):
+        """Writes ``data`` unless that would wait; returns whether it was sent.
+
+        For heartbeats and timers, which must not hang on a peer that
+        stopped reading. Nothing is sent while another thread is writing or
+        the socket buffer is full. If only part fits, the rest is written
+        by a thread of its own that holds the lock until it is done.
+        """
+        if not self.write_lock.acquire(blocking=False):
+            return False
+        try:
+            sent = self.sock.send(data, socket.MSG_DONTWAIT)
+        except OSError:
+            self.write_lock.release()
+            return False
+        if sent == len(data):
+            self.write_lock.release()
+        else:
+            threading.Thread(target=self._finish_send, args=(data[sent:],), daemon=True).start()
+        return True
+
+    def _finish_send(self, rest):
+        try:
+            self.sock.sendall(rest)
+        except OSError:
+            pass
+        finally:
+            self.write_lock.release()
+
+    def __getattr__(self, name):
+        return getattr(self.sock, name)
+
+
+class FrameDecoder:
+    """Incremental frame parser over a reusable receive buffer.
+
+    Bytes are read straight into the decoder with ``recv_into(get_buffer())``
+    followed by ``buffer_updated(n)`` (the same contract as
+    ``asyncio.BufferedProtocol``), or pushed in with ``feed``. Complete frames
+    are returned with payloads as ``memoryview`` slices of the buffer, so
+    partial and coalesced reads are handled without copying or decoding the
+    payload. A payload view is only valid until the next ``get_buffer`` or
+    ``feed`` call; consumers that need to keep it must copy it.
+    """
+
+    def __init__(self, initial_size=4096, max_payload=MAX_PAYLOAD):
+        self.max_payload = max_payload
+        self._buf = bytearray(initial_size)
+        self._view = memoryview(self._buf)
+        self._start = 0
+        self._end = 0
+
+    def _needed(self):
+        """Bytes the frame at the read position needs to be complete."""
+        pending = self._end - self._start
+        if pending < HEADER_SIZE:
+            return HEADER_SIZE
+        length = HEADER.unpack_from(self._buf, self._start)[5]
+        return HEADER_SIZE + min(length, self.max_payload)
+
+    def get_buffer(self, sizehint=-1):
+        """Returns a writable view of the free space at the end of the buffer."""
+        pending = self._end - self._start
+        if pending == 0:
+            self._start = self._end = 0
+        else:
+            needed = self._needed()
+            if self._start + needed > len(self._buf):
+                if needed > len(self._buf):
+                    # Grow into a fresh buffer; views handed out earlier keep
+                    # the old one alive instead of blocking the resize
+                    new_buf = bytearray(max(2 * needed, 2 * len(self._buf)))
+                    new_buf[:pending] = self._view[self._start:self._end]
+                    self._buf = new_buf
+                    self._view = memoryview(new_buf)
+                else:
+                    self._view[:pending] = self._view[self._start:self._end]
+                self._start, self._end = 0, pending
+        return self._view[self._end:]
+
+    def buffer_updated(self, nbytes):
+        """Records that ``nbytes`` were written into the last ``get_buffer`` view."""
+        self._end += nbytes
+
+    def recv_from(self, sock):
+        """Reads once from ``sock`` into the buffer; returns the byte count."""
+        nbytes = sock.recv_into(self.get_buffer())
+        self.buffer_updated(nbytes)
+        return nbytes
+
+    def feed(self, data):
+        """Copies ``data`` in and yields every frame it completes."""
+        data = memoryview(data)
+        while data:
+            free = self.get_buffer()
+            n = min(len(free), len(data))
+            free[:n] = data[:n]
+            self.buffer_updated(n)
+            data = data[n:]
+            yield from self.frames()
+
+    def _header(self):
+        """Parses and validates the header at the read position, if it is complete."""
+        if self._end - self._start < HEADER_SIZE:
+            return None
+        magic, version, frame_type, flags, stream_id, length = HEADER.unpack_from(self._buf, self._start)
+        if magic != MAGIC:
+            raise ProtocolError(f"Bad frame magic 0x{magic:02x}")
+        if version != VERSION:
+            raise ProtocolError(f"Unsupported frame version {version}")
+        if length > self.max_payload:
+            raise ProtocolError(f"Frame of {length} bytes exceeds limit of {self.max_payload}")
+        return frame_type, flags, stream_id, length
+
+    def next_frame(self):
+        """Returns the next complete frame, or None if more bytes are needed."""
+        header = self._header()
+        if header is None:
+            return None
+        frame_type, flags, stream_id, length = header
+        start = self._start + HEADER_SIZE
+        end = start + length
+        if end > self._end:
+            return None
+        self._start = end
+        return Frame(frame_type, flags, stream_id, self._view[start:end])
+
+    def partial_frame(self):
+        """Returns the frame being received if its header is in but its payload is not.
+
+        The result is ``(frame, missing)``: ``frame.payload`` holds the payload
+        bytes buffered so far and ``missing`` is how many are still on the
+        wire. Relays that move the rest of an opaque payload themselves (for
+        example with os.splice) call ``discard_partial`` afterwards.
+        """
+        header = self._header()
+        if header is None:
+            return None
+        frame_type, flags, stream_id, length = header
+        start = self._start + HEADER_SIZE
+        if start + length <= self._end:
+            return None
+        return Frame(frame_type, flags, stream_id, self._view[start:self._end]), start + length - self._end
+
+    def discard_partial(self):
+        """Drops the partial frame after its remaining payload was consumed elsewhere."""
+        self._start = self._end = 0
+
+    def frames(self):
+        """Yields all complete frames currently buffered."""
+        while (frame := self.next_frame()) is not None:
+            yield frame
@@ -1,10 +1,16 @@
 import sys
 from PyQt6.QtWidgets import (
     QApplication, QMainWindow, QWidget, QVBoxLayout, QHBoxLayout, QPushButton,
-    QTextEdit, QLineEdit, QFileDialog, QMessageBox, QLabel
+    QLineEdit, QFileDialog, QMessageBox, QLabel
 )
 from PyQt6.QtCore import Qt
 
+import chatmodel
+import history
+
+# This window has no peer, so all of its messages form one conversation
+CONVERSATION = "local"
+
 
 class MessengerApp(QMainWindow):
     def __init__(self):
@@ -28,13 +34,15 @@ class MessengerApp(QMainWindow):
         )
         main_layout.addWidget(header_label)
 
-        # Chat Display Area
-        self.chat_display = QTextEdit(self)
-        self.chat_display.setReadOnly(True)
+        # Chat Display Area, backed by the on-disk history and read lazily
+        self.message_log = history.MessageLog(history.DEFAULT_DIRECTORY, CONVERSATION)
+        self.chat_model = chatmodel.MessageListModel(self.message_log, self)
+        self.chat_display = chatmodel.MessageView(self.chat_model, self)
         self.chat_display.setStyleSheet(
             "background-color: #131c21; color: #e1e1e1; font-size: 14px; padding: 10px; border: none;"
         )
         main_layout.addWidget(self.chat_display)
+        self.chat_display.scrollToBottom()
 
         # Bottom Input and Buttons
         bottom_layout = QHBoxLayout()
@@ -71,8 +79,10 @@ class MessengerApp(QMainWindow):
             QMessageBox.warning(self, "Warning", "Message cannot be empty!")
 
     def display_message(self, sender, message):
-        """Displays a message in the chat window."""
-        self.chat_display.append(f"<b>{sender}:</b> {message}")
+        """Displays a message in the chat window and adds it to the history."""
+        self.message_log.append(f"{sender}: {message}")
+        self.chat_model.refresh()
+        self.chat_display.scrollToBottom()
 
     def add_file(self):
         """Opens a file dialog to select a file."""
@@ -80,6 +90,9 @@ class MessengerApp(QMainWindow):
         if file_path:
             self.display_message("You", f"Sent a file: {file_path}")
 
+    def closeEvent(self, event):
+        self.message_log.close()
+
 
 if __name__ == "__main__":
     app = QApplication(sys.argv)
@@ -0,0 +1,149 @@
+import math
+import socket
+import time
+
+# A client that has been quiet this long is sent a heartbeat to answer...
+DEFAULT_HEARTBEAT_INTERVAL = 30.0
+# ...and one that has sent nothing at all for this long is disconnected
+DEFAULT_IDLE_TIMEOUT = 90.0
+# A file transfer with no data moving for this long is given up
+DEFAULT_STALL_TIMEOUT = 120.0
+# Clients of the raw-text servers cannot answer heartbeats, and one that only
+# listens is as healthy as any, so there quiet clients are not cut (0) and the
+# kernel's keepalive probes find dead peers
+QUIET_IDLE_TIMEOUT = 0
+
+# Heartbeat request and answer, as text frames in server6's protocol
+PING = "PING"
+PONG = "PONG"
+
+
+def enable_keepalive(sock, interval=DEFAULT_HEARTBEAT_INTERVAL, probes=3):
+    """Has the kernel probe ``sock`` once it has been idle for ``interval`` seconds.
+
+    For protocols with no room for heartbeats of their own: a peer that
+    vanished without closing the connection (power loss, a dropped NAT
+    mapping) then fails the next recv after about ``interval * (probes + 1)``
+    seconds, and is cleaned up like any other disconnect.
+    """
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    seconds = max(1, int(interval))
+    # Not every platform lets the timings be set per socket
+    for name, value in (("TCP_KEEPIDLE", seconds), ("TCP_KEEPINTVL", seconds), ("TCP_KEEPCNT", probes)):
+        option = getattr(socket, name, None)
+        if option is not None:
+            try:
+                sock.setsockopt(socket.IPPROTO_TCP, option, value)
+            except OSError:
+                pass
+
+
+def disconnect(sock):
+    """Wakes a thread blocked reading ``sock``, which then cleans the connection up."""
+    try:
+        sock.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass
+
+
+class Liveness:
+    """When one connection was last heard from; readers call ``touch``."""
+
+    __slots__ = ("key", "last_seen", "timeout", "timer")
+
+    def __init__(self, key, timeout):
+        self.key = key
+        self.last_seen = time.monotonic()
+        self.timeout = timeout
+        self.timer = None
+
+    def touch(self):
+        self.last_seen = time.monotonic()
+
+
+class IdleMonitor:
+    """Heartbeats and idle eviction for all of a server's connections on one TimerWheel.
+
+    Reading a connection only updates its Liveness with ``touch``, one
+    attribute write; the wheel is not involved. Each connection has one
+    timer, due a heartbeat interval after it was last heard from. If it was
+    heard from since, the timer is just moved on; if not, ``on_heartbeat(key)``
+    asks the client for an answer, and once it has been quiet for its
+    timeout, ``on_idle(key, quiet_seconds)`` should close it. A connection
+    thus costs O(1) work per heartbeat interval, however busy it is and
+    however many there are.
+
+    A timeout or interval of 0 disables that part. Callbacks run on the
+    thread that advances the wheel and must not block.
+    """
+
+    def __init__(self, wheel, idle_timeout=DEFAULT_IDLE_TIMEOUT, heartbeat_interval=DEFAULT_HEARTBEAT_INTERVAL,
+                 on_idle=None, on_heartbeat=None):
+        self.wheel = wheel
+        self.idle_timeout = idle_timeout or math.inf
+        self.heartbeat_interval = heartbeat_interval if on_heartbeat is not None and heartbeat_interval else math.inf
+        self.on_idle = on_idle
+        self.on_heartbeat = on_heartbeat
+        self._entries = {}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def add(self, key):
+        """Starts watching connection ``key``; returns its Liveness."""
+        entry = Liveness(key, self.idle_timeout)
+        self._entries[key] = entry
+        wait = min(entry.timeout, self.heartbeat_interval)
+        if wait < math.inf:
+            entry.timer = self.wheel.schedule(wait, self._check, entry)
+        return entry
+
+    def get(self, key):
+        return self._entries.get(key)
+
+    def touch(self, key):
+        entry = self._entries.get(key)
+        if entry is not None:
+            entry.last_seen = time.monotonic()
+
+    def remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None and entry.timer is not None:
+            self.wheel.cancel(entry.timer)
+
+    def set_timeout(self, key, timeout=None):
+        """Gives ``key`` its own timeout, e.g. a stall timeout during a transfer; None restores the idle timeout."""
+        entry = self._entries.get(key)
+        if entry is None:
+            return
+        entry.timeout = (timeout or math.inf) if timeout is not None else self.idle_timeout
+        self._arm(entry, time.monotonic() - entry.last_seen)
+
+    def _arm(self, entry, quiet):
+        """Schedules the next check of ``entry``, which has been quiet for ``quiet`` seconds."""
+        if quiet >= self.heartbeat_interval:
+            # Already asked; the answer is due within an interval
+            wait = min(self.heartbeat_interval, entry.timeout - quiet)
+        else:
+            wait = min(self.heartbeat_interval, entry.timeout) - quiet
+        if wait == math.inf:
+            return
+        if entry.timer is None:
+            entry.timer = self.wheel.schedule(wait, self._check, entry)
+        else:
+            self.wheel.reschedule(entry.timer, wait)
+
+    def _check(self, entry):
+        if self._entries.get(entry.key) is not entry:
+            return
+        quiet = time.monotonic() - entry.last_seen
+        if quiet >= entry.timeout:
+            if self.on_idle is not None:
+                self.on_idle(entry.key, quiet)
+            # Looked at again a timeout later, should the connection outlive that
+            if entry.timeout < math.inf:
+                self.wheel.reschedule(entry.timer, entry.timeout)
+            return
+        if quiet >= self.heartbeat_interval:
+            self.on_heartbeat(entry.key)
+        self._arm(entry, quiet)
@@ -0,0 +1,148 @@
+import json
+import os
+import re
+import struct
+import threading
+import time
+from collections import namedtuple
+
+# Where conversations are kept unless a client is told otherwise
+DEFAULT_DIRECTORY = os.path.join(os.path.expanduser("~"), ".messenger", "history")
+# Conversation for lines shown before pairing with anyone
+SERVER_CONVERSATION = "server"
+
+# Each conversation is <name>.log, one JSON object per line, plus
+# <name>.idx, the log offset of every message as a big-endian uint64
+LOG_SUFFIX = ".log"
+INDEX_SUFFIX = ".idx"
+INDEX_ENTRY = struct.Struct("!Q")
+
+Message = namedtuple("Message", ["timestamp", "text"])
+
+
+def conversation_name(peer):
+    """Returns a file name for ``peer`` (e.g. an IP address), safe on every platform."""
+    return re.sub(r"[^A-Za-z0-9._-]", "_", peer) or SERVER_CONVERSATION
+
+
+class MessageLog:
+    """Append-only message history of one conversation, with an offset index.
+
+    Messages are appended to the log and their offsets to the index, so
+    message ``n`` is found with one index read and one log read however
+    long the history is, and opening a conversation never reads it all.
+    The index is written after the log; on open, messages the index lost
+    in a crash are re-indexed from the log's tail and index entries past a
+    truncated log are dropped.
+
+    ``extend`` is called from the GUI thread while ``read`` may be called
+    from anywhere, so both hold a lock.
+    """
+
+    def __init__(self, directory, peer):
+        os.makedirs(directory, exist_ok=True)
+        base = os.path.join(directory, conversation_name(peer))
+        self.peer = peer
+        self.log_path = base + LOG_SUFFIX
+        self.index_path = base + INDEX_SUFFIX
+        self._lock = threading.Lock()
+
+        self._log = open(self.log_path, "a+b")
+        self._index = open(self.index_path, "a+b")
+        self._log_size = self._log.seek(0, os.SEEK_END)
+        self._count = self._index.seek(0, os.SEEK_END) // INDEX_ENTRY.size
+        self._recover()
+
+    def _offset(self, n):
+        self._index.seek(n * INDEX_ENTRY.size)
+        return INDEX_ENTRY.unpack(self._index.read(INDEX_ENTRY.size))[0]
+
+    def _recover(self):
+        """Brings the index back in step with the log after an unclean exit."""
+        # Entries pointing past the end of the log describe nothing
+        while self._count and self._offset(self._count - 1) >= self._log_size:
+            self._count -= 1
+
+        # Complete lines after the last indexed message were never indexed;
+        # a partial last line is dropped, with its index entry if it has one
+        start = self._offset(self._count - 1) if self._count else 0
+        self._log.seek(start)
+        tail = self._log.read()
+        complete = tail.rfind(b"\n") + 1
+        offsets = []
+        position = start
+        for line in tail[:complete].split(b"\n")[:-1]:
+            offsets.append(position)
+            position += len(line) + 1
+        if self._count:
+            if offsets:
+                # The first line is the last message that was already indexed
+                offsets = offsets[1:]
+            else:
+                self._count -= 1
+        if position != self._log_size:
+            self._log.truncate(position)
+            self._log_size = position
+        self._index.truncate(self._count * INDEX_ENTRY.size)
+        if offsets:
+            self._index.seek(0, os.SEEK_END)
+            self._index.write(b"".join(INDEX_ENTRY.pack(offset) for offset in offsets))
+            self._count += len(offsets)
+        self._index.flush()
+
+    def __len__(self):
+        return self._count
+
+    def append(self, text, timestamp=None):
+        self.extend([text], timestamp)
+
+    def extend(self, texts, timestamp=None):
+        """Appends several messages with one write to each file."""
+        if timestamp is None:
+            timestamp = time.time()
+        records = [json.dumps({"t": timestamp, "text": text}).encode("utf-8") + b"\n" for text in texts]
+        with self._lock:
+            offsets = []
+            position = self._log_size
+            for record in records:
+                offsets.append(position)
+                position += len(record)
+            self._log.seek(0, os.SEEK_END)
+            self._log.write(b"".join(records))
+            self._log.flush()
+            self._index.seek(0, os.SEEK_END)
+            self._index.write(b"".join(INDEX_ENTRY.pack(offset) for offset in offsets))
+            self._index.flush()
+            self._log_size = position
+            self._count += len(records)
+
+    def read(self, start, count):
+        """Returns up to ``count`` messages starting with message ``start``."""
+        with self._lock:
+            count = min(count, self._count - start)
+            if start < 0 or count <= 0:
+                return []
+            self._index.seek(start * INDEX_ENTRY.size)
+            entries = self._index.read((count + 1) * INDEX_ENTRY.size)
+            offsets = [INDEX_ENTRY.unpack_from(entries, i * INDEX_ENTRY.size)[0]
+                       for i in range(len(entries) // INDEX_ENTRY.size)]
+            if len(offsets) == count:
+                offsets.append(self._log_size)
+            self._log.seek(offsets[0])
+            data = self._log.read(offsets[-1] - offsets[0])
+
+        messages = []
+        base = offsets[0]
+        for begin, end in zip(offsets, offsets[1:]):
+            record = data[begin - base:end - base]
+            try:
+                value = json.loads(record)
+                messages.append(Message(value["t"], value["text"]))
+            except (ValueError, KeyError, TypeError):
+                messages.append(Message(0, record.decode("utf-8", "replace").rstrip("\n")))
+        return messages
+
+    def close(self):
+        with self._lock:
+            self._log.close()
+            self._index.close()
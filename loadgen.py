@@ -0,0 +1,532 @@
+"""Headless load generator for server.py, server3.py and server6.py.
+
+Opens many simulated clients from one asyncio loop and drives each
+server's own protocol:
+
+  server   chat lines broadcast to every other client
+  server3  MESSAGE: request/reply round trips and FILE: uploads
+  server6  PAIR: between client pairs, TEXT messages relayed to the peer,
+           FILE: + windowed FILECHUNK/EOF transfers acknowledged by the peer
+
+Connections are opened in steps of --ramp-step; the first step with a
+failed connect sets the connection ceiling and no further clients are
+opened. The run ends with one JSON report (messages/sec, latency
+percentiles, file throughput, connection counts), written to stdout or
+appended as one line to --output so results can be tracked over time.
+
+server6 pairs clients by IP, so every simulated client binds its own
+127.x.y.z source address; run it against a server on this host. server3
+saves uploads to its user's Desktop as loadgen-*.bin.
+
+Usage: python loadgen.py server6 --port 12345 --clients 1000 --duration 10
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import sys
+import time
+
+import framing
+import transfer
+
+SERVERS = ("server", "server3", "server6")
+
+# Messages carry their send time so receivers can measure latency
+MESSAGE_TAG = "LG"
+# A server6 PAIR that fails (the peer is not registered yet) is sent again
+# after this many seconds, doubling up to PAIR_RETRY_MAX
+PAIR_RETRY = 0.05
+PAIR_RETRY_MAX = 1.0
+
+
+def percentiles(values, points=(50, 99, 99.9)):
+    """Returns {"p50": ..., "p99": ..., "p999": ...} in milliseconds."""
+    result = {}
+    ordered = sorted(values)
+    for point in points:
+        key = "p" + f"{point:g}".replace(".", "")
+        if not ordered:
+            result[key] = None
+            continue
+        index = min(len(ordered) - 1, int(len(ordered) * point / 100))
+        result[key] = round(ordered[index] * 1000, 3)
+    return result
+
+
+def source_ip(index):
+    """Distinct loopback address for client ``index`` (127.1.0.1 upwards)."""
+    n = index + 1
+    return f"127.{1 + (n >> 16)}.{(n >> 8) & 0xFF}.{n & 0xFF}"
+
+
+def make_message(sender, seq):
+    return f"{MESSAGE_TAG} {sender} {seq} {time.perf_counter_ns()}"
+
+
+def message_latency(text):
+    """Seconds since a make_message() text was created, or None if it is not one."""
+    parts = text.split()
+    if len(parts) != 4 or parts[0] != MESSAGE_TAG:
+        return None
+    try:
+        return (time.perf_counter_ns() - int(parts[3])) / 1e9
+    except ValueError:
+        return None
+
+
+class Stats:
+    """Counters and samples shared by every simulated client."""
+
+    def __init__(self):
+        self.connect_times = []
+        self.connect_failed = 0
+        self.ceiling = None
+        self.sent = 0
+        self.received = 0
+        self.malformed = 0
+        self.latencies = []
+        self.file_transfers = 0
+        self.file_completed = 0
+        self.file_bytes = 0
+        self.file_times = []
+        self.file_elapsed = 0.0
+        self.message_elapsed = 0.0
+        self.errors = {}
+
+    def error(self, e):
+        key = f"{type(e).__name__}: {e}"
+        self.errors[key] = self.errors.get(key, 0) + 1
+
+    def report(self, server, args):
+        established = len(self.connect_times)
+        file_mb_s = self.file_bytes / self.file_elapsed / 1e6 if self.file_elapsed else 0.0
+        return {
+            "server": server,
+            "label": args.label,
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "params": {
+                "host": args.host,
+                "port": args.port,
+                "clients": args.clients,
+                "duration": args.duration,
+                "rate": args.rate,
+                "file_clients": args.file_clients,
+                "files": args.files,
+                "file_size": args.file_size,
+                "chunk": args.chunk,
+            },
+            "connections": {
+                "attempted": established + self.connect_failed,
+                "established": established,
+                "failed": self.connect_failed,
+                "ceiling": self.ceiling,
+                "connect_ms": percentiles(self.connect_times),
+            },
+            "messages": {
+                "sent": self.sent,
+                "received": self.received,
+                "malformed": self.malformed,
+                "sent_per_sec": round(self.sent / self.message_elapsed, 1) if self.message_elapsed else 0.0,
+                "per_sec": round(self.received / self.message_elapsed, 1) if self.message_elapsed else 0.0,
+                "latency_ms": percentiles(self.latencies),
+            },
+            "files": {
+                "transfers": self.file_transfers,
+                "completed": self.file_completed,
+                "bytes": self.file_bytes,
+                "mb_per_sec": round(file_mb_s, 2),
+                "duration_ms": percentiles(self.file_times),
+            },
+            "errors": self.errors,
+        }
+
+
+async def open_clients(args, stats, bind_source=False):
+    """Connects up to ``args.clients`` clients in steps; returns the (reader, writer) pairs."""
+    connections = []
+    for start in range(0, args.clients, args.ramp_step):
+        indexes = range(start, min(start + args.ramp_step, args.clients))
+        results = await asyncio.gather(*(connect(args, stats, i, bind_source) for i in indexes))
+        connections.extend(conn for conn in results if conn is not None)
+        if len(connections) < indexes.stop:
+            stats.ceiling = len(connections)
+            break
+    return connections
+
+
+async def connect(args, stats, index, bind_source):
+    local_addr = (source_ip(index), 0) if bind_source else None
+    start = time.perf_counter()
+    try:
+        conn = await asyncio.wait_for(
+            asyncio.open_connection(args.host, args.port, local_addr=local_addr), args.connect_timeout)
+    except (OSError, asyncio.TimeoutError) as e:
+        stats.connect_failed += 1
+        stats.error(e)
+        return None
+    stats.connect_times.append(time.perf_counter() - start)
+    return conn
+
+
+async def close_all(connections):
+    for _, writer in connections:
+        writer.close()
+    await asyncio.gather(*(writer.wait_closed() for _, writer in connections), return_exceptions=True)
+
+
+async def paced(duration, rate):
+    """Yields sequence numbers at ``rate`` per second (flat out if 0) for ``duration`` seconds."""
+    deadline = time.perf_counter() + duration
+    interval = 1 / rate if rate else 0
+    next_at = time.perf_counter()
+    for seq in itertools.count():
+        now = time.perf_counter()
+        if now >= deadline:
+            return
+        if interval:
+            if next_at > now:
+                await asyncio.sleep(next_at - now)
+            next_at += interval
+        else:
+            await asyncio.sleep(0)
+        yield seq
+
+
+# server.py: broadcast chat
+
+async def chat_reader(reader, stats, observe):
+    """Drains broadcasts; observers record latency for every message they see."""
+    pending = b""
+    while data := await reader.read(65536):
+        if not observe:
+            continue
+        pending += data
+        *lines, pending = pending.split(b"\n")
+        for line in lines:
+            latency = message_latency(line.decode("utf-8", errors="replace"))
+            if latency is None:
+                stats.malformed += 1
+            else:
+                stats.received += 1
+                stats.latencies.append(latency)
+
+
+async def chat_sender(writer, index, args, stats):
+    async for seq in paced(args.duration, args.rate):
+        writer.write((make_message(index, seq) + "\n").encode("utf-8"))
+        stats.sent += 1
+        await writer.drain()
+
+
+async def run_chat(args, stats):
+    connections = await open_clients(args, stats)
+    readers = [asyncio.ensure_future(chat_reader(reader, stats, i < args.observers))
+               for i, (reader, _) in enumerate(connections)]
+    start = time.perf_counter()
+    results = await asyncio.gather(*(chat_sender(writer, i, args, stats)
+                                     for i, (_, writer) in enumerate(connections)),
+                                   return_exceptions=True)
+    # Let the last broadcasts arrive
+    await asyncio.sleep(args.settle)
+    stats.message_elapsed = time.perf_counter() - start
+    for result in results:
+        if isinstance(result, Exception):
+            stats.error(result)
+    await close_all(connections)
+    await asyncio.gather(*readers, return_exceptions=True)
+
+
+# server3.py: MESSAGE round trips and FILE uploads
+
+async def server3_messages(reader, writer, index, args, stats):
+    async for seq in paced(args.duration, args.rate):
+        start = time.perf_counter()
+        writer.write(f"MESSAGE:{MESSAGE_TAG} {index} {seq}".encode("utf-8"))
+        stats.sent += 1
+        await writer.drain()
+        if not await reader.read(4096):
+            raise ConnectionError("server3 closed the connection")
+        stats.received += 1
+        stats.latencies.append(time.perf_counter() - start)
+
+
+async def server3_files(reader, writer, index, args, stats):
+    payload = os.urandom(args.file_size)
+    for n in range(args.files):
+        stats.file_transfers += 1
+        start = time.perf_counter()
+        writer.write(f"FILE:loadgen-{index}-{n}.bin:{args.file_size}".encode("utf-8"))
+        await writer.drain()
+        # server3 parses the header from a single recv, so it must arrive alone
+        await asyncio.sleep(0.05)
+        writer.write(payload)
+        await writer.drain()
+        reply = await reader.read(4096)
+        if b"received successfully" not in reply:
+            raise ConnectionError(f"Unexpected FILE reply {reply[:80]!r}")
+        stats.file_times.append(time.perf_counter() - start)
+        stats.file_completed += 1
+        stats.file_bytes += args.file_size
+
+
+async def run_server3(args, stats):
+    connections = await open_clients(args, stats)
+    await run_phases(connections, connections[:args.file_clients], args, stats, server3_messages, server3_files)
+    await close_all(connections)
+
+
+async def run_phases(clients, senders, args, stats, messages, files):
+    """Runs the message phase on every client, then the file phase on ``senders``."""
+    start = time.perf_counter()
+    results = await asyncio.gather(*(messages(*client, i, args, stats) for i, client in enumerate(clients)),
+                                   return_exceptions=True)
+    await asyncio.sleep(args.settle)
+    stats.message_elapsed = time.perf_counter() - start
+
+    if args.files and args.file_size:
+        start = time.perf_counter()
+        results += await asyncio.gather(*(files(*client, i, args, stats) for i, client in enumerate(senders)),
+                                        return_exceptions=True)
+        stats.file_elapsed = time.perf_counter() - start
+    for result in results:
+        if isinstance(result, Exception):
+            stats.error(result)
+
+
+# server6.py: framed relay between paired clients
+
+class Server6Client:
+    """One framed server6 connection; a reader task dispatches incoming frames."""
+
+    def __init__(self, reader, writer, index, stats):
+        self.reader = reader
+        self.writer = writer
+        self.index = index
+        self.ip = source_ip(index)
+        self.stats = stats
+        self.paired = asyncio.Event()
+        self.pair_failed = asyncio.Event()
+        self.stream_ids = itertools.count(1)
+        # stream id -> queue of "ACK"/"ERROR:" texts for transfers we send
+        self.replies = {}
+        # stream id -> [acked offset, event]; receiver progress of our transfers
+        self.acked = {}
+        # stream id -> [bytes received, started]; transfers we receive
+        self.incoming = {}
+        self.task = asyncio.ensure_future(self.read_frames())
+
+    def send(self, frame_type, payload=b"", stream_id=0, flags=0):
+        self.writer.write(framing.encode_frame(frame_type, payload, stream_id, flags))
+
+    def send_text(self, text, stream_id=0):
+        self.send(framing.TEXT, text.encode("utf-8"), stream_id)
+
+    async def read_frames(self):
+        try:
+            while True:
+                header = await self.reader.readexactly(framing.HEADER_SIZE)
+                _, _, frame_type, flags, stream_id, length = framing.HEADER.unpack(header)
+                payload = await self.reader.readexactly(length) if length else b""
+                self.handle_frame(framing.Frame(frame_type, flags, stream_id, payload))
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+
+    def handle_frame(self, frame):
+        if frame.type == framing.FILECHUNK:
+            counts = self.incoming.setdefault(frame.stream_id, [0, time.perf_counter()])
+            counts[0] += len(frame.payload)
+            if frame.flags & framing.FLAG_WINDOWED:
+                self.send(framing.ACK, framing.ACK_PAYLOAD.pack(counts[0]), frame.stream_id)
+        elif frame.type == framing.EOF:
+            counts = self.incoming.pop(frame.stream_id, None)
+            if counts is not None:
+                self.stats.file_completed += 1
+                self.stats.file_bytes += counts[0]
+                self.stats.file_times.append(time.perf_counter() - counts[1])
+        elif frame.type == framing.ACK:
+            state = self.acked.get(frame.stream_id)
+            if state is not None:
+                state[0] = max(state[0], framing.decode_ack(frame))
+                state[1].set()
+        elif frame.type == framing.TEXT:
+            text = frame.payload.decode("utf-8", errors="replace")
+            if text == "PAIR_SUCCESS":
+                self.paired.set()
+            elif text == "PAIR_FAILED":
+                self.pair_failed.set()
+            elif text.startswith("MSG:"):
+                latency = message_latency(text[4:])
+                if latency is None:
+                    self.stats.malformed += 1
+                else:
+                    self.stats.received += 1
+                    self.stats.latencies.append(latency)
+            elif text.startswith("FILE:"):
+                # Tell the sender we are ready, as clientgui3 does
+                self.incoming[frame.stream_id] = [0, time.perf_counter()]
+                self.send_text("ACK", frame.stream_id)
+            elif frame.stream_id in self.replies:
+                self.replies[frame.stream_id].put_nowait(text)
+
+    async def send_file(self, size, chunk, window, timeout):
+        stream_id = next(self.stream_ids)
+        replies = self.replies[stream_id] = asyncio.Queue()
+        state = self.acked[stream_id] = [0, asyncio.Event()]
+        try:
+            self.send_text(f"FILE:loadgen-{self.index}-{stream_id}.bin:{size}", stream_id)
+            reply = await asyncio.wait_for(replies.get(), timeout)
+            if reply != "ACK":
+                raise ConnectionError(f"Transfer refused: {reply}")
+
+            data = os.urandom(min(chunk, size))
+            sent = 0
+            while sent < size:
+                n = min(chunk, size - sent)
+                while sent + n - state[0] > window:
+                    state[1].clear()
+                    await asyncio.wait_for(state[1].wait(), timeout)
+                self.send(framing.FILECHUNK, data[:n], stream_id, framing.FLAG_WINDOWED)
+                sent += n
+                await self.writer.drain()
+            while state[0] < size:
+                state[1].clear()
+                await asyncio.wait_for(state[1].wait(), timeout)
+            self.send(framing.EOF, b"", stream_id)
+            await self.writer.drain()
+        finally:
+            del self.replies[stream_id]
+            del self.acked[stream_id]
+
+
+async def server6_pair(a, b, timeout):
+    """Pairs ``a`` with ``b``, asking again while the server does not know ``b`` yet.
+
+    A connection is accepted before the server registers it, so a PAIR
+    sent as soon as both have connected may be answered with PAIR_FAILED.
+    """
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    delay = PAIR_RETRY
+    try:
+        while True:
+            a.pair_failed.clear()
+            a.send_text(f"PAIR:{b.ip}")
+            await a.writer.drain()
+            answered = [asyncio.ensure_future(event.wait()) for event in (a.paired, a.pair_failed)]
+            try:
+                await asyncio.wait_for(asyncio.wait(answered, return_when=asyncio.FIRST_COMPLETED),
+                                       deadline - loop.time())
+            finally:
+                for waiter in answered:
+                    waiter.cancel()
+            if a.paired.is_set():
+                break
+            await asyncio.sleep(min(delay, max(deadline - loop.time(), 0)))
+            delay = min(delay * 2, PAIR_RETRY_MAX)
+        await asyncio.wait_for(b.paired.wait(), max(deadline - loop.time(), 0))
+    except asyncio.TimeoutError:
+        raise TimeoutError("no PAIR_SUCCESS before --reply-timeout") from None
+
+
+async def server6_messages(client, index, args, stats):
+    async for seq in paced(args.duration, args.rate):
+        client.send_text(make_message(index, seq))
+        stats.sent += 1
+        await client.writer.drain()
+
+
+async def server6_files(client, index, args, stats):
+    for _ in range(args.files):
+        stats.file_transfers += 1
+        await client.send_file(args.file_size, args.chunk, args.window, args.reply_timeout)
+
+
+async def run_server6(args, stats):
+    connections = await open_clients(args, stats, bind_source=True)
+    clients = [Server6Client(reader, writer, i, stats) for i, (reader, writer) in enumerate(connections)]
+    results = await asyncio.gather(*(server6_pair(a, b, args.reply_timeout)
+                                     for a, b in zip(clients[0::2], clients[1::2])),
+                                   return_exceptions=True)
+    paired = [client for client in clients if client.paired.is_set()]
+    for result in results:
+        if isinstance(result, Exception):
+            stats.error(result)
+
+    # Files go one way per pair, from the client that asked to pair
+    senders = [(client,) for client in paired if client.index % 2 == 0][:args.file_clients]
+    await run_phases([(client,) for client in paired], senders, args, stats, server6_messages, server6_files)
+    # Receivers count a transfer when its EOF arrives
+    await asyncio.sleep(args.settle)
+    for client in clients:
+        client.task.cancel()
+    await close_all(connections)
+
+
+SCENARIOS = {"server": run_chat, "server3": run_server3, "server6": run_server6}
+
+
+def raise_fd_limit():
+    """Lifts the open-file soft limit to the hard limit, where supported."""
+    try:
+        import resource
+    except ImportError:
+        return None
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+            soft = hard
+        except (ValueError, OSError):
+            pass
+    return soft
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("server", choices=SERVERS, help="which server's protocol to speak")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=12345)
+    parser.add_argument("--clients", type=int, default=100)
+    parser.add_argument("--ramp-step", type=int, default=100,
+                        help="connections opened at once while ramping up")
+    parser.add_argument("--connect-timeout", type=float, default=10.0)
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds of message traffic")
+    parser.add_argument("--rate", type=float, default=1.0,
+                        help="messages per second per client (0: as fast as possible)")
+    parser.add_argument("--observers", type=int, default=10,
+                        help="server: clients that record latency for the broadcasts they receive")
+    parser.add_argument("--file-clients", type=int, default=10, help="clients that send files")
+    parser.add_argument("--files", type=int, default=1, help="files per sending client")
+    parser.add_argument("--file-size", type=int, default=4 * 1024 * 1024)
+    parser.add_argument("--chunk", type=int, default=65000, help="server6 FILECHUNK payload size")
+    parser.add_argument("--window", type=int, default=transfer.DEFAULT_WINDOW,
+                        help="server6 unacknowledged bytes per transfer")
+    parser.add_argument("--reply-timeout", type=float, default=30.0)
+    parser.add_argument("--settle", type=float, default=1.0,
+                        help="seconds to wait for in-flight traffic after each phase")
+    parser.add_argument("--label", default="", help="free-form tag stored in the report")
+    parser.add_argument("--output", help="append the JSON report as one line to this file")
+    args = parser.parse_args()
+
+    limit = raise_fd_limit()
+    if limit is not None and limit < args.clients + 64:
+        print(f"[!] Open-file limit is {limit}, connections will fail before {args.clients}", file=sys.stderr)
+
+    stats = Stats()
+    asyncio.run(SCENARIOS[args.server](args, stats))
+    report = stats.report(args.server, args)
+
+    line = json.dumps(report)
+    if args.output:
+        with open(args.output, "a") as f:
+            f.write(line + "\n")
+    print(line)
+    print(f"[*] {report['connections']['established']} connections, "
+          f"{report['messages']['per_sec']} msg/s, latency {report['messages']['latency_ms']}, "
+          f"files {report['files']['mb_per_sec']} MB/s", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,279 @@
+import bisect
+import os
+import sys
+import threading
+import time
+
+# Log levels, as in the logging module
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+LEVELS = {"debug": DEBUG, "info": INFO, "warning": WARNING, "error": ERROR}
+
+# Histogram bucket upper bounds
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+SIZE_BUCKETS = (64, 256, 1024, 4096, 16384, 65536, 262144, 1048576)
+
+
+def _escape(label):
+    """Escapes a label value, which may be e.g. a file name, for the text format."""
+    return str(label).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class Counter:
+    """Monotonic count, e.g. frames relayed."""
+
+    kind = "counter"
+
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help = help_text
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def samples(self):
+        yield self.name, "", self.value
+
+
+class Gauge:
+    """Value that goes up and down, e.g. connected clients."""
+
+    kind = "gauge"
+
+    def __init__(self, name, help_text, func=None):
+        self.name = name
+        self.help = help_text
+        self.value = 0
+        # Read at export time instead of being set, if given
+        self.func = func
+
+    def set(self, value):
+        self.value = value
+
+    def samples(self):
+        yield self.name, "", self.func() if self.func is not None else self.value
+
+
+class LabeledGauge:
+    """Gauge with one value per label set, e.g. per upload, read at export time.
+
+    ``func`` returns ``(labels, value)`` pairs, labels being a dict.
+    """
+
+    kind = "gauge"
+
+    def __init__(self, name, help_text, func):
+        self.name = name
+        self.help = help_text
+        self.func = func
+
+    def samples(self):
+        for labels, value in self.func():
+            yield self.name, ",".join(f'{key}="{_escape(label)}"' for key, label in labels.items()), value
+
+
+class Histogram:
+    """Observations counted into fixed buckets, plus their sum and count."""
+
+    kind = "histogram"
+
+    def __init__(self, name, help_text, buckets):
+        self.name = name
+        self.help = help_text
+        self.buckets = tuple(buckets)
+        # One slot per bucket plus +Inf
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+    def samples(self):
+        with self._lock:
+            counts, total, count = list(self.counts), self.sum, self.count
+        cumulative = 0
+        for bound, n in zip(self.buckets + (float("inf"),), counts):
+            cumulative += n
+            le = "+Inf" if bound == float("inf") else str(bound)
+            yield f"{self.name}_bucket", f'le="{le}"', cumulative
+        yield f"{self.name}_sum", "", total
+        yield f"{self.name}_count", "", count
+
+
+class ConnectionBytes:
+    """Bytes received from and sent to each live connection.
+
+    Entries are dropped on disconnect and their totals folded into the
+    ``closed`` counts, so the table only grows with live connections.
+    """
+
+    kind = "counter"
+
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help = help_text
+        # address -> [received, sent]
+        self.live = {}
+        self.closed = [0, 0]
+        self._lock = threading.Lock()
+
+    def add(self, address, received=0, sent=0):
+        with self._lock:
+            totals = self.live.get(address)
+            if totals is None:
+                totals = self.live[address] = [0, 0]
+            totals[0] += received
+            totals[1] += sent
+
+    def sent(self, address):
+        """Bytes sent to a live connection so far, 0 if it is not known."""
+        totals = self.live.get(address)
+        return totals[1] if totals is not None else 0
+
+    def remove(self, address):
+        """Forgets a closed connection; returns its [received, sent] totals."""
+        with self._lock:
+            totals = self.live.pop(address, None)
+            if totals is not None:
+                self.closed[0] += totals[0]
+                self.closed[1] += totals[1]
+            return totals
+
+    def samples(self):
+        with self._lock:
+            rows = [(f"{address[0]}:{address[1]}", totals) for address, totals in self.live.items()]
+            rows.append(("closed", list(self.closed)))
+        for peer, (received, sent) in rows:
+            yield self.name, f'peer="{peer}",direction="rx"', received
+            yield self.name, f'peer="{peer}",direction="tx"', sent
+
+
+class Registry:
+    """Named metrics of one process, exported as Prometheus text."""
+
+    def __init__(self, prefix=""):
+        self.prefix = prefix
+        self._metrics = []
+
+    def _register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, help_text):
+        return self._register(Counter(self.prefix + name, help_text))
+
+    def gauge(self, name, help_text, func=None):
+        return self._register(Gauge(self.prefix + name, help_text, func))
+
+    def labeled_gauge(self, name, help_text, func):
+        return self._register(LabeledGauge(self.prefix + name, help_text, func))
+
+    def histogram(self, name, help_text, buckets):
+        return self._register(Histogram(self.prefix + name, help_text, buckets))
+
+    def connection_bytes(self, name, help_text):
+        return self._register(ConnectionBytes(self.prefix + name, help_text))
+
+    def render(self):
+        """Returns every metric in the Prometheus text exposition format."""
+        lines = []
+        for metric in self._metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for name, labels, value in metric.samples():
+                lines.append(f"{name}{{{labels}}} {value}" if labels else f"{name} {value}")
+        return "\n".join(lines) + "\n"
+
+    def write(self, path):
+        """Writes a snapshot to ``path``, replacing it atomically."""
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            f.write(self.render())
+        os.replace(tmp_path, path)
+
+    def export_every(self, path, interval):
+        """Starts a daemon thread that rewrites the snapshot every ``interval`` seconds."""
+        def run():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.write(path)
+                except OSError as e:
+                    print(f"[-] Could not write metrics to {path}: {e}", file=sys.stderr)
+
+        thread = threading.Thread(target=run, name="metrics-export", daemon=True)
+        thread.start()
+        return thread
+
+
+class Log:
+    """Leveled logging with per-key rate limiting for hot paths.
+
+    ``log.info(...)`` and friends print when the level is enabled.
+    ``log.sampled(key, ...)`` prints at most once per ``interval`` seconds
+    for each key and reports how many lines were suppressed in between, so
+    a per-chunk message costs a dict lookup instead of a write to stdout.
+    At DEBUG every sampled line is printed. Callers check ``enabled(level)``
+    before building an expensive message.
+    """
+
+    def __init__(self, level=INFO, interval=1.0):
+        self.level = level
+        self.interval = interval
+        # key -> [next allowed time, suppressed count]
+        self._sampled = {}
+        self._lock = threading.Lock()
+
+    def enabled(self, level):
+        return level >= self.level
+
+    def log(self, level, message):
+        if level >= self.level:
+            print(message)
+
+    def debug(self, message):
+        self.log(DEBUG, message)
+
+    def info(self, message):
+        self.log(INFO, message)
+
+    def warning(self, message):
+        self.log(WARNING, message)
+
+    def error(self, message):
+        self.log(ERROR, message)
+
+    def sampled(self, key, message, level=INFO):
+        """Logs ``message`` unless ``key`` was logged less than ``interval`` seconds ago."""
+        if level < self.level:
+            return
+        if self.level <= DEBUG:
+            print(message)
+            return
+        now = time.monotonic()
+        with self._lock:
+            state = self._sampled.get(key)
+            if state is not None and now < state[0]:
+                state[1] += 1
+                return
+            suppressed = state[1] if state is not None else 0
+            self._sampled[key] = [now + self.interval, 0]
+        if suppressed:
+            message = f"{message} ({suppressed} similar suppressed)"
+        print(message)
+
+    def forget(self, key):
+        """Drops the rate-limit state of ``key``, e.g. when its connection closes."""
+        with self._lock:
+            self._sampled.pop(key, None)
@@ -0,0 +1,340 @@
+import os
+import shutil
+import struct
+import threading
+import time
+from collections import namedtuple
+
+# Undelivered bytes kept per recipient, and how long they are kept at most
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+DEFAULT_MAX_AGE = 7 * 24 * 3600
+# A recipient's log is split into segment files of about this size
+SEGMENT_BYTES = 16 * 1024 * 1024
+
+SEGMENT_SUFFIX = ".seg"
+CURSOR_FILE = "cursor"
+
+# Each record: time queued, frame type, flags, stream id, payload length
+RECORD = struct.Struct("!dBBII")
+# Persisted read position: segment number, offset in that segment
+CURSOR = struct.Struct("!QQ")
+
+Record = namedtuple("Record", ["timestamp", "type", "flags", "stream_id", "payload"])
+
+
+def _directory_name(recipient):
+    # IPv6 addresses cannot be used as file names everywhere; IPs have no "_"
+    return recipient.replace(":", "_")
+
+
+class _Recipient:
+    """Segments and read position of one recipient's log."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        # [segment number, size], oldest first; the last one is appended to
+        self.segments = []
+        self.cursor = (0, 0)
+        self.writer = None
+        self.reader = None
+        self.reader_number = None
+        # Set once the recipient is forgotten; appends then start a new one
+        self.closed = False
+        self.cond = threading.Condition()
+
+    def path(self, number):
+        return os.path.join(self.directory, f"{number:016d}{SEGMENT_SUFFIX}")
+
+    @property
+    def size(self):
+        total = sum(size for _, size in self.segments)
+        if self.segments and self.segments[0][0] == self.cursor[0]:
+            total -= self.cursor[1]
+        return total
+
+    def close(self):
+        self.closed = True
+        self.close_files()
+
+    def close_files(self):
+        for f in (self.writer, self.reader):
+            if f is not None:
+                f.close()
+        self.writer = self.reader = self.reader_number = None
+
+
+class OfflineQueue:
+    """Durable store-and-forward queue of frames for clients that are offline.
+
+    Frames for a recipient (an IP, which is what clients pair by) are
+    appended to a log split into numbered segment files under
+    ``directory/<ip>/``. A drain reads them back in order from a position
+    it advances itself; ``commit`` persists that position and deletes the
+    segments read to the end, so delivery is at least once: whatever was
+    read after the last commit is read again after a restart. A recipient
+    may hold ``max_bytes`` undelivered bytes, and segments whose newest
+    frame is older than ``max_age`` seconds are dropped unread.
+
+    Records are flushed but not fsynced, so a relay crash loses nothing
+    while a machine crash may lose the last few frames.
+    """
+
+    def __init__(self, directory, max_bytes=DEFAULT_MAX_BYTES, max_age=DEFAULT_MAX_AGE,
+                 segment_bytes=SEGMENT_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.segment_bytes = segment_bytes
+        self.expired_bytes = 0
+        # recipient -> _Recipient, only while it has undelivered frames
+        self._recipients = {}
+        self._lock = threading.Lock()
+        self._next_sweep = 0.0
+
+        os.makedirs(directory, exist_ok=True)
+        self._load()
+        self.expire()
+
+    def _load(self):
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if not os.path.isdir(path):
+                continue
+            state = _Recipient(path)
+            for entry in os.listdir(path):
+                number, suffix = os.path.splitext(entry)
+                if suffix == SEGMENT_SUFFIX and number.isdigit():
+                    state.segments.append([int(number), os.path.getsize(os.path.join(path, entry))])
+            state.segments.sort()
+            if state.segments:
+                self._truncate_partial(state)
+                state.cursor = self._read_cursor(state)
+            if state.size:
+                self._recipients[name.replace("_", ":")] = state
+            else:
+                shutil.rmtree(path, ignore_errors=True)
+
+    def _truncate_partial(self, state):
+        """Drops a record the relay was writing when it stopped."""
+        number, size = state.segments[-1]
+        end = 0
+        with open(state.path(number), "r+b") as f:
+            while end + RECORD.size <= size:
+                f.seek(end)
+                length = RECORD.unpack(f.read(RECORD.size))[4]
+                if end + RECORD.size + length > size:
+                    break
+                end += RECORD.size + length
+            if end != size:
+                f.truncate(end)
+                state.segments[-1][1] = end
+
+    def _read_cursor(self, state):
+        first = state.segments[0][0]
+        try:
+            with open(os.path.join(state.directory, CURSOR_FILE), "rb") as f:
+                number, offset = CURSOR.unpack(f.read(CURSOR.size))
+        except (OSError, struct.error):
+            return (first, 0)
+        sizes = dict(state.segments)
+        if number not in sizes or offset > sizes[number]:
+            return (first, 0)
+        return (number, offset)
+
+    def __contains__(self, recipient):
+        return recipient in self._recipients
+
+    def pending(self, recipient):
+        """True while ``recipient`` has frames that were not delivered yet."""
+        return recipient in self._recipients
+
+    @property
+    def total_bytes(self):
+        with self._lock:
+            return sum(state.size for state in self._recipients.values())
+
+    def room(self, recipient):
+        """Bytes that can still be queued for ``recipient``."""
+        with self._lock:
+            state = self._recipients.get(recipient)
+            return self.max_bytes - (state.size if state is not None else 0)
+
+    def append(self, recipient, frame_type, payload=b"", stream_id=0, flags=0, force=False):
+        """Queues one frame for ``recipient``.
+
+        Returns False if that would take it over ``max_bytes``, unless
+        ``force`` is set (for the rest of a file whose size was checked
+        against ``room`` when it was announced).
+        """
+        record = RECORD.pack(time.time(), frame_type, flags, stream_id, len(payload))
+        while True:
+            with self._lock:
+                state = self._recipients.get(recipient)
+                if state is None:
+                    state = _Recipient(os.path.join(self.directory, _directory_name(recipient)))
+                    self._recipients[recipient] = state
+                if not force and state.size + len(record) + len(payload) > self.max_bytes:
+                    if not state.segments:
+                        del self._recipients[recipient]
+                    return False
+                sweep = time.monotonic() >= self._next_sweep
+
+            with state.cond:
+                # A drain may have finished with it in between
+                if state.closed:
+                    continue
+                if state.writer is None or state.segments[-1][1] >= self.segment_bytes:
+                    self._roll(state)
+                state.writer.write(record)
+                state.writer.write(payload)
+                state.writer.flush()
+                state.segments[-1][1] += len(record) + len(payload)
+                state.cond.notify_all()
+                break
+        if sweep:
+            self.expire()
+        return True
+
+    def _roll(self, state):
+        """Starts appending to a new segment (or reopens the last one after a restart)."""
+        if state.writer is not None:
+            state.writer.close()
+            state.writer = None
+        if not state.segments or state.segments[-1][1] >= self.segment_bytes:
+            number = state.segments[-1][0] + 1 if state.segments else 0
+            state.segments.append([number, 0])
+            if len(state.segments) == 1:
+                state.cursor = (number, 0)
+        os.makedirs(state.directory, exist_ok=True)
+        state.writer = open(state.path(state.segments[-1][0]), "ab")
+
+    def start(self, recipient):
+        """Returns the position a drain of ``recipient`` starts reading at."""
+        state = self._recipients.get(recipient)
+        return state.cursor if state is not None else None
+
+    def read(self, recipient, position):
+        """Returns ``(record, next_position)``, or ``(None, position)`` if nothing follows ``position``.
+
+        A position in a segment that expired meanwhile continues with the
+        oldest segment left.
+        """
+        state = self._recipients.get(recipient)
+        if state is None:
+            return None, position
+        with state.cond:
+            number, offset = position
+            for index, (segment, size) in enumerate(state.segments):
+                if segment < number:
+                    continue
+                if segment > number:
+                    number, offset = segment, 0
+                if offset + RECORD.size <= size:
+                    break
+                if index + 1 == len(state.segments):
+                    return None, (number, offset)
+            else:
+                return None, position
+
+            if state.reader_number != number:
+                if state.reader is not None:
+                    state.reader.close()
+                state.reader = open(state.path(number), "rb")
+                state.reader_number = number
+            state.reader.seek(offset)
+            timestamp, frame_type, flags, stream_id, length = RECORD.unpack(state.reader.read(RECORD.size))
+            payload = state.reader.read(length)
+        record = Record(timestamp, frame_type, flags, stream_id, payload)
+        return record, (number, offset + RECORD.size + length)
+
+    def wait(self, recipient, position, timeout=1.0):
+        """Waits up to ``timeout`` seconds for a frame to be queued after ``position``."""
+        state = self._recipients.get(recipient)
+        if state is None:
+            return
+        with state.cond:
+            last, size = state.segments[-1] if state.segments else (None, 0)
+            if position == (last, size):
+                state.cond.wait(timeout)
+
+    def commit(self, recipient, position):
+        """Records that everything before ``position`` was delivered."""
+        state = self._recipients.get(recipient)
+        if state is None:
+            return
+        with state.cond:
+            self._commit(state, position)
+
+    def _commit(self, state, position):
+        while len(state.segments) > 1 and state.segments[0][0] < position[0]:
+            number, _ = state.segments.pop(0)
+            if state.reader_number == number:
+                state.reader.close()
+                state.reader = state.reader_number = None
+            try:
+                os.remove(state.path(number))
+            except OSError:
+                pass
+        state.cursor = position
+        tmp_path = os.path.join(state.directory, CURSOR_FILE + ".tmp")
+        with open(tmp_path, "wb") as f:
+            f.write(CURSOR.pack(*position))
+        os.replace(tmp_path, os.path.join(state.directory, CURSOR_FILE))
+
+    def finish(self, recipient, position):
+        """Ends a drain that read up to ``position``.
+
+        Returns True and forgets ``recipient`` if nothing was queued after
+        ``position``; otherwise returns False, and the drain should go on.
+        """
+        with self._lock:
+            state = self._recipients.get(recipient)
+            if state is None:
+                return True
+            with state.cond:
+                if state.segments and position != tuple(state.segments[-1]):
+                    return False
+                del self._recipients[recipient]
+                state.close()
+            # Still locked, so no append can start a new log in the directory
+            shutil.rmtree(state.directory, ignore_errors=True)
+        return True
+
+    def expire(self):
+        """Drops segments whose newest frame is older than ``max_age``; returns the bytes dropped."""
+        now = time.time()
+        self._next_sweep = time.monotonic() + min(self.max_age / 10, 60)
+        dropped = 0
+        with self._lock:
+            for recipient, state in list(self._recipients.items()):
+                with state.cond:
+                    while state.segments:
+                        number, size = state.segments[0]
+                        path = state.path(number)
+                        try:
+                            if os.path.getmtime(path) >= now - self.max_age:
+                                break
+                        except OSError:
+                            pass
+                        if state.cursor[0] == number:
+                            size -= state.cursor[1]
+                        dropped += size
+                        state.segments.pop(0)
+                        if len(state.segments) == 0:
+                            state.close_files()
+                        elif state.reader_number == number:
+                            state.reader.close()
+                            state.reader = state.reader_number = None
+                        try:
+                            os.remove(path)
+                        except OSError:
+                            pass
+                    if state.segments:
+                        if state.cursor[0] < state.segments[0][0]:
+                            state.cursor = (state.segments[0][0], 0)
+                    else:
+                        del self._recipients[recipient]
+                        state.close()
+                        shutil.rmtree(state.directory, ignore_errors=True)
+        self.expired_bytes += dropped
+        return dropped
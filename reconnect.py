@@ -0,0 +1,35 @@
+import random
+
+# The first retry comes within BASE_DELAY seconds; each failure doubles the
+# range, up to MAX_DELAY
+BASE_DELAY = 0.25
+MAX_DELAY = 30.0
+# A connection that stayed up this long starts the next backoff from scratch
+STABLE_AFTER = 10.0
+
+
+class Backoff:
+    """Exponential backoff with full jitter for reconnecting to the relay.
+
+    Retry ``n`` (counting from 0) waits a uniformly random time between 0
+    and ``min(cap, base * 2**n)``. When a relay restarts, all its clients
+    lose their connection at once; spreading their first retries over
+    ``base`` seconds keeps them from arriving in one burst while still
+    bringing them back within a fraction of a second.
+    """
+
+    def __init__(self, base=BASE_DELAY, cap=MAX_DELAY, rng=None):
+        self.base = base
+        self.cap = cap
+        self.attempts = 0
+        self._random = rng if rng is not None else random.Random()
+
+    def next_delay(self):
+        """Returns how long to wait before the next attempt."""
+        # The exponent is bounded so the range stops growing once capped
+        ceiling = min(self.cap, self.base * 2 ** min(self.attempts, 32))
+        self.attempts += 1
+        return self._random.uniform(0, ceiling)
+
+    def reset(self):
+        self.attempts = 0
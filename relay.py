@@ -0,0 +1,71 @@
+import os
+
+# os.splice exists on Linux with Python 3.10+
+SPLICE_AVAILABLE = hasattr(os, "splice")
+
+# Pipe capacity to request for splicing (the kernel default is 64KB)
+PIPE_SIZE = 1024 * 1024
+
+# Payload remainders smaller than this are cheaper to read the normal way
+MIN_SPLICE_BYTES = 16 * 1024
+
+
+class SpliceRelay:
+    """Moves bytes between two sockets through a kernel pipe with os.splice.
+
+    The data never enters the Python process: each hop is a single splice
+    from the source socket into the pipe and from the pipe into the
+    destination socket. One instance (one pipe) per relaying thread.
+    """
+
+    def __init__(self, pipe_size=PIPE_SIZE):
+        if not SPLICE_AVAILABLE:
+            raise OSError("os.splice is not available on this platform")
+        self.read_fd, self.write_fd = os.pipe()
+        try:
+            import fcntl
+            fcntl.fcntl(self.write_fd, fcntl.F_SETPIPE_SZ, pipe_size)
+        except (ImportError, AttributeError, OSError):
+            pass  # Keep the default pipe size
+
+    def forward(self, src_fd, dst_fd, nbytes):
+        """Forwards exactly ``nbytes`` from ``src_fd`` to ``dst_fd``.
+
+        Blocks like ``recv``/``sendall`` on blocking sockets. Raises
+        ConnectionError if the source closes before ``nbytes`` arrive. If the
+        destination fails, the rest of the payload is still consumed from
+        the source (and discarded) before the error is raised, so the source
+        stream stays in sync.
+        """
+        remaining = nbytes
+        while remaining:
+            filled = os.splice(src_fd, self.write_fd, remaining, flags=os.SPLICE_F_MOVE)
+            if filled == 0:
+                raise ConnectionError(f"Source closed with {remaining} bytes left to relay")
+            remaining -= filled
+            # Drain the pipe completely so it is empty for the next call
+            try:
+                while filled:
+                    filled -= os.splice(self.read_fd, dst_fd, filled, flags=os.SPLICE_F_MOVE)
+            except OSError:
+                self._discard(filled)
+                self._skip(src_fd, remaining)
+                raise
+
+    def _discard(self, nbytes):
+        """Empties ``nbytes`` left in the pipe."""
+        while nbytes:
+            nbytes -= len(os.read(self.read_fd, min(nbytes, PIPE_SIZE)))
+
+    def _skip(self, src_fd, nbytes):
+        """Consumes and drops ``nbytes`` from the source."""
+        while nbytes:
+            filled = os.splice(src_fd, self.write_fd, nbytes)
+            if filled == 0:
+                return
+            self._discard(filled)
+            nbytes -= filled
+
+    def close(self):
+        os.close(self.read_fd)
+        os.close(self.write_fd)
@@ -0,0 +1,132 @@
+import hashlib
+import json
+import os
+
+# A partial file is kept as <target>.part, described by <target>.part.json
+PARTIAL_SUFFIX = ".part"
+MANIFEST_SUFFIX = ".part.json"
+
+# Block size for hashing the prefix of a file
+HASH_BLOCK = 1024 * 1024
+
+
+def transfer_id(path):
+    """Returns an ID for sending ``path`` that stays the same across reconnects.
+
+    Derived from the name, size and modification time, so a file that
+    changed since the interrupted attempt gets a new ID and starts over.
+    """
+    st = os.stat(path)
+    key = f"{os.path.basename(path)}\0{st.st_size}\0{st.st_mtime_ns}"
+    return hashlib.sha1(key.encode("utf-8")).hexdigest()[:16]
+
+
+def hash_prefix(path, length):
+    """Returns a sha256 object fed with the first ``length`` bytes of ``path``.
+
+    Raises ValueError if the file is shorter than ``length``.
+    """
+    hasher = hashlib.sha256()
+    remaining = length
+    with open(path, "rb") as f:
+        while remaining:
+            block = f.read(min(HASH_BLOCK, remaining))
+            if not block:
+                raise ValueError(f"{path} is shorter than {length} bytes")
+            hasher.update(block)
+            remaining -= len(block)
+    return hasher
+
+
+class Manifest:
+    """What the receiver knows about a partially received file.
+
+    ``offset`` bytes of the ``.part`` file are on disk and ``digest`` is the
+    sha256 of exactly those bytes. The manifest is only rewritten after the
+    data it describes has been synced, so after a crash it never claims more
+    than the disk holds.
+    """
+
+    def __init__(self, target_path, transfer_id, size, offset=0, digest=None):
+        self.target_path = target_path
+        self.transfer_id = transfer_id
+        self.size = size
+        self.offset = offset
+        self.digest = digest if digest is not None else hashlib.sha256().hexdigest()
+
+    @property
+    def path(self):
+        return self.target_path + MANIFEST_SUFFIX
+
+    @property
+    def partial_path(self):
+        return self.target_path + PARTIAL_SUFFIX
+
+    @classmethod
+    def load(cls, target_path):
+        """Returns the manifest saved for ``target_path``, or None."""
+        try:
+            with open(target_path + MANIFEST_SUFFIX) as f:
+                data = json.load(f)
+            return cls(target_path, data["transfer_id"], data["size"], data["offset"], data["digest"])
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def update(self, offset, digest):
+        """Records that ``offset`` bytes hashing to ``digest`` are on disk."""
+        self.offset = offset
+        self.digest = digest
+        self.save()
+
+    def reset(self):
+        """Starts the partial copy over; returns a fresh sha256 object for it."""
+        hasher = hashlib.sha256()
+        self.update(0, hasher.hexdigest())
+        return hasher
+
+    def save(self):
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({
+                "transfer_id": self.transfer_id,
+                "size": self.size,
+                "offset": self.offset,
+                "digest": self.digest,
+            }, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+
+    def remove(self):
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+
+def find_resumable(target_path, transfer_id, size):
+    """Looks for a verified partial copy of a transfer that is being offered again.
+
+    Returns ``(manifest, hasher)``: the manifest to keep updating, and a
+    sha256 object fed with the partial file's first ``manifest.offset``
+    bytes. The partial file is re-hashed and checked against the manifest,
+    so a copy damaged on disk starts over from 0 instead of being resumed.
+    """
+    manifest = Manifest.load(target_path)
+    if (manifest is not None and manifest.transfer_id == transfer_id and manifest.size == size
+            and 0 < manifest.offset <= size):
+        try:
+            hasher = hash_prefix(manifest.partial_path, manifest.offset)
+        except (OSError, ValueError):
+            hasher = None
+        if hasher is not None and hasher.hexdigest() == manifest.digest:
+            return manifest, hasher
+    return Manifest(target_path, transfer_id, size), hashlib.sha256()
+
+
+def verify_offer(path, offset, digest):
+    """Sender side: True if the receiver's first ``offset`` bytes match ``path``."""
+    try:
+        return 0 < offset <= os.path.getsize(path) and hash_prefix(path, offset).hexdigest() == digest
+    except (OSError, ValueError):
+        return False
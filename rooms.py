@@ -0,0 +1,142 @@
+import threading
+from collections import deque
+
+import fanout
+
+# Threads handing published messages to room members. A room is always
+# delivered by the same one, so members see its messages in publish order
+DEFAULT_WORKERS = 2
+
+
+class RoomHub:
+    """Named rooms of connections, each represented by its ``fanout.Outbox``.
+
+    Membership is indexed both ways, room -> members and member -> rooms,
+    so joining, leaving and dropping a disconnected member touch only the
+    rooms involved. ``publish`` does no per-member work: it appends the
+    encoded message, shared by every member, to a worker's queue and
+    returns. The worker puts it on each member's Outbox, whose writer
+    thread sends it. Messages that pile up while a worker is busy are
+    delivered per room as one buffer per member, so a busy 10k-member room
+    costs one pass over its members per batch rather than per message. The
+    member list is a tuple cached until membership changes.
+
+    Publishers do not get their own messages back, as with ``broadcast``.
+    """
+
+    def __init__(self, workers=DEFAULT_WORKERS, batch_bytes=fanout.BATCH_BYTES):
+        self.batch_bytes = batch_bytes
+        # room -> set of members, member -> set of rooms
+        self._members = {}
+        self._rooms = {}
+        # room -> tuple of its members, dropped whenever they change
+        self._snapshots = {}
+        self._lock = threading.Lock()
+        self._workers = [_Worker(self, number) for number in range(workers)]
+
+    def join(self, room, member):
+        """Adds ``member`` to ``room``; returns how many members it has now."""
+        with self._lock:
+            members = self._members.setdefault(room, set())
+            if member not in members:
+                members.add(member)
+                self._rooms.setdefault(member, set()).add(room)
+                self._snapshots.pop(room, None)
+            return len(members)
+
+    def leave(self, room, member):
+        """Removes ``member`` from ``room``; returns False if it was not in it."""
+        with self._lock:
+            return self._leave(room, member)
+
+    def _leave(self, room, member):
+        members = self._members.get(room)
+        if members is None or member not in members:
+            return False
+        members.discard(member)
+        if not members:
+            del self._members[room]
+        self._snapshots.pop(room, None)
+        rooms = self._rooms[member]
+        rooms.discard(room)
+        if not rooms:
+            del self._rooms[member]
+        return True
+
+    def leave_all(self, member):
+        """Removes a disconnected member from every room; returns the rooms it was in."""
+        with self._lock:
+            rooms = list(self._rooms.get(member, ()))
+            for room in rooms:
+                self._leave(room, member)
+            return rooms
+
+    def is_member(self, room, member):
+        return room in self._rooms.get(member, ())
+
+    def rooms_of(self, member):
+        with self._lock:
+            return set(self._rooms.get(member, ()))
+
+    def members(self, room):
+        """Returns the members of ``room`` as a tuple, rebuilt only after it changed."""
+        with self._lock:
+            snapshot = self._snapshots.get(room)
+            if snapshot is None:
+                snapshot = self._snapshots[room] = tuple(self._members.get(room, ()))
+            return snapshot
+
+    def __len__(self):
+        return len(self._members)
+
+    def publish(self, room, data, exclude=None):
+        """Queues ``data`` for every member of ``room`` except ``exclude`` and returns at once."""
+        self._workers[hash(room) % len(self._workers)].put(room, data, exclude)
+
+    def _deliver(self, room, messages):
+        """Puts a room's pending ``(data, publisher)`` messages on its members' outboxes."""
+        combined = b"".join(data for data, _ in messages)
+        # The few members that published some of them get the rest only
+        own = {publisher: b"".join(data for data, sender in messages if sender is not publisher)
+               for _, publisher in messages if publisher is not None}
+        for member in self.members(room):
+            data = own.get(member, combined) if own else combined
+            if data:
+                member.put(data)
+
+
+class _Worker:
+    """Delivers the messages published to its share of the rooms."""
+
+    def __init__(self, hub, number):
+        self.hub = hub
+        self._pending = deque()
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name=f"rooms-{number}", daemon=True)
+        self._thread.start()
+
+    def put(self, room, data, publisher):
+        with self._cond:
+            self._pending.append((room, data, publisher))
+            self._cond.notify()
+
+    def _take(self):
+        """Blocks for published messages; returns up to ``batch_bytes`` of them by room, in order."""
+        with self._cond:
+            while not self._pending:
+                self._cond.wait()
+            batches = {}
+            size = 0
+            while self._pending and size < self.hub.batch_bytes:
+                room, data, publisher = self._pending.popleft()
+                batches.setdefault(room, []).append((data, publisher))
+                size += len(data)
+            return batches
+
+    def _run(self):
+        while True:
+            for room, messages in self._take().items():
+                try:
+                    self.hub._deliver(room, messages)
+                except Exception as e:
+                    print(f"[-] Error delivering to room {room}: {e}")
@@ -1,32 +1,74 @@
+import argparse
 import socket
 import threading
 
-# List to store client connections
-clients = []
+import fanout
+import heartbeat
+import rooms
+import timerwheel
+
+# Connected clients: socket -> its outbound queue
+clients = {}
+clients_lock = threading.Lock()
+
+# Outbound queue settings, set by start_server
+max_queue_bytes = fanout.DEFAULT_MAX_BYTES
+slow_consumer_policy = fanout.DROP
+# Drops clients that stay silent too long, set up by start_server
+idle_monitor = None
+# Rooms clients joined, set up by start_server
+room_hub = None
+
+# Clients of a big room may all connect at once
+LISTEN_BACKLOG = 1024
+
+# Room commands; any other message still goes to every client
+ROOM_COMMANDS = (b"JOIN:", b"LEAVE:", b"ROOM:")
 
 
 # Function to handle client communication
 def handle_client(client_socket, client_address):
     print(f"New connection: {client_address}")
 
-    # Add client to the list
-    clients.append(client_socket)
+    # Add client to the list; its writer thread drains its queue
+    outbox = fanout.Outbox(client_socket, client_address, max_queue_bytes, slow_consumer_policy)
+    with clients_lock:
+        clients[client_socket] = outbox
+    liveness = idle_monitor.add(client_socket) if idle_monitor is not None else None
+    # Start of a room command whose newline has not arrived yet
+    partial = b""
 
     try:
         while True:
-            message = client_socket.recv(1024).decode('utf-8')
-            if not message:
+            data = client_socket.recv(1024)
+            if not data:
                 # If no message is received, it means the client has disconnected
                 break
+            if liveness is not None:
+                liveness.touch()
+            message = data.decode('utf-8', errors='replace')
             print(f"Message from {client_address}: {message}")
 
-            # Broadcast message to all clients
-            for client in clients:
-                if client != client_socket:
-                    try:
-                        client.send(message.encode('utf-8'))
-                    except:
-                        continue  # If the message cannot be sent, skip the client
+            if partial or data.startswith(ROOM_COMMANDS):
+                # Newline-terminated commands sent back to back may arrive in
+                # one read, or split across two
+                lines = (partial + data).split(b"\n")
+                rest = lines.pop()
+                for line in lines:
+                    if line.startswith(ROOM_COMMANDS):
+                        handle_room_command(outbox, line)
+                    elif line:
+                        fanout.broadcast(list(clients.values()), line + b"\n", exclude=outbox)
+                # Only a command waits for the rest of its line; other text
+                # after the last newline goes out now, as it always has
+                partial = rest if rest.startswith(ROOM_COMMANDS) else b""
+                if rest and not partial:
+                    fanout.broadcast(list(clients.values()), rest, exclude=outbox)
+                continue
+
+            # Broadcast message to all clients; the bytes are shared by every
+            # queue and a slow client only ever delays itself
+            fanout.broadcast(list(clients.values()), data, exclude=outbox)
     except (ConnectionResetError, BrokenPipeError):
         # If the client has unexpectedly disconnected
         print(f"{client_address} disconnected")
@@ -34,25 +76,100 @@ def handle_client(client_socket, client_address):
         print(f"Error: {e}")
     finally:
         # If a client disconnects, remove them from the client list
-        if client_socket in clients:
-            clients.remove(client_socket)
+        with clients_lock:
+            clients.pop(client_socket, None)
+        if idle_monitor is not None:
+            idle_monitor.remove(client_socket)
+        if room_hub is not None:
+            room_hub.leave_all(outbox)
+        outbox.close()
+        if outbox.dropped:
+            print(f"Dropped {outbox.dropped} messages for slow client {client_address}")
         client_socket.close()
         print(f"Connection with {client_address} closed.")
 
 
+def handle_room_command(outbox, line):
+    """JOIN:<room>, LEAVE:<room>, or ROOM:<room>:<text> to publish to a room one has joined."""
+    command, _, rest = line.decode('utf-8', errors='replace').partition(":")
+    if command == "JOIN":
+        room = rest.strip()
+        if room:
+            members = room_hub.join(room, outbox)
+            outbox.put(f"JOINED:{room}:{members}\n".encode('utf-8'))
+        return
+    if command == "LEAVE":
+        room = rest.strip()
+        reply = f"LEFT:{room}" if room_hub.leave(room, outbox) else f"ERROR: Not in room {room}"
+        outbox.put(f"{reply}\n".encode('utf-8'))
+        return
+
+    room, separator, _ = rest.partition(":")
+    if not separator or not room_hub.is_member(room, outbox):
+        outbox.put(f"ERROR: Not in room {room}\n".encode('utf-8'))
+        return
+    # Members get the line as it was sent, newline-terminated so they can
+    # tell messages apart; the same bytes go to all of them
+    room_hub.publish(room, line + b"\n", exclude=outbox)
+
+
+def disconnect_idle(client_socket, quiet):
+    outbox = clients.get(client_socket)
+    if outbox is not None:
+        print(f"Disconnecting {outbox.name}: nothing received for {quiet:.0f}s")
+    heartbeat.disconnect(client_socket)
+
+
 # Function to start the server
-def start_server(host='127.0.0.1', port=12345):
+def start_server(host='127.0.0.1', port=12345, queue_bytes=fanout.DEFAULT_MAX_BYTES, policy=fanout.DROP,
+                 idle_timeout=heartbeat.QUIET_IDLE_TIMEOUT, keepalive_interval=heartbeat.DEFAULT_HEARTBEAT_INTERVAL,
+                 room_workers=rooms.DEFAULT_WORKERS):
+    """Accepts clients until interrupted.
+
+    Room messages are handed to members by ``room_workers`` threads, so a
+    client publishing to a big room is never held up delivering it.
+
+    Clients of this server send raw text and cannot answer heartbeats, so
+    dead peers are found with TCP keepalive probes every
+    ``keepalive_interval`` seconds, and clients that send nothing for
+    ``idle_timeout`` seconds are dropped. 0 disables either.
+    """
+    global max_queue_bytes, slow_consumer_policy, idle_monitor, room_hub
+    max_queue_bytes = queue_bytes
+    slow_consumer_policy = policy
+    room_hub = rooms.RoomHub(room_workers)
+    wheel = timerwheel.TimerWheel()
+    idle_monitor = heartbeat.IdleMonitor(wheel, idle_timeout, on_idle=disconnect_idle)
+    wheel.start()
+
     server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     server.bind((host, port))
-    server.listen(5)
+    server.listen(LISTEN_BACKLOG)
     print(f"Server listening on {host}:{port}")
 
     while True:
         client_socket, client_address = server.accept()
+        if keepalive_interval:
+            heartbeat.enable_keepalive(client_socket, keepalive_interval)
         client_thread = threading.Thread(target=handle_client, args=(client_socket, client_address))
         client_thread.start()
 
 
 # Run the server
 if __name__ == "__main__":
-    start_server()
+    parser = argparse.ArgumentParser(description="Broadcast chat server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=12345)
+    parser.add_argument("--queue-bytes", type=int, default=fanout.DEFAULT_MAX_BYTES,
+                        help="outbound bytes buffered per client before the slow-consumer policy applies")
+    parser.add_argument("--slow-consumer", choices=fanout.POLICIES, default=fanout.DROP,
+                        help="what to do with a client whose queue is full")
+    parser.add_argument("--idle-timeout", type=float, default=heartbeat.QUIET_IDLE_TIMEOUT,
+                        help="seconds a client may send nothing before it is dropped (0: never)")
+    parser.add_argument("--heartbeat-interval", type=float, default=heartbeat.DEFAULT_HEARTBEAT_INTERVAL,
+                        help="seconds between TCP keepalive probes of an idle client (0: no probes)")
+    parser.add_argument("--room-workers", type=int, default=rooms.DEFAULT_WORKERS,
+                        help="threads delivering room messages to members")
+    args = parser.parse_args()
+    start_server(args.host, args.port, args.queue_bytes, args.slow_consumer, args.idle_timeout,
+                 args.heartbeat_interval, args.room_workers)
@@ -1,20 +1,28 @@
+import argparse
 import socket
 import threading
 
+import heartbeat
+import timerwheel
+
 clients = {}
 
+idle_monitor = None
+
 def handle_client(client_socket, client_address):
     global clients
 
     # Receive the initial message from the client
     client_ip = client_address[0]
     print(f"New connection from {client_ip}")
+    liveness = idle_monitor.add(client_socket)
 
     while True:
         try:
             message = client_socket.recv(1024).decode('utf-8')
             if not message:
                 break
+            liveness.touch()
 
             # If message starts with 'PAIR:', handle the pairing request
             if message.startswith("PAIR:"):
@@ -32,23 +40,50 @@ def handle_client(client_socket, client_address):
             print(f"Error: {e}")
             break
 
+    idle_monitor.remove(client_socket)
     client_socket.close()
-    del clients[client_ip]
+    # A newer connection from the same IP may have taken its place
+    if clients.get(client_ip) is client_socket:
+        del clients[client_ip]
     print(f"Client {client_ip} disconnected.")
 
-def start_server():
-    global clients
+def disconnect_idle(client_socket, quiet):
+    print(f"Disconnecting idle client after {quiet:.0f}s")
+    heartbeat.disconnect(client_socket)
+
+def start_server(host='127.0.0.1', port=12345, idle_timeout=heartbeat.QUIET_IDLE_TIMEOUT,
+                 keepalive_interval=heartbeat.DEFAULT_HEARTBEAT_INTERVAL):
+    """Accepts clients until interrupted.
+
+    Dead peers are found with TCP keepalive probes every
+    ``keepalive_interval`` seconds, and clients that send nothing for
+    ``idle_timeout`` seconds are dropped. 0 disables either.
+    """
+    global clients, idle_monitor
+    wheel = timerwheel.TimerWheel()
+    idle_monitor = heartbeat.IdleMonitor(wheel, idle_timeout, on_idle=disconnect_idle)
+    wheel.start()
     server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    server.bind(('127.0.0.1', 12345))
+    server.bind((host, port))
     server.listen(5)
 
-    print("Server listening on 127.0.0.1:12345")
+    print(f"Server listening on {host}:{port}")
 
     while True:
         client_socket, client_address = server.accept()
+        if keepalive_interval:
+            heartbeat.enable_keepalive(client_socket, keepalive_interval)
         clients[client_address[0]] = client_socket
         client_thread = threading.Thread(target=handle_client, args=(client_socket, client_address))
         client_thread.start()
 
 if __name__ == "__main__":
-    start_server()
+    parser = argparse.ArgumentParser(description="Pairing request server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=12345)
+    parser.add_argument("--idle-timeout", type=float, default=heartbeat.QUIET_IDLE_TIMEOUT,
+                        help="seconds a client may send nothing before it is dropped (0: never)")
+    parser.add_argument("--heartbeat-interval", type=float, default=heartbeat.DEFAULT_HEARTBEAT_INTERVAL,
+                        help="seconds between TCP keepalive probes of an idle client (0: no probes)")
+    args = parser.parse_args()
+    start_server(args.host, args.port, args.idle_timeout, args.heartbeat_interval)
@@ -1,65 +1,258 @@
+import argparse
+import contextlib
 import socket
 import threading
 import os
 
+import control
+import filewriter
+import heartbeat
+import metrics
+import resume
+import timerwheel
+
 clients = {}
 
+idle_monitor = None
+# How long an upload may go without data before it is given up, set by start_server
+upload_stall_timeout = heartbeat.DEFAULT_STALL_TIMEOUT
+# Disk writers shared by all uploads, set up by start_server
+writer_pool = None
+
+registry = metrics.Registry("server3_")
+upload_bytes = registry.counter("upload_bytes_total", "File bytes received")
+uploads_completed = registry.counter("uploads_completed_total", "Files received completely")
+queued_chunks = registry.gauge("disk_queue_chunks", "Received chunks waiting for a disk writer",
+                               lambda: writer_pool.queued() if writer_pool is not None else 0)
+
+
+def upload_samples(stat):
+    return lambda: [({"upload": upload.name}, stat(upload)) for upload in writer_pool.files()]
+
+
+# Per upload: a reader that waits long for buffers means the disk is the
+# bottleneck, a disk that is mostly idle means the network is
+registry.labeled_gauge("upload_bytes_per_second", "Receive rate of each upload in progress",
+                       upload_samples(lambda upload: round(upload.throughput())))
+registry.labeled_gauge("upload_queue_depth", "Chunks of each upload waiting for the disk",
+                       upload_samples(lambda upload: upload.depth))
+registry.labeled_gauge("upload_network_wait_seconds", "Time each upload's reader waited for the disk",
+                       upload_samples(lambda upload: round(upload.network_wait, 3)))
+registry.labeled_gauge("upload_disk_seconds", "Time spent writing and syncing each upload",
+                       upload_samples(lambda upload: round(upload.disk_time, 3)))
+
 
 def handle_client(client_socket, client_address):
     print(f"[+] New connection from {client_address}")
     clients[client_address] = client_socket
+    liveness = idle_monitor.add(client_address) if idle_monitor is not None else None
     try:
         while True:
             data = client_socket.recv(4096)
             if not data:  # If no data is received, the client has disconnected
                 break
+            if liveness is not None:
+                liveness.touch()
+
+            # Control messages come as text or, after MAGIC, in binary form;
+            # whatever follows a binary one is the start of the file it announces
+            binary = data[:1] == control.MAGIC
+            rest = b""
+            try:
+                if binary:
+                    message, end = control.decode(data, len(control.MAGIC))
+                    rest = data[end:]
+                else:
+                    message = control.parse_text(data.decode('utf-8', errors='ignore'))
+            except control.ControlError as e:
+                print(f"[UNKNOWN] {client_address}: {str(e)}")
+                continue
+
+            handler = HANDLERS.get(message.kind) if message is not None else None
+            if handler is None:
+                print(f"[UNKNOWN] {client_address}: {message or data.decode('utf-8', errors='ignore')}")
+            elif handler(client_socket, client_address, liveness, binary, rest, message) is False:
+                break
+
+    except ConnectionResetError:
+        print(f"[!] Client {client_address} disconnected abruptly.")
+    except Exception as e:
+        print(f"[ERROR] {client_address}: {str(e)}")
+    finally:
+        disconnect_client(client_address)
 
-            data = data.decode('utf-8', errors='ignore')
 
-            if data.startswith("PAIR:"):
-                peer_ip = data.split(":")[1]
-                print(f"[PAIR] Client {client_address} requests pairing with {peer_ip}")
-                client_socket.send(f"PAIR_REQUEST:{client_address[0]}".encode('utf-8'))
+def reply(client_socket, binary, kind, *values):
+    """Answers a control message in the form it came in."""
+    if binary:
+        client_socket.sendall(control.MAGIC + control.encode(kind, *values))
+    else:
+        client_socket.sendall(control.format_text(kind, *values).encode('utf-8'))
 
-            elif data.startswith("PAIR_ACCEPT:"):
-                peer_ip = data.split(":")[1]
-                print(f"[PAIR_ACCEPT] Client {client_address} accepted pair with {peer_ip}")
 
-            elif data.startswith("FILE:"):
-                _, file_name, file_size = data.split(":")
-                file_size = int(file_size)
-                print(f"[FILE] Receiving '{file_name}' ({file_size} bytes) from {client_address}")
+def handle_pair(client_socket, client_address, liveness, binary, rest, message):
+    print(f"[PAIR] Client {client_address} requests pairing with {message.ip}")
+    reply(client_socket, binary, control.PAIR_REQUEST, client_address[0])
 
-                # Receive file in chunks
-                desktop = os.path.join(os.path.expanduser("~"), "Desktop")
-                file_path = os.path.join(desktop, file_name)
 
-                with open(file_path, "wb") as f:
-                    received_size = 0
-                    while received_size < file_size:
-                        chunk = client_socket.recv(4096)
-                        if not chunk or chunk == b"EOF":
-                            break
-                        f.write(chunk)
-                        received_size += len(chunk)
+def handle_pair_accept(client_socket, client_address, liveness, binary, rest, message):
+    print(f"[PAIR_ACCEPT] Client {client_address} accepted pair with {message.ip}")
 
-                print(f"[FILE] File '{file_name}' saved to {file_path}")
-                client_socket.send(f"File '{file_name}' received successfully.".encode('utf-8'))
 
-            elif data.startswith("MESSAGE:"):
-                message = data.split(":", 1)[1]
-                print(f"[MESSAGE] {client_address}: {message}")
-                client_socket.send(f"Message received: {message}".encode('utf-8'))
+def handle_file(client_socket, client_address, liveness, binary, rest, message):
+    """Receives the file a FILE message announces; returns False if the upload was interrupted."""
+    file_name, file_size = message.name, message.size
+    desktop = os.path.join(os.path.expanduser("~"), "Desktop")
+    file_path = os.path.join(desktop, file_name)
 
-            else:
-                print(f"[UNKNOWN] {client_address}: {data}")
+    # FILE:<name>:<size>:<transfer id> can resume an interrupted upload
+    transfer_id = message.transfer_id.strip()
+    if transfer_id:
+        print(f"[FILE] Receiving '{file_name}' ({file_size} bytes) from {client_address}, resumable")
+        if not receive_resumable(client_socket, file_path, file_size, transfer_id, client_address):
+            print(f"[FILE] Upload of '{file_name}' interrupted, kept for resuming")
+            return False
+        print(f"[FILE] File '{file_name}' saved to {file_path}")
+        client_socket.send(f"File '{file_name}' received successfully.".encode('utf-8'))
+        return
 
-    except ConnectionResetError:
-        print(f"[!] Client {client_address} disconnected abruptly.")
-    except Exception as e:
-        print(f"[ERROR] {client_address}: {str(e)}")
+    print(f"[FILE] Receiving '{file_name}' ({file_size} bytes) from {client_address}")
+
+    # Receive file in chunks
+    upload = writer_pool.open(file_path, file_size, name=upload_name(client_address, file_name))
+    try:
+        with receiving(client_address):
+            rest = rest[:file_size]
+            upload.write(rest)
+            upload_bytes.inc(len(rest))
+            receive_into(client_socket, upload, file_size - len(rest), liveness, stop_at_eof=True)
+    except BaseException:
+        upload.abort()
+        raise
+    upload.close()
+    uploads_completed.inc()
+
+    print(f"[FILE] File '{file_name}' saved to {file_path}: {upload.summary()}")
+    client_socket.send(f"File '{file_name}' received successfully.".encode('utf-8'))
+
+
+def handle_message(client_socket, client_address, liveness, binary, rest, message):
+    print(f"[MESSAGE] {client_address}: {message.text}")
+    client_socket.send(f"Message received: {message.text}".encode('utf-8'))
+
+
+# Control messages clients send, by kind (see control.py)
+HANDLERS = {
+    control.PAIR: handle_pair,
+    control.PAIR_ACCEPT: handle_pair_accept,
+    control.FILE: handle_file,
+    control.MESSAGE: handle_message,
+}
+
+
+def upload_name(client_address, file_name):
+    return f"{client_address[0]}:{client_address[1]}/{file_name}"
+
+
+def receive_into(client_socket, upload, size, liveness=None, stop_at_eof=False):
+    """Reads up to ``size`` bytes of a file straight into ``upload``'s buffers.
+
+    Returns how many arrived before the client closed the connection (or,
+    with ``stop_at_eof``, sent a bare EOF).
+    """
+    received = 0
+    while received < size:
+        buf = upload.buffer()
+        try:
+            nbytes = client_socket.recv_into(buf, min(len(buf), size - received))
+        except BaseException:
+            upload.release(buf)
+            raise
+        if not nbytes or (stop_at_eof and nbytes == 3 and buf[:3] == b"EOF"):
+            upload.release(buf)
+            break
+        if liveness is not None:
+            liveness.touch()
+        upload.submit(buf, nbytes)
+        upload_bytes.inc(nbytes)
+        received += nbytes
+    return received
+
+
+def recv_line(client_socket, limit=1024):
+    """Reads up to a newline; returns (line, bytes received after it)."""
+    data = b""
+    while b"\n" not in data:
+        chunk = client_socket.recv(limit)
+        if not chunk or len(data) > limit:
+            raise ConnectionError("Connection closed during resume handshake")
+        data += chunk
+    line, rest = data.split(b"\n", 1)
+    return line.decode('utf-8', errors='ignore'), rest
+
+
+@contextlib.contextmanager
+def receiving(client_address):
+    """Holds a client to the stall timeout instead of the idle timeout while a file comes in."""
+    if idle_monitor is not None:
+        idle_monitor.set_timeout(client_address, upload_stall_timeout)
+    try:
+        yield
     finally:
-        disconnect_client(client_address)
+        if idle_monitor is not None:
+            idle_monitor.set_timeout(client_address)
+
+
+def receive_resumable(client_socket, file_path, file_size, transfer_id, client_address=None):
+    """Receives an upload into <file>.part, continuing a verified earlier attempt.
+
+    The server offers RESUME:<offset>:<sha256 of those bytes>; the client
+    answers RESUME_FROM:<offset> (0 to start over) and sends the rest of the
+    file. Returns False if the connection dropped or stalled first; the
+    partial file and its manifest are kept for the next attempt.
+    """
+    manifest, hasher = resume.find_resumable(file_path, transfer_id, file_size)
+    client_socket.sendall(f"RESUME:{manifest.offset}:{manifest.digest}\n".encode('utf-8'))
+
+    line, rest = recv_line(client_socket)
+    offset = int(line.split(":")[1]) if line.startswith("RESUME_FROM:") else 0
+    if offset == 0 or offset != manifest.offset:
+        offset = 0
+        hasher = manifest.reset()
+    elif offset:
+        print(f"[FILE] Resuming '{os.path.basename(file_path)}' at byte {offset}")
+
+    name = upload_name(client_address, os.path.basename(file_path)) if client_address else file_path
+    upload = writer_pool.open(manifest.partial_path, file_size, offset, hasher, manifest.update, name)
+    received = offset
+    liveness = idle_monitor.get(client_address) if idle_monitor is not None else None
+    try:
+        with receiving(client_address):
+            rest = rest[:file_size - received]
+            upload.write(rest)
+            upload_bytes.inc(len(rest))
+            received += len(rest)
+            received += receive_into(client_socket, upload, file_size - received, liveness)
+    except OSError:
+        pass
+
+    if received < file_size:
+        upload.abort()
+        return False
+    upload.close()
+    uploads_completed.inc()
+    print(f"[FILE] '{os.path.basename(file_path)}': {upload.summary()}")
+    os.replace(manifest.partial_path, file_path)
+    manifest.remove()
+    return True
+
+
+def disconnect_idle(client_address, quiet):
+    """Wakes the handler of a client that went quiet; it then disconnects the client."""
+    client_socket = clients.get(client_address)
+    if client_socket is not None:
+        print(f"[-] Client {client_address} sent nothing for {quiet:.0f}s")
+        heartbeat.disconnect(client_socket)
 
 
 def disconnect_client(client_address):
@@ -70,11 +263,34 @@ def disconnect_client(client_address):
         except Exception as e:
             print(f"[ERROR] Closing socket for {client_address}: {e}")
         del clients[client_address]
+    if idle_monitor is not None:
+        idle_monitor.remove(client_address)
     print(f"[-] Client {client_address} disconnected.")
 
 
-def start_server(host="127.0.0.1", port=12345):
-    """Start the server and listen for incoming connections."""
+def start_server(host="127.0.0.1", port=12345, writers=filewriter.DEFAULT_WRITERS,
+                 chunk_size=filewriter.DEFAULT_CHUNK_SIZE, buffers=filewriter.DEFAULT_BUFFERS,
+                 metrics_file=None, metrics_interval=10.0, idle_timeout=heartbeat.QUIET_IDLE_TIMEOUT,
+                 stall_timeout=heartbeat.DEFAULT_STALL_TIMEOUT, keepalive_interval=heartbeat.DEFAULT_HEARTBEAT_INTERVAL):
+    """Start the server and listen for incoming connections.
+
+    Uploads are read in ``chunk_size`` pieces into up to ``buffers`` buffers
+    each and written to disk by a pool of ``writers`` threads.
+
+    Dead peers are found with TCP keepalive probes every
+    ``keepalive_interval`` seconds. Clients that send nothing for
+    ``idle_timeout`` seconds are dropped, or for ``stall_timeout`` while a
+    file is coming in. 0 disables any of them.
+    """
+    global idle_monitor, writer_pool, upload_stall_timeout
+    upload_stall_timeout = stall_timeout
+    writer_pool = filewriter.WriterPool(writers, chunk_size, buffers)
+    if metrics_file:
+        registry.export_every(metrics_file, metrics_interval)
+    wheel = timerwheel.TimerWheel()
+    idle_monitor = heartbeat.IdleMonitor(wheel, idle_timeout, on_idle=disconnect_idle)
+    wheel.start()
+
     server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
     server_socket.bind((host, port))
@@ -84,6 +300,8 @@ def start_server(host="127.0.0.1", port=12345):
     try:
         while True:
             client_socket, client_address = server_socket.accept()
+            if keepalive_interval:
+                heartbeat.enable_keepalive(client_socket, keepalive_interval)
             threading.Thread(target=handle_client, args=(client_socket, client_address), daemon=True).start()
     except KeyboardInterrupt:
         print("\n[*] Server shutting down.")
@@ -92,4 +310,26 @@ def start_server(host="127.0.0.1", port=12345):
 
 
 if __name__ == "__main__":
-    start_server()
+    parser = argparse.ArgumentParser(description="File and message server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=12345)
+    parser.add_argument("--disk-writers", type=int, default=filewriter.DEFAULT_WRITERS,
+                        help="threads writing received files to disk, shared by all uploads")
+    parser.add_argument("--chunk-size", type=int, default=filewriter.DEFAULT_CHUNK_SIZE,
+                        help="bytes read from the network and written to disk at a time")
+    parser.add_argument("--upload-buffers", type=int, default=filewriter.DEFAULT_BUFFERS,
+                        help="chunks an upload may have waiting for the disk before its reads wait")
+    parser.add_argument("--metrics-file",
+                        help="write a Prometheus text snapshot of the upload metrics to this file")
+    parser.add_argument("--metrics-interval", type=float, default=10.0,
+                        help="seconds between metrics snapshots")
+    parser.add_argument("--idle-timeout", type=float, default=heartbeat.QUIET_IDLE_TIMEOUT,
+                        help="seconds a client may send nothing before it is dropped (0: never)")
+    parser.add_argument("--stall-timeout", type=float, default=heartbeat.DEFAULT_STALL_TIMEOUT,
+                        help="seconds an upload may go without data before it is given up (0: never)")
+    parser.add_argument("--heartbeat-interval", type=float, default=heartbeat.DEFAULT_HEARTBEAT_INTERVAL,
+                        help="seconds between TCP keepalive probes of an idle client (0: no probes)")
+    args = parser.parse_args()
+    start_server(args.host, args.port, args.disk_writers, args.chunk_size, args.upload_buffers,
+                 args.metrics_file, args.metrics_interval, args.idle_timeout, args.stall_timeout,
+                 args.heartbeat_interval)
@@ -1,7 +1,26 @@
+import argparse
 import socket
 import threading
+import time
 import base64
+import hashlib
+import hmac
+import itertools
 import os
+import secrets
+import sys
+
+import backpressure
+import chunkcache
+import control
+import framing
+import heartbeat
+import metrics
+import offlinequeue
+import relay
+import sockopts
+import timerwheel
+from client_index import ClientIndex
 
 # Dictionary to store connected clients
 clients = {}
@@ -9,232 +28,1222 @@ clients = {}
 paired_clients = {}
 # Dictionary to track file transfers
 file_transfers = {}
+# Live client addresses by IP, for pairing lookups
+client_index = ClientIndex()
+# Backpressure state per sender, for traffic towards its paired client
+flow_controls = {}
+# Unacknowledged bytes a sender may have in flight, set by start_server
+max_in_flight = backpressure.DEFAULT_MAX_IN_FLIGHT
+# Set by cluster.py when this process is one of several SO_REUSEPORT workers
+cluster = None
+# Relay-side store of file chunks, set with --chunk-cache
+chunk_cache = None
+# Extra data connections of a parallel transfer -> the client they joined
+data_links = {}
+# (receiver, stream id) -> data connection that sends that stream, so the
+# receiver's ACKs release the right connection's backpressure
+stream_routes = {}
+# Signs join tokens, so only the client that asked can add connections to itself
+join_secret = os.urandom(16)
+# Store-and-forward queue for peers that are offline, set with --offline-queue
+offline_queue = None
+# Client -> IP of the peer it was paired with until that peer disconnected
+offline_peers = {}
+# (sender, stream id) -> [recipient IP, queued stream id, bytes queued] of a
+# file being queued for an offline peer
+queued_transfers = {}
+# Recipient IP -> client its queue is being delivered to
+queue_drains = {}
+drain_lock = threading.Lock()
+# Client -> backpressure for the queued file data being delivered to it
+drain_flows = {}
+# Stream ids the relay gives queued files, so they never clash with live ones
+queued_stream_ids = itertools.count(1)
+# Session id -> {side secret: connected client} of a pairing that can be
+# restored after a reconnect
+sessions = {}
+# Client -> (session id, side secret) it holds
+session_of = {}
+# Heartbeats, idle eviction and stalled transfers run on one timer wheel,
+# set up by start_timers
+timer_wheel = None
+idle_monitor = None
+heartbeat_interval = heartbeat.DEFAULT_HEARTBEAT_INTERVAL
+idle_timeout = heartbeat.DEFAULT_IDLE_TIMEOUT
+stall_timeout = heartbeat.DEFAULT_STALL_TIMEOUT
+# Socket options of each connection, tuned for bulk data while a file moves
+tuners = {}
+
+# Relay instrumentation, exported as Prometheus text with --metrics-file
+registry = metrics.Registry("server6_")
+log = metrics.Log()
+connections_accepted = registry.counter("connections_accepted_total", "Client connections accepted")
+connected_clients = registry.gauge("connected_clients", "Clients currently connected", lambda: len(clients))
+frames_received = registry.counter("frames_received_total", "Frames received from clients")
+frames_relayed = registry.counter("frames_relayed_total", "Frames forwarded to a paired client")
+relay_errors = registry.counter("relay_errors_total", "Frames that could not be forwarded")
+relay_seconds = registry.histogram("relay_seconds", "Time to hand one frame to the receiving connection",
+                                   metrics.LATENCY_BUCKETS)
+chunk_bytes = registry.histogram("chunk_bytes", "FILECHUNK payload sizes", metrics.SIZE_BUCKETS)
+cache_hits = registry.counter("cache_hits_total", "FILECHUNKs served from the chunk cache")
+cache_hit_bytes = registry.counter("cache_hit_bytes_total", "Payload bytes served from the chunk cache")
+cache_misses = registry.counter("cache_misses_total", "Chunk hashes offered by senders that were not cached")
+queued_frames = registry.counter("offline_queued_frames_total", "Frames queued for offline peers")
+queued_bytes = registry.counter("offline_queued_bytes_total", "Payload bytes queued for offline peers")
+delivered_frames = registry.counter("offline_delivered_frames_total",
+                                    "Queued frames delivered once their peer came back")
+queue_rejected = registry.counter("offline_rejected_total",
+                                  "Messages and files refused because the peer's queue was full")
+queue_size = registry.gauge("offline_queue_bytes", "Undelivered bytes in the offline queue",
+                            lambda: offline_queue.total_bytes if offline_queue is not None else 0)
+heartbeats_sent = registry.counter("heartbeats_sent_total", "Heartbeats sent to quiet clients")
+idle_evictions = registry.counter("idle_evictions_total", "Clients disconnected for sending nothing")
+stalled_transfers = registry.counter("stalled_transfers_total", "File transfers given up for not moving")
+connection_bytes = registry.connection_bytes("connection_bytes_total",
+                                             "Bytes received from (rx) and relayed to (tx) each client")
+
+ENGINES = ("threaded", "asyncio")
+
+# Reconnecting clients arrive in a burst after a restart
+LISTEN_BACKLOG = 1024
+
+# File transfer replies relayed between the peers unchanged (see handle_frame)
+HANDSHAKE_PREFIXES = ("ACK:", "RESUME:", "RESUME_FROM:", "PARALLEL", "RANGES:", "DIGEST:",
+                      "VERIFIED", "VERIFY_FAILED", "ERROR:")
+
+# First byte of a FILE message in binary form
+FILE_CODE = bytes((control.FILE.code,))
+
+# Set in the stream id of files delivered from the offline queue
+QUEUED_STREAM = 0x80000000
+# Queued frames delivered between commits of the queue's read position
+COMMIT_EVERY = 256
+
+# Sent to a client that has been quiet for a heartbeat interval
+PING_FRAME = framing.encode_frame(framing.TEXT, heartbeat.PING.encode("utf-8"))
+
+
+def get_flow(address):
+    """Returns the backpressure state for traffic sent by ``address``."""
+    flow = flow_controls.get(address)
+    if flow is None:
+        flow = flow_controls.setdefault(address, backpressure.FlowControl(max_in_flight))
+    return flow
+
+
+def release_flow(address):
+    """Unblocks ``address`` after its receiver went away or changed."""
+    flow = flow_controls.get(address)
+    if flow is not None:
+        flow.reset()
+        resume_sender(address, flow)
+
+
+def resume_sender(address, flow):
+    """Lets an event-loop connection read again once its flow is under the limit."""
+    connection = clients.get(address)
+    if hasattr(connection, "resume_reading"):
+        connection.resume_reading("in_flight")
+        flow.mark_resumed()
+
+
+def find_client(ip, exclude=None):
+    """Returns the address of the earliest live client with ``ip``, or None."""
+    client_addr = client_index.lookup(ip, exclude=exclude)
+    if client_addr is not None and client_addr not in clients and cluster is not None:
+        # Connected to another worker; reach it through a proxy
+        cluster.attach(client_addr)
+    return client_addr if client_addr in clients else None
+
+
+def pair_clients(address, client_addr):
+    """Pairs two clients in both directions, dropping any stale flow state."""
+    paired_clients[address] = client_addr
+    paired_clients[client_addr] = address
+    offline_peers.pop(address, None)
+    offline_peers.pop(client_addr, None)
+    release_flow(address)
+    release_flow(client_addr)
+    if cluster is not None:
+        cluster.paired(address, client_addr)
+
+
+def peer_of(address):
+    """Returns the client paired with ``address``, or with the client it joined."""
+    return paired_clients.get(data_links.get(address, address))
+
+
+def join_token(address):
+    """Returns the token a data connection presents to join ``address``."""
+    mac = hmac.new(join_secret, f"{address[0]}:{address[1]}".encode(), hashlib.sha256).hexdigest()[:32]
+    return f"{address[1]}:{mac}"
+
+
+def join_client(address, token):
+    """Links data connection ``address`` to the client that issued ``token``.
+
+    The token only works from the same IP, and only for a client connected
+    to this process. Returns the joined client's address, or None.
+    """
+    port, _, _ = token.partition(":")
+    if not port.isdigit():
+        return None
+    primary = (address[0], int(port))
+    if primary == address or primary not in clients or not hmac.compare_digest(token, join_token(primary)):
+        return None
+    if cluster is not None and primary not in cluster.index.local:
+        return None
+    data_links[address] = primary
+    return primary
 
-def handle_client(client_socket, address):
-    """Handles communication with a connected client."""
-    print(f"[*] Accepted connection from {address}")
+
+def forward_frame(address, frame):
+    """Forwards a frame unchanged to the client paired with ``address``.
+
+    Returns the receiver's address, or None if there is no live peer.
+    """
+    paired_addr = peer_of(address)
+    if paired_addr not in clients:
+        return None
+    header = framing.encode_header(frame.type, len(frame.payload), frame.stream_id, frame.flags)
+    start = time.monotonic()
+    framing.sendall_buffers(clients[paired_addr], (header, frame.payload))
+    elapsed = time.monotonic() - start
+    get_flow(address).add_receiver_blocked(elapsed)
+    relay_seconds.observe(elapsed)
+    frames_relayed.inc()
+    connection_bytes.add(paired_addr, sent=len(header) + len(frame.payload))
+    return paired_addr
+
+
+def handle_frame(client_socket, address, frame):
+    """Processes one frame received from a connected client.
+
+    Shared by both server engines; ``client_socket`` only needs ``sendall``.
+    """
+    frames_received.inc()
+    # Sender asks which of its next chunks the relay already holds
+    if frame.type == framing.CACHE_QUERY:
+        if chunk_cache is None:
+            framing.send_frame(client_socket, framing.CACHE_HAVE, b"", frame.stream_id)
+            return
+        hashes = [bytes(frame.payload[i:i + chunkcache.HASH_SIZE])
+                  for i in range(0, len(frame.payload), chunkcache.HASH_SIZE)]
+        present = chunk_cache.pin((address, frame.stream_id), hashes)
+        cache_misses.inc(present.count(False))
+        framing.send_frame(client_socket, framing.CACHE_HAVE, bytes(present), frame.stream_id)
+        return
+
+    # A chunk the sender did not upload again; relay the cached copy instead
+    cached = False
+    if frame.type == framing.CHUNKREF:
+        payload = None
+        if chunk_cache is not None:
+            payload = chunk_cache.take((address, frame.stream_id), bytes(frame.payload))
+        if payload is None:
+            framing.send_text(client_socket, "ERROR: Chunk is not in the relay cache", frame.stream_id)
+            return
+        cache_hits.inc()
+        cache_hit_bytes.inc(len(payload))
+        frame = framing.Frame(framing.FILECHUNK, frame.flags, frame.stream_id, payload)
+        cached = True
+
+    # The rest of a file being queued for an offline peer goes to the queue
+    if queued_transfers and (address, frame.stream_id) in queued_transfers:
+        queue_frame(client_socket, address, frame)
+        return
+
+    # File chunks are relayed as opaque payloads (preserving encryption)
+    if frame.type == framing.FILECHUNK:
+        chunk_bytes.observe(len(frame.payload))
+        try:
+            paired_addr = forward_frame(address, frame)
+            if chunk_cache is not None and not cached:
+                store_chunk(address, frame.payload)
+            if paired_addr is not None:
+                # Once per second per sender rather than once per chunk
+                log.sampled(("chunk", address),
+                            f"[+] Forwarded {len(frame.payload)} bytes chunk from {address} to {paired_addr}.")
+
+                # Windowed transfers are acknowledged end to end by the receiver
+                if frame.flags & framing.FLAG_WINDOWED:
+                    flow = get_flow(address)
+                    flow.forwarded(frame.stream_id, len(frame.payload))
+                    if address in data_links:
+                        stream_routes[(paired_addr, frame.stream_id)] = address
+                    # Event-loop connections stop reading right away; the
+                    # threaded reader waits before its next recv
+                    if flow.over_limit() and hasattr(client_socket, "pause_reading"):
+                        client_socket.pause_reading("in_flight")
+                        flow.mark_paused()
+                else:
+                    # Send ACK back to the sender
+                    framing.send_text(client_socket, "ACK", frame.stream_id)
+        except Exception as e:
+            relay_errors.inc()
+            log.sampled(("chunk_error", address), f"[-] Error forwarding file chunk: {str(e)}", metrics.ERROR)
+            # Try to inform the sender
+            try:
+                framing.send_text(client_socket, f"ERROR: Failed to forward chunk - {str(e)}", frame.stream_id)
+            except:
+                pass
+        return
+
+    # End of a file transfer
+    if frame.type == framing.EOF:
+        log.info(f"[+] EOF marker detected from {address}")
+        try:
+            paired_addr = forward_frame(address, frame)
+            if paired_addr is not None:
+                log.info(f"[+] File transfer completed from {address} to {paired_addr}")
+                flow = get_flow(address)
+                flow.finish_stream(frame.stream_id)
+                stream_routes.pop((paired_addr, frame.stream_id), None)
+                if chunk_cache is not None:
+                    chunk_cache.release((address, frame.stream_id))
+                log.info(f"[+] Backpressure for {address}: {flow.summary()}")
+
+                # Clear file transfer tracking if needed
+                if (address, paired_addr) in file_transfers:
+                    log.info(f"[+] Removing file transfer tracking: {file_transfers[(address, paired_addr)]}")
+                    del file_transfers[(address, paired_addr)]
+                    bulk_finished((address, paired_addr))
+        except Exception as e:
+            log.error(f"[-] Error forwarding EOF: {str(e)}")
+        return
+
+    # Receiver's cumulative ACK for a windowed transfer goes back to the sender
+    if frame.type == framing.ACK:
+        # or paces the delivery of a file from the offline queue
+        if frame.stream_id & QUEUED_STREAM:
+            flow = drain_flows.get(address)
+            if flow is not None:
+                flow.acked(frame.stream_id, framing.decode_ack(frame))
+            return
+        try:
+            sender_addr = forward_frame(address, frame)
+            if sender_addr is not None:
+                # Streams of a parallel transfer are paced per data connection
+                sender_addr = stream_routes.get((address, frame.stream_id), sender_addr)
+                flow = get_flow(sender_addr)
+                if flow.acked(frame.stream_id, framing.decode_ack(frame)):
+                    resume_sender(sender_addr, flow)
+        except Exception as e:
+            log.error(f"[-] Error forwarding ACK: {str(e)}")
+        return
+
+    if frame.type == framing.CONTROL:
+        try:
+            message, _ = control.decode(frame.payload)
+        except control.ControlError as e:
+            log.warning(f"[?] Received malformed control message from {address}: {str(e)}")
+            return
+        handle_control(client_socket, address, frame, message)
+        return
+
+    if frame.type != framing.TEXT:
+        log.warning(f"[?] Received unknown frame type {frame.type} from {address} of length {len(frame.payload)}")
+        return
 
     try:
-        buffer_size = 65536  # 64KB buffer size
-        while True:
-            # Receive raw data bytes (don't decode yet)
-            raw_data = client_socket.recv(buffer_size)
-            if not raw_data:
-                break  # Client disconnected
-                
-            # First check if this is a binary file chunk (starts with FILECHUNK:)
-            if raw_data.startswith(b'FILECHUNK:'):
-                print(f"[+] Forwarding file chunk from {address} ({len(raw_data)} bytes)")
-                
-                # Find the paired client
-                if address in paired_clients:
-                    paired_addr = paired_clients[address]
-                    if paired_addr in clients:
-                        try:
-                            # Forward the raw data as is (preserving encryption)
-                            clients[paired_addr].send(raw_data)
-                            print(f"[+] Forwarded {len(raw_data)} bytes chunk to {paired_addr}.")
-                            
-                            # Send ACK back to the sender
-                            client_socket.send("ACK".encode('utf-8'))
-                        except Exception as e:
-                            print(f"[-] Error forwarding file chunk: {str(e)}")
-                            # Try to inform the sender
-                            try:
-                                client_socket.send(f"ERROR: Failed to forward chunk - {str(e)}".encode('utf-8'))
-                            except:
-                                pass
-                
-                # Skip further processing for file chunks
-                continue
-            
-            # Try to handle as text data
+        text_data = str(frame.payload, 'utf-8')
+
+        # Resume handshake of a file transfer, passed between the peers as
+        # is: the receiver's ACK or RESUME:<offset>:<digest> offer (either
+        # may end in the codec it accepted), then the sender's
+        # RESUME_FROM:<offset>. Parallel transfers instead agree with
+        # PARALLEL, RANGES: and ACK, and end with DIGEST: and the
+        # receiver's VERIFIED or VERIFY_FAILED; a receiver that gives up
+        # says ERROR:. The transfer's stream id tells them apart from chat
+        # messages
+        if frame.stream_id and (text_data == "ACK" or text_data.startswith(HANDSHAKE_PREFIXES)):
+            log.debug(f"[+] Received {text_data} from {address} for file info")
+            # The receiver's answer to a file from the offline queue, which
+            # always starts from the beginning
+            if frame.stream_id & QUEUED_STREAM:
+                if text_data.startswith("ERROR:"):
+                    log.info(f"[-] {address} refused a queued file: {text_data}")
+                return
+            paired_addr = forward_frame(address, frame)
+            if paired_addr is not None and text_data.startswith("RESUME_FROM:"):
+                offset = int(text_data.split(":")[1])
+                # Receiver ACKs count from the resume offset, not from 0
+                get_flow(address).start_stream(frame.stream_id, offset)
+                transfer_info = file_transfers.get((address, paired_addr))
+                if transfer_info is not None and transfer_info["stream_id"] == frame.stream_id:
+                    transfer_info["offset"] = offset
+                    if offset:
+                        log.info(f"[+] Resuming {transfer_info['name']} from {address} at byte {offset}")
+            return
+
+        # The commands clients send in text form; anything else, including
+        # text that only looks like another message, is chat
+        handle_control(client_socket, address, frame, control.parse_text(text_data, control.CHAT, TEXT_KINDS))
+
+    except UnicodeDecodeError:
+        # Text frames must carry UTF-8
+        log.warning(f"[?] Received undecodable text frame from {address} of length {len(frame.payload)}")
+
+
+def control_payload(frame, kind, *values):
+    """Encodes a ``kind`` message the way ``frame`` was: as text or in binary."""
+    if frame.type == framing.TEXT:
+        return control.format_text(kind, *values).encode("utf-8")
+    return control.encode(kind, *values)
+
+
+def reply(client_socket, frame, kind, *values, stream_id=0):
+    """Answers the control message in ``frame`` in the same form."""
+    framing.send_frame(client_socket, frame.type, control_payload(frame, kind, *values), stream_id)
+
+
+def handle_control(client_socket, address, frame, message):
+    """Dispatches a control message, received as text or in binary, to its handler."""
+    try:
+        if log.enabled(metrics.DEBUG) and message.kind not in (control.PING, control.PONG):
+            log.debug(f"[{address}] Message: {message}")
+        if not control.dispatch(CONTROL_HANDLERS, message, client_socket, address, frame):
+            log.warning(f"[?] Unexpected {message.kind.name} message from {address}")
+    except Exception as e:
+        log.error(f"[-] Error processing message: {str(e)}")
+
+
+def handle_ping(client_socket, address, frame, message):
+    reply(client_socket, frame, control.PONG)
+
+
+def handle_pong(client_socket, address, frame, message):
+    # That it arrived at all is what keeps the client alive
+    pass
+
+
+def handle_join_token(client_socket, address, frame, message):
+    """A parallel sender asks for a token to open more connections with."""
+    reply(client_socket, frame, control.JOIN_TOKEN, join_token(address), stream_id=frame.stream_id)
+
+
+def handle_resume_session(client_socket, address, frame, message):
+    """A client that reconnected asks for its pairing back."""
+    resume_session(client_socket, address, message.token)
+
+
+def handle_join(client_socket, address, frame, message):
+    """A connection opened with a join token joins its client, sending into the same pairing."""
+    primary = join_client(address, message.token)
+    if primary is not None:
+        log.info(f"[+] {address} joined {primary} as a data connection")
+        # It only ever carries file data
+        tuners[address].start(sockopts.BULK)
+        framing.send_text(client_socket, "JOIN_SUCCESS")
+    else:
+        framing.send_text(client_socket, "JOIN_FAILED")
+
+
+def handle_pair(client_socket, address, frame, message):
+    """Pairs directly with the client at the IP given."""
+    # Match only the IP part, via the index rather than a scan
+    client_addr = find_client(message.ip, exclude=address)
+    if client_addr is not None:
+        # Store the pairing information in both directions
+        pair_clients(address, client_addr)
+
+        log.info(f"[+] {address} paired with {client_addr}")
+        reply(client_socket, frame, control.PAIR_SUCCESS)
+
+        # Also notify the other client about successful pairing
+        try:
+            framing.send_text(clients[client_addr], "PAIR_SUCCESS")
+        except Exception:
+            pass
+        start_session(address, client_addr)
+    else:
+        reply(client_socket, frame, control.PAIR_FAILED)
+
+
+def handle_pair_answer(client_socket, address, frame, message):
+    """Handles pairing acceptance/rejection."""
+    # Find the client with the matching IP
+    client_addr = find_client(message.ip, exclude=address)
+    if client_addr is None:
+        return
+    if message.kind is control.PAIR_ACCEPT:
+        # Set up pairing
+        pair_clients(address, client_addr)
+
+        log.info(f"[+] {address} accepted pairing with {client_addr}")
+        reply(client_socket, frame, control.PAIR_SUCCESS)
+        framing.send_text(clients[client_addr], "PAIR_SUCCESS")
+        start_session(address, client_addr)
+    else:
+        log.info(f"[-] {address} rejected pairing with {client_addr}")
+        framing.send_text(clients[client_addr], "PAIR_FAILED")
+
+
+def handle_file(client_socket, address, frame, message):
+    """Handles file transfer initiation."""
+    log.info(f"[+] File transfer initiated from {address}: {message.name} ({message.size} bytes)")
+
+    # Acknowledge receipt to the sender
+    framing.send_text(client_socket, "ACK", frame.stream_id)
+
+    # The peer is offline; the relay takes the file for it
+    queue_ip = queue_for(address)
+    if queue_ip is not None:
+        queue_file(client_socket, address, queue_ip, frame, message)
+
+    # If this client is paired, forward the file info to its paired client
+    elif address in paired_clients:
+        paired_addr = paired_clients[address]
+        if paired_addr in clients:
             try:
-                # Try to decode as text
-                text_data = raw_data.decode('utf-8')
-                
-                # Check for EOF marker (end of file)
-                if text_data == "EOF":
-                    print(f"[+] EOF marker detected from {address}")
-                    # Find the paired client
-                    if address in paired_clients:
-                        paired_addr = paired_clients[address]
-                        if paired_addr in clients:
-                            try:
-                                # Forward the EOF marker
-                                clients[paired_addr].send(raw_data)
-                                print(f"[+] File transfer completed from {address} to {paired_addr}")
-                                
-                                # Clear file transfer tracking if needed
-                                if (address, paired_addr) in file_transfers:
-                                    print(f"[+] Removing file transfer tracking: {file_transfers[(address, paired_addr)]}")
-                                    del file_transfers[(address, paired_addr)]
-                            except Exception as e:
-                                print(f"[-] Error forwarding EOF: {str(e)}")
-                    
-                    # Skip further processing for EOF marker
-                    continue
-                
-                # Process other messages
-                print(f"[{address}] Message: {text_data}")
-
-                # Handle Pairing (Direct IP Input Allowed)
-                if text_data.startswith("PAIR:"):
-                    pair_ip = text_data.split(":")[1]
-                    
-                    # Modified pairing logic to match only the IP part
-                    pair_found = False
-                    for client_addr in clients:
-                        # Check if the first element (IP address) of the client_addr tuple matches
-                        if isinstance(client_addr, tuple) and client_addr[0] == pair_ip:
-                            # Store the pairing information in both directions
-                            paired_clients[address] = client_addr
-                            paired_clients[client_addr] = address
-                            
-                            print(f"[+] {address} paired with {client_addr}")
-                            client_socket.send("PAIR_SUCCESS".encode('utf-8'))
-                            
-                            # Also notify the other client about successful pairing
-                            try:
-                                clients[client_addr].send("PAIR_SUCCESS".encode('utf-8'))
-                            except Exception:
-                                pass
-                                
-                            pair_found = True
-                            break
-                    
-                    if not pair_found:
-                        client_socket.send("PAIR_FAILED".encode('utf-8'))
-                
-                # Handle pairing acceptance/rejection
-                elif text_data.startswith("PAIR_ACCEPT:") or text_data.startswith("PAIR_REJECT:"):
-                    parts = text_data.split(":")
-                    action = parts[0]
-                    target_ip = parts[1]
-                    
-                    # Find the client with the matching IP
-                    for client_addr in clients:
-                        if isinstance(client_addr, tuple) and client_addr[0] == target_ip:
-                            if action == "PAIR_ACCEPT":
-                                # Set up pairing
-                                paired_clients[address] = client_addr
-                                paired_clients[client_addr] = address
-                                
-                                print(f"[+] {address} accepted pairing with {client_addr}")
-                                client_socket.send("PAIR_SUCCESS".encode('utf-8'))
-                                clients[client_addr].send("PAIR_SUCCESS".encode('utf-8'))
-                            else:
-                                print(f"[-] {address} rejected pairing with {client_addr}")
-                                clients[client_addr].send("PAIR_FAILED".encode('utf-8'))
-                            break
-                
-                # Handle file transfer initiation
-                elif text_data.startswith("FILE:"):
-                    print(f"[+] File transfer initiated from {address}: {text_data}")
-                    
-                    # Acknowledge receipt to the sender
-                    client_socket.send("ACK".encode('utf-8'))
-                    
-                    # If this client is paired, forward the file info to its paired client
-                    if address in paired_clients:
-                        paired_addr = paired_clients[address]
-                        if paired_addr in clients:
-                            try:
-                                # Forward the original message
-                                clients[paired_addr].send(text_data.encode('utf-8'))
-                                print(f"[+] Forwarded file info from {address} to {paired_addr}")
-                                
-                                # Wait for ACK from receiver before proceeding
-                                try:
-                                    ack_data = clients[paired_addr].recv(4096).decode('utf-8')
-                                    if ack_data == "ACK":
-                                        print(f"[+] Received ACK from {paired_addr} for file info")
-                                        # Forward ACK back to sender
-                                        client_socket.send("ACK".encode('utf-8'))
-                                    else:
-                                        print(f"[?] Received non-ACK from receiver: {ack_data}")
-                                except Exception as e:
-                                    print(f"[-] Error getting ACK from receiver: {str(e)}")
-                                
-                                # Track this file transfer
-                                file_parts = text_data.split(":")
-                                if len(file_parts) >= 3:
-                                    file_name = file_parts[1]
-                                    file_size = int(file_parts[2])
-                                    print(f"[+] Tracking file transfer: {file_name} ({file_size} bytes)")
-                                    file_transfers[(address, paired_addr)] = {
-                                        "name": file_name,
-                                        "size": file_size,
-                                        "started": True
-                                    }
-                            except Exception as e:
-                                print(f"[-] Error forwarding file to {paired_addr}: {str(e)}")
-                                # Try to inform the sender
-                                try:
-                                    client_socket.send(f"ERROR: Failed to forward file info - {str(e)}".encode('utf-8'))
-                                except:
-                                    pass
-                
-                # Handle regular messages
-                else:
-                    # Acknowledge receipt to the sender
-                    client_socket.send("ACK".encode('utf-8'))
-                    
-                    # If this client is paired, forward the message to its paired client
-                    if address in paired_clients:
-                        paired_addr = paired_clients[address]
-                        if paired_addr in clients:
-                            try:
-                                # Add a prefix to indicate it's a forwarded message
-                                forward_msg = f"MSG:{text_data}"
-                                clients[paired_addr].send(forward_msg.encode('utf-8'))
-                                print(f"[+] Forwarded message from {address} to {paired_addr}")
-                            except Exception as e:
-                                print(f"[-] Error forwarding message to {paired_addr}: {str(e)}")
-            
-            except UnicodeDecodeError:
-                # This is binary data but not a file chunk - unusual
-                print(f"[?] Received unknown binary data from {address} of length {len(raw_data)}")
-            
+                # Forward the original message, in the form the sender chose
+                forward_frame(address, frame)
+                log.info(f"[+] Forwarded file info from {address} to {paired_addr}")
+
+                # Track this file transfer
+                log.info(f"[+] Tracking file transfer: {message.name} ({message.size} bytes)")
+                if (address, paired_addr) in file_transfers:
+                    bulk_finished((address, paired_addr))
+                file_transfers[(address, paired_addr)] = {
+                    "name": message.name,
+                    "size": message.size,
+                    "stream_id": frame.stream_id,
+                    # Set by senders that can resume an interrupted transfer
+                    "transfer_id": message.transfer_id or None,
+                    # Compression the sender offered
+                    "codec": message.codec or None,
+                    "offset": 0,
+                    "started": True
+                }
+                bulk_started((address, paired_addr))
+                watch_transfer((address, paired_addr), frame.stream_id)
+            except Exception as e:
+                log.error(f"[-] Error forwarding file to {paired_addr}: {str(e)}")
+                # Try to inform the sender
+                try:
+                    framing.send_text(client_socket, f"ERROR: Failed to forward file info - {str(e)}", frame.stream_id)
+                except:
+                    pass
+
+
+def handle_chat(client_socket, address, frame, message):
+    """Handles regular messages."""
+    # Acknowledge receipt to the sender
+    framing.send_text(client_socket, "ACK")
+
+    # Kept for the peer while it is offline
+    queue_ip = queue_for(address)
+    if queue_ip is not None:
+        queue_message(client_socket, address, queue_ip, frame, message)
+
+    # If this client is paired, forward the message to its paired client
+    elif address in paired_clients:
+        paired_addr = paired_clients[address]
+        if paired_addr in clients:
+            try:
+                # As MSG, to tell it from the server's own messages
+                reply(clients[paired_addr], frame, control.MSG, message.text)
+                log.sampled(("message", address), f"[+] Forwarded message from {address} to {paired_addr}")
             except Exception as e:
-                print(f"[-] Error processing message: {str(e)}")
-    
+                log.error(f"[-] Error forwarding message to {paired_addr}: {str(e)}")
+
+
+# What clients may send
+CONTROL_HANDLERS = {
+    control.PING: handle_ping,
+    control.PONG: handle_pong,
+    control.JOIN_TOKEN: handle_join_token,
+    control.RESUME_SESSION: handle_resume_session,
+    control.JOIN: handle_join,
+    control.PAIR: handle_pair,
+    control.PAIR_ACCEPT: handle_pair_answer,
+    control.PAIR_REJECT: handle_pair_answer,
+    control.FILE: handle_file,
+    control.CHAT: handle_chat,
+}
+
+# The messages clients have always sent as text, taken in that form for
+# older clients' sake; any newer kind is only taken in a CONTROL frame
+TEXT_KINDS = frozenset({
+    control.PING, control.PONG, control.JOIN_TOKEN, control.RESUME_SESSION, control.JOIN,
+    control.PAIR, control.PAIR_ACCEPT, control.PAIR_REJECT, control.FILE,
+})
+
+
+def start_session(address, client_addr):
+    """Gives both sides of a new pairing a token to restore it with after a reconnect.
+
+    The token is ``<session id>.<side secret>``, different for each side.
+    Nothing about it is kept once both sides are gone, so sessions also
+    outlive a relay restart: the first side back waits for the second.
+    """
+    session_id = secrets.token_hex(16)
+    for member in (address, client_addr):
+        side = secrets.token_hex(8)
+        join_session(member, session_id, side)
+        try:
+            framing.send_text(clients[member], f"SESSION:{session_id}.{side}")
+        except Exception as e:
+            log.error(f"[-] Error sending session token to {member}: {str(e)}")
+
+
+def join_session(address, session_id, side):
+    leave_session(address)
+    session_of[address] = (session_id, side)
+    sessions.setdefault(session_id, {})[side] = address
+
+
+def leave_session(address):
+    session_id, side = session_of.pop(address, (None, None))
+    members = sessions.get(session_id)
+    # A newer connection of the same side may have taken its place already
+    if members is not None and members.get(side) == address:
+        del members[side]
+        if not members:
+            del sessions[session_id]
+
+
+def resume_session(client_socket, address, token):
+    """Pairs a reconnected client with the other side of its session again.
+
+    Replies SESSION_RESUMED (to both sides) once paired, SESSION_WAIT if
+    the other side is not back yet, or SESSION_FAILED if the token is
+    malformed or the other side has paired with someone else since.
+    """
+    session_id, _, side = token.partition(".")
+    members = sessions.get(session_id, {})
+    others = [member for member_side, member in members.items() if member_side != side]
+    if not session_id or not side or len(others) > 1:
+        framing.send_text(client_socket, "SESSION_FAILED")
+        return
+
+    # The connection this one replaces may not have noticed it is dead yet
+    stale = members.get(side)
+    if stale is not None and stale != address:
+        log.info(f"[*] {address} replaces {stale} in its session")
+        if paired_clients.get(stale) is not None:
+            paired_clients.pop(paired_clients.pop(stale), None)
+        close_client(stale)
+
+    peer = others[0] if others else None
+    if peer is not None and paired_clients.get(peer) not in (None, address):
+        framing.send_text(client_socket, "SESSION_FAILED")
+        return
+    join_session(address, session_id, side)
+    if peer is None:
+        framing.send_text(client_socket, "SESSION_WAIT")
+        return
+
+    pair_clients(address, peer)
+    log.info(f"[+] {address} resumed its session with {peer}")
+    framing.send_text(client_socket, "SESSION_RESUMED")
+    try:
+        framing.send_text(clients[peer], "SESSION_RESUMED")
+    except Exception:
+        pass
+
+
+def close_client(address):
+    """Closes a client's connection; it is then cleaned up like any disconnect."""
+    connection = clients.get(address)
+    try:
+        if isinstance(connection, framing.LockedSocket):
+            # The reader thread closes the socket once its recv returns
+            connection.sock.shutdown(socket.SHUT_RDWR)
+        elif hasattr(connection, "abort"):
+            # A dead peer would never drain what is buffered for it
+            connection.abort()
+        elif connection is not None:
+            connection.close()
+    except OSError:
+        pass
+
+
+def start_timers(thread=True):
+    """Sets up heartbeats, idle eviction and stall checks on a new timer wheel.
+
+    The wheel is advanced by a thread of its own, or with ``thread`` unset
+    by the caller (the asyncio engine advances it on the event loop).
+    """
+    global timer_wheel, idle_monitor
+    timer_wheel = timerwheel.TimerWheel(
+        on_error=lambda timer, e: log.error(f"[-] Error in timer {timer.callback.__name__}: {str(e)}"))
+    idle_monitor = heartbeat.IdleMonitor(timer_wheel, idle_timeout, heartbeat_interval, evict_idle, send_heartbeat)
+    if thread:
+        timer_wheel.start()
+    log.info(f"[*] Heartbeat every {heartbeat_interval}s, idle timeout {idle_timeout}s, "
+             f"stall timeout {stall_timeout}s")
+    return timer_wheel
+
+
+def send_nowait(address, data):
+    """Writes ``data`` to a client from a timer, skipping it rather than waiting on it."""
+    connection = clients.get(address)
+    send = getattr(connection, "send_nowait", None)
+    try:
+        return send is not None and send(data)
+    except OSError:
+        return False
+
+
+def send_heartbeat(address):
+    """Asks a quiet client to answer with a PONG."""
+    # Data connections of a parallel transfer are never read by the client
+    if address not in data_links and send_nowait(address, PING_FRAME):
+        heartbeats_sent.inc()
+
+
+def evict_idle(address, quiet):
+    """Disconnects a client that sent nothing, not even a PONG, for too long."""
+    connection = clients.get(address)
+    if connection is None:
+        return
+    # Silence is expected while the relay itself is not reading from it
+    if getattr(connection, "reading_paused", False):
+        idle_monitor.touch(address)
+        return
+    idle_evictions.inc()
+    log.info(f"[-] Disconnecting {address}: nothing received for {quiet:.0f}s")
+    close_client(address)
+
+
+def transfer_progress(key):
+    """Bytes relayed so far to the sender and receiver of a file transfer.
+
+    Chunks and EOFs are relayed one way and the receiver's replies and
+    ACKs the other, so a transfer that moves changes one of them.
+    """
+    return tuple(connection_bytes.sent(address) for address in key)
+
+
+def watch_transfer(key, stream_id):
+    """Gives up the file transfer tracked under ``key`` once nothing moves for ``stall_timeout``."""
+    if timer_wheel is not None and stall_timeout:
+        timer_wheel.schedule(stall_timeout, check_transfer, key, stream_id, transfer_progress(key))
+
+
+def check_transfer(key, stream_id, progress):
+    transfer_info = file_transfers.get(key)
+    if transfer_info is None or transfer_info["stream_id"] != stream_id:
+        return  # Finished, or replaced by a newer one that has its own timer
+    now_progress = transfer_progress(key)
+    if now_progress != progress:
+        timer_wheel.schedule(stall_timeout, check_transfer, key, stream_id, now_progress)
+        return
+
+    sender_addr, paired_addr = key
+    del file_transfers[key]
+    bulk_finished(key)
+    stalled_transfers.inc()
+    log.info(f"[-] Giving up {transfer_info['name']} from {sender_addr} to {paired_addr}: "
+             f"nothing moved for {stall_timeout:.0f}s")
+    # Release what the transfer still holds, so the sender is not left paused
+    flow = flow_controls.get(sender_addr)
+    if flow is not None:
+        flow.finish_stream(stream_id)
+        resume_sender(sender_addr, flow)
+    stream_routes.pop((paired_addr, stream_id), None)
+    if chunk_cache is not None:
+        chunk_cache.release((sender_addr, stream_id))
+    send_nowait(sender_addr, framing.encode_frame(framing.TEXT, b"ERROR: Transfer stalled", stream_id))
+
+
+def bulk_started(key):
+    """Tunes the sender's and receiver's connections of a tracked file transfer for bulk data.
+
+    The relay never corks: it cannot tell when a sender is about to pause,
+    and a corked tail would then wait out the kernel's 200ms.
+    """
+    for address in key:
+        tuner = tuners.get(address)
+        if tuner is not None:
+            tuner.start(sockopts.BULK)
+
+
+def bulk_finished(key):
+    """Returns both connections of a file transfer that ended to the interactive profile."""
+    for address in key:
+        tuner = tuners.get(address)
+        if tuner is not None:
+            tuner.finish(sockopts.BULK)
+
+
+def store_chunk(address, payload):
+    """Adds a relayed chunk to the cache; a failing cache never stops the relay."""
+    try:
+        chunk_cache.put(chunkcache.chunk_hash(payload), payload)
+    except OSError as e:
+        log.sampled(("cache_error", address), f"[-] Could not cache chunk: {str(e)}", metrics.ERROR)
+
+
+def queue_for(address):
+    """Returns the IP to queue ``address``'s traffic for, or None to relay it live.
+
+    Traffic is queued while the peer is offline and, once it is back,
+    until everything queued before has been delivered, so live messages
+    never overtake queued ones.
+    """
+    if offline_queue is None:
+        return None
+    paired_addr = paired_clients.get(address)
+    if paired_addr is None:
+        return offline_peers.get(address)
+    if paired_addr in clients and not offline_queue.pending(paired_addr[0]):
+        return None
+    return paired_addr[0]
+
+
+def queue_message(client_socket, address, ip, frame, message):
+    # Queued in the form the sender used, as it would have been relayed
+    if not offline_queue.append(ip, frame.type, control_payload(frame, control.MSG, message.text)):
+        queue_rejected.inc()
+        framing.send_text(client_socket, f"QUEUE_FULL: {ip} is offline and its queue is full; message not delivered")
+        return
+    queued_frames.inc()
+    log.sampled(("queued", address), f"[+] Queued message from {address} for {ip}")
+    start_drain(ip, exclude=address)
+
+
+def queue_file(client_socket, address, ip, frame, message):
+    """Takes a file for an offline peer, answering the sender in its place.
+
+    The relay replies a plain ACK, so the sender neither resumes, nor
+    compresses, nor splits the file, and queued chunks hold exactly the
+    file's bytes. The header is queued without the codec and stream count,
+    followed by RESUME_FROM:0, under a stream id of the relay's own.
+    """
+    stream_id = frame.stream_id
+    if any(transfer[0] == ip for transfer in queued_transfers.values()):
+        framing.send_text(client_socket, f"ERROR: {ip} is offline and already has a file being queued", stream_id)
+        return
+    if offline_queue.room(ip) < message.size:
+        queue_rejected.inc()
+        framing.send_text(client_socket, f"ERROR: {ip} is offline and its queue is full", stream_id)
+        return
+    queued_stream = QUEUED_STREAM | next(queued_stream_ids) % QUEUED_STREAM
+    header = control_payload(frame, control.FILE, message.name, message.size, message.transfer_id)
+    offline_queue.append(ip, frame.type, header, queued_stream, force=True)
+    offline_queue.append(ip, framing.TEXT, b"RESUME_FROM:0", queued_stream, force=True)
+    queued_transfers[(address, stream_id)] = [ip, queued_stream, 0]
+    log.info(f"[+] Queueing {message.name} ({message.size} bytes) from {address} for {ip}")
+    framing.send_text(client_socket, "ACK", stream_id)
+    start_drain(ip, exclude=address)
+
+
+def queue_frame(client_socket, address, frame):
+    """Queues a chunk or the EOF of a file being queued, acknowledging it as the receiver would."""
+    transfer = queued_transfers[(address, frame.stream_id)]
+    ip, queued_stream, queued = transfer
+    if frame.type == framing.FILECHUNK:
+        offline_queue.append(ip, framing.FILECHUNK, frame.payload, queued_stream, framing.FLAG_WINDOWED,
+                             force=True)
+        transfer[2] += len(frame.payload)
+        queued_frames.inc()
+        queued_bytes.inc(len(frame.payload))
+        if frame.flags & framing.FLAG_WINDOWED:
+            framing.send_ack(client_socket, frame.stream_id, transfer[2])
+        else:
+            framing.send_text(client_socket, "ACK", frame.stream_id)
+    elif frame.type == framing.EOF:
+        del queued_transfers[(address, frame.stream_id)]
+        offline_queue.append(ip, framing.EOF, b"", queued_stream, force=True)
+        queued_frames.inc()
+        if chunk_cache is not None:
+            chunk_cache.release((address, frame.stream_id))
+        log.info(f"[+] Queued {queued} bytes from {address} for {ip}")
+        framing.send_text(client_socket, f"QUEUED: {queued} bytes of file data queued for {ip}")
+    # The sender's RESUME_FROM:0 was queued with the header already
+
+
+def start_drain(ip, address=None, exclude=None):
+    """Starts delivering ``ip``'s queue to ``address``, or to the first client with ``ip``.
+
+    Does nothing if the queue is empty, already being delivered, or nobody
+    with ``ip`` is connected.
+    """
+    if offline_queue is None or not offline_queue.pending(ip):
+        return
+    with drain_lock:
+        if ip in queue_drains:
+            return
+        if address is None:
+            address = find_client(ip, exclude=exclude)
+            if address is None:
+                return
+        queue_drains[ip] = address
+    threading.Thread(target=drain_queue, args=(ip, address), name=f"drain-{ip}", daemon=True).start()
+
+
+def is_file_header(record):
+    """Whether a queued record is the FILE message a queued file starts with, in either form."""
+    if record.type == framing.CONTROL:
+        return record.payload[:1] == FILE_CODE
+    return record.payload.startswith(b"FILE:")
+
+
+def drain_queue(ip, address):
+    """Delivers the frames queued for ``ip`` to ``address``, oldest first.
+
+    Queued file chunks are windowed, so the receiver's ACKs pace the drain
+    through a FlowControl as they would a sender; messages are paced by the
+    socket. The read position is only committed between files, so a drain
+    cut short starts again with the file it was delivering. Chunks of a
+    file whose start expired or whose sender went away are skipped.
+    """
+    flow = backpressure.FlowControl(max_in_flight)
+    drain_flows[address] = flow
+    position = committed = offline_queue.start(ip)
+    open_stream = None
+    delivered = uncommitted = 0
+    try:
+        while address in clients and position is not None:
+            record, next_position = offline_queue.read(ip, position)
+            if record is None:
+                # A file is still coming in for this peer
+                if any(transfer[0] == ip for transfer in queued_transfers.values()):
+                    offline_queue.wait(ip, position)
+                    continue
+                with drain_lock:
+                    if offline_queue.finish(ip, position):
+                        committed = None
+                        break
+                continue
+
+            position = next_position
+            if record.type in (framing.TEXT, framing.CONTROL) and record.stream_id:
+                if is_file_header(record):
+                    open_stream = record.stream_id
+                elif record.stream_id != open_stream:
+                    continue
+                elif record.payload.startswith(b"ERROR:"):
+                    # Marks a file whose sender went away part way
+                    open_stream = None
+                    continue
+            elif record.type in (framing.FILECHUNK, framing.EOF) and record.stream_id != open_stream:
+                continue
+
+            connection = clients.get(address)
+            if connection is None:
+                break
+            if record.type == framing.FILECHUNK:
+                flow.forwarded(record.stream_id, len(record.payload))
+            framing.send_frame(connection, record.type, record.payload, record.stream_id, record.flags)
+            delivered += 1
+            delivered_frames.inc()
+            connection_bytes.add(address, sent=framing.HEADER_SIZE + len(record.payload))
+            if record.type == framing.EOF:
+                flow.finish_stream(record.stream_id)
+                open_stream = None
+
+            while flow.over_limit() and address in clients:
+                flow.wait_for_room()
+            if open_stream is None:
+                # Where to start again if the drain is cut short
+                committed = position
+                uncommitted += 1
+                if uncommitted >= COMMIT_EVERY:
+                    offline_queue.commit(ip, position)
+                    uncommitted = 0
     except Exception as e:
-        print(f"[-] General error: {str(e)}")
+        log.error(f"[-] Error delivering queued frames to {address}: {str(e)}")
     finally:
-        print(f"[*] Connection closed: {address}")
+        if committed is not None:
+            offline_queue.commit(ip, committed)
+        drain_flows.pop(address, None)
+        with drain_lock:
+            if queue_drains.get(ip) == address:
+                del queue_drains[ip]
+        log.info(f"[+] Delivered {delivered} queued frames to {address}")
+
+
+def register_client(address, connection):
+    """Makes a newly accepted client reachable for relaying and pairing."""
+    clients[address] = connection
+    tuners[address] = sockopts.Tuner(connection.sock)
+    client_index.add(address, address[0])
+    connections_accepted.inc()
+    if idle_monitor is not None:
+        idle_monitor.add(address)
+    # Deliver what was queued for this IP while it was offline
+    start_drain(address[0], address)
+
+
+def remove_client(address):
+    """Drops all relay state held for a disconnected client."""
+    if cluster is not None:
+        cluster.client_gone(address)
+    client_index.remove(address)
+
+    # Clean up file transfers
+    for key in list(file_transfers.keys()):
+        if address in key:
+            del file_transfers[key]
+            bulk_finished(key)
+    tuners.pop(address, None)
+
+    # Data connections of a parallel transfer end with their client
+    data_links.pop(address, None)
+    for link, primary in list(data_links.items()):
+        if primary == address:
+            del data_links[link]
+    for key, sender in list(stream_routes.items()):
+        if address in (key[0], sender):
+            del stream_routes[key]
+
+    # Files it was queueing end unfinished; a queued file it was being
+    # delivered is sent again from the start next time
+    for key in [key for key in queued_transfers if key[0] == address]:
+        ip, queued_stream, _ = queued_transfers.pop(key)
+        offline_queue.append(ip, framing.TEXT, b"ERROR: Sender disconnected", queued_stream, force=True)
+    flow = drain_flows.pop(address, None)
+    if flow is not None:
+        flow.reset()
+    offline_peers.pop(address, None)
+    leave_session(address)
+    if idle_monitor is not None:
+        idle_monitor.remove(address)
+
+    # Clean up paired clients; the peer must not wait on ACKs that won't come
+    flow_controls.pop(address, None)
+    if chunk_cache is not None:
+        for owner in chunk_cache.owners():
+            if owner[0] == address:
+                chunk_cache.release(owner)
+    if address in paired_clients:
+        paired_addr = paired_clients.pop(address)
+        paired_clients.pop(paired_addr, None)
+        release_flow(paired_addr)
+        # What the peer sends from now on is queued for this client's IP
+        if offline_queue is not None:
+            offline_peers[paired_addr] = address[0]
+        # Lets the peer stop its transfers now instead of timing out
+        try:
+            framing.send_text(clients[paired_addr], "PEER_DISCONNECTED")
+        except Exception:
+            pass
+
+    # Remove from clients dictionary
+    if address in clients:
+        del clients[address]
+
+    totals = connection_bytes.remove(address)
+    for key in ("chunk", "chunk_error", "cache_error", "message", "queued"):
+        log.forget((key, address))
+    if totals is not None:
+        log.info(f"[*] {address} sent {totals[0]} bytes, received {totals[1]} bytes")
+
+
+def splice_chunk(splicer, client_socket, writer, address, decoder):
+    """Relays the rest of a large FILECHUNK from socket to socket in the kernel.
+
+    Called when the decoder holds a chunk header but not the whole payload.
+    The header and buffered part are written to the paired client, then the
+    missing bytes are spliced across without entering Python. Returns False
+    if the partial frame should be left to the normal path.
+    """
+    partial = decoder.partial_frame()
+    if partial is None:
+        return False
+    frame, missing = partial
+    if frame.type != framing.FILECHUNK or missing < relay.MIN_SPLICE_BYTES:
+        return False
+    if queued_transfers and (address, frame.stream_id) in queued_transfers:
+        return False
+    paired_addr = peer_of(address)
+    peer = clients.get(paired_addr)
+    if not isinstance(peer, framing.LockedSocket):
+        return False
+
+    length = len(frame.payload) + missing
+    header = framing.encode_header(frame.type, length, frame.stream_id, frame.flags)
+    with peer.write_lock:
+        try:
+            framing.sendall_buffers(peer.sock, (header, frame.payload))
+            splicer.forward(client_socket.fileno(), peer.sock.fileno(), missing)
+        except Exception:
+            # The receiver got a truncated frame, so its stream is unusable
+            try:
+                peer.sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            raise
+    decoder.discard_partial()
+    chunk_bytes.observe(length)
+    frames_received.inc()
+    frames_relayed.inc()
+    connection_bytes.add(address, received=missing)
+    connection_bytes.add(paired_addr, sent=len(header) + length)
+    log.sampled(("chunk", address), f"[+] Forwarded {length} bytes chunk from {address} to {paired_addr}.")
+
+    # Windowed transfers are acknowledged end to end by the receiver
+    if frame.flags & framing.FLAG_WINDOWED:
+        get_flow(address).forwarded(frame.stream_id, length)
+        if address in data_links:
+            stream_routes[(paired_addr, frame.stream_id)] = address
+    else:
+        framing.send_text(writer, "ACK", frame.stream_id)
+    return True
+
+
+def handle_client(client_socket, address, splice=False):
+    """Handles communication with a connected client.
+
+    With ``splice`` set, large file chunks bypass the receive buffer and are
+    moved to the paired socket with os.splice.
+    """
+    log.info(f"[*] Accepted connection from {address}")
+
+    splicer = None
+    try:
+        # Frames are parsed in place from one reusable receive buffer
+        decoder = framing.FrameDecoder()
+        # Writes go through the locked wrapper stored by the accept loop
+        writer = clients.get(address, client_socket)
+        liveness = idle_monitor.get(address) if idle_monitor is not None else None
+        while True:
+            nbytes = decoder.recv_from(client_socket)
+            if not nbytes:
+                break  # Client disconnected
+            connection_bytes.add(address, received=nbytes)
+            if liveness is not None:
+                liveness.touch()
+
+            for frame in decoder.frames():
+                handle_frame(writer, address, frame)
+
+            # Spliced chunks never enter Python, so they could not be cached
+            if splice and chunk_cache is None:
+                if splicer is None:
+                    splicer = relay.SpliceRelay()
+                splice_chunk(splicer, client_socket, writer, address, decoder)
+
+            # Stop reading while too much of this sender's data is unacknowledged
+            flow = flow_controls.get(address)
+            while flow is not None and flow.over_limit() and address in clients:
+                flow.wait_for_room()
+                flow = flow_controls.get(address)
+                # Not reading from it is our doing, not a sign it is gone
+                if liveness is not None:
+                    liveness.touch()
+
+    except Exception as e:
+        log.error(f"[-] General error: {str(e)}")
+    finally:
+        log.info(f"[*] Connection closed: {address}")
         client_socket.close()
-        
-        # Clean up file transfers
-        for key in list(file_transfers.keys()):
-            if address in key:
-                del file_transfers[key]
-        
-        # Clean up paired clients
-        if address in paired_clients:
-            paired_addr = paired_clients[address]
-            if paired_addr in paired_clients:
-                del paired_clients[paired_addr]
-            del paired_clients[address]
-        
-        # Remove from clients dictionary
-        if address in clients:
-            del clients[address]
-
-def start_server():
-    """Starts the server and listens for incoming connections."""
+        remove_client(address)
+        if splicer is not None:
+            splicer.close()
+
+
+def start_threaded_server(host="0.0.0.0", port=12345, splice=relay.SPLICE_AVAILABLE, reuse_port=False):
+    """Accepts connections and serves each one on its own thread.
+
+    With ``reuse_port`` several processes can listen on the same port and
+    the kernel spreads new connections across them.
+    """
     server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    server.bind(("0.0.0.0", 12345))
-    server.listen(5)
-    
-    print("[*] Listening on 0.0.0.0:12345")
-    print("[*] No encryption key needed - using built-in XOR encryption")
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    server.bind((host, port))
+    server.listen(LISTEN_BACKLOG)
+    # Started here, so that each worker of a cluster runs its own
+    start_timers()
+
+    log.info(f"[*] Listening on {host}:{port} (threaded engine)")
+    log.info("[*] No encryption key needed - using built-in XOR encryption")
 
     while True:
         client_socket, address = server.accept()
-        clients[address] = client_socket  # Store connected client
-        client_thread = threading.Thread(target=handle_client, args=(client_socket, address))
+        # Store connected client; writes come from several threads
+        register_client(address, framing.LockedSocket(client_socket))
+        client_thread = threading.Thread(target=handle_client, args=(client_socket, address, splice))
         client_thread.start()
 
+
+def start_server(host="0.0.0.0", port=12345, engine="threaded", splice=relay.SPLICE_AVAILABLE,
+                 in_flight=backpressure.DEFAULT_MAX_IN_FLIGHT, workers=1, metrics_file=None,
+                 metrics_interval=10.0, heartbeat_every=heartbeat.DEFAULT_HEARTBEAT_INTERVAL,
+                 idle_after=heartbeat.DEFAULT_IDLE_TIMEOUT, stall_after=heartbeat.DEFAULT_STALL_TIMEOUT):
+    """Starts the server and listens for incoming connections.
+
+    With more than one worker the threaded engine is forked into that many
+    processes sharing the port (see cluster.py). With ``metrics_file`` a
+    Prometheus text snapshot is rewritten every ``metrics_interval`` seconds.
+    Quiet clients are sent a heartbeat every ``heartbeat_every`` seconds and
+    disconnected after ``idle_after``; file transfers that do not move for
+    ``stall_after`` seconds are given up. 0 disables each of them.
+    """
+    global max_in_flight, heartbeat_interval, idle_timeout, stall_timeout
+    max_in_flight = in_flight
+    heartbeat_interval, idle_timeout, stall_timeout = heartbeat_every, idle_after, stall_after
+    if offline_queue is not None and (workers > 1 or engine != "threaded"):
+        # Queues are delivered by a thread writing to the recipient's socket
+        raise ValueError("The offline queue is only supported with the threaded engine and one worker")
+    if workers > 1:
+        if engine != "threaded":
+            raise ValueError("Multiple workers are only supported with the threaded engine")
+        import cluster
+        cluster.start_cluster(host, port, workers, splice, in_flight, metrics_file, metrics_interval)
+        return
+    if metrics_file:
+        registry.export_every(metrics_file, metrics_interval)
+    if engine == "asyncio":
+        import server6_async
+        server6_async.start_server(host, port)
+    elif engine == "threaded":
+        start_threaded_server(host, port, splice)
+    else:
+        raise ValueError(f"Unknown engine {engine!r}, expected one of {ENGINES}")
+
+
 if __name__ == "__main__":
-    start_server()
+    # server6_async and cluster import this module by name; make that the
+    # running script rather than a second copy with its own state
+    sys.modules.setdefault("server6", sys.modules[__name__])
+
+    parser = argparse.ArgumentParser(description="Paired relay server")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=12345)
+    parser.add_argument("--engine", choices=ENGINES, default="threaded",
+                        help="threaded: one thread per client; asyncio: single event loop")
+    parser.add_argument("--no-splice", dest="splice", action="store_false",
+                        help="relay file chunks through Python buffers instead of os.splice")
+    parser.add_argument("--max-in-flight", type=int, default=backpressure.DEFAULT_MAX_IN_FLIGHT,
+                        help="unacknowledged bytes per sender before the relay stops reading from it")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="processes sharing the port via SO_REUSEPORT (threaded engine only)")
+    parser.add_argument("--log-level", choices=metrics.LEVELS, default="info",
+                        help="per-chunk and per-message lines are rate limited at info, all shown at debug")
+    parser.add_argument("--metrics-file",
+                        help="write a Prometheus text snapshot of the relay metrics to this file")
+    parser.add_argument("--metrics-interval", type=float, default=10.0,
+                        help="seconds between metrics snapshots")
+    parser.add_argument("--chunk-cache", metavar="DIR",
+                        help="cache relayed file chunks in DIR so repeated files skip the sender's uplink")
+    parser.add_argument("--chunk-cache-bytes", type=int, default=chunkcache.DEFAULT_MAX_BYTES,
+                        help="size limit of the chunk cache; least recently used chunks are evicted")
+    parser.add_argument("--offline-queue", metavar="DIR",
+                        help="keep messages and files for offline peers in DIR and deliver them when they reconnect")
+    parser.add_argument("--offline-queue-bytes", type=int, default=offlinequeue.DEFAULT_MAX_BYTES,
+                        help="undelivered bytes kept per offline peer; more is refused")
+    parser.add_argument("--offline-queue-age", type=float, default=offlinequeue.DEFAULT_MAX_AGE,
+                        help="seconds undelivered messages and files are kept")
+    parser.add_argument("--heartbeat-interval", type=float, default=heartbeat.DEFAULT_HEARTBEAT_INTERVAL,
+                        help="seconds a client may be quiet before it is asked for a heartbeat (0: never)")
+    parser.add_argument("--idle-timeout", type=float, default=heartbeat.DEFAULT_IDLE_TIMEOUT,
+                        help="seconds a client may send nothing, heartbeats included, before it is dropped (0: never)")
+    parser.add_argument("--stall-timeout", type=float, default=heartbeat.DEFAULT_STALL_TIMEOUT,
+                        help="seconds a file transfer may make no progress before it is given up (0: never)")
+    args = parser.parse_args()
+    log.level = metrics.LEVELS[args.log_level]
+    if args.chunk_cache:
+        chunk_cache = chunkcache.ChunkCache(args.chunk_cache, args.chunk_cache_bytes)
+        log.info(f"[*] Chunk cache in {args.chunk_cache}: {len(chunk_cache)} chunks, {chunk_cache.total_bytes} bytes")
+    if args.offline_queue:
+        offline_queue = offlinequeue.OfflineQueue(args.offline_queue, args.offline_queue_bytes, args.offline_queue_age)
+        log.info(f"[*] Offline queue in {args.offline_queue}: {offline_queue.total_bytes} bytes undelivered")
+    start_server(args.host, args.port, args.engine, args.splice and relay.SPLICE_AVAILABLE,
+                 args.max_in_flight, args.workers, args.metrics_file, args.metrics_interval,
+                 args.heartbeat_interval, args.idle_timeout, args.stall_timeout)
@@ -0,0 +1,188 @@
+import asyncio
+import time
+
+import framing
+import server6
+
+# Large listen backlog so connection storms are not refused by the kernel
+LISTEN_BACKLOG = 4096
+# Bytes buffered for a slow client before its sender is paused
+WRITE_BUFFER_HIGH = 1024 * 1024
+
+
+class RelayProtocol(asyncio.BufferedProtocol):
+    """One connected client on the event loop.
+
+    Exposes the small socket-like surface ``server6.handle_frame`` uses, so
+    both engines share the same PAIR/FILE/FILECHUNK/EOF/MSG handling. An idle
+    connection costs one protocol object and a transport, not a thread stack.
+    The transport reads straight into the frame decoder's buffer.
+
+    Backpressure uses the transport's flow control: reading from a sender is
+    paused while it has too much unacknowledged data in flight or while its
+    receiver's write buffer is above the high-water mark.
+    """
+
+    def __init__(self):
+        self.transport = None
+        self.sock = None
+        self.address = None
+        self.decoder = framing.FrameDecoder()
+        self._pause_reasons = set()
+        self._write_paused_since = None
+        self.liveness = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        # For socket options only; reads and writes go through the transport
+        self.sock = transport.get_extra_info("socket")
+        self.address = transport.get_extra_info("peername")
+        transport.set_write_buffer_limits(high=WRITE_BUFFER_HIGH)
+        server6.log.info(f"[*] Accepted connection from {self.address}")
+        server6.register_client(self.address, self)
+        if server6.idle_monitor is not None:
+            self.liveness = server6.idle_monitor.get(self.address)
+
+    def get_buffer(self, sizehint):
+        return self.decoder.get_buffer(sizehint)
+
+    def buffer_updated(self, nbytes):
+        self.decoder.buffer_updated(nbytes)
+        server6.connection_bytes.add(self.address, received=nbytes)
+        if self.liveness is not None:
+            self.liveness.touch()
+        try:
+            for frame in self.decoder.frames():
+                server6.handle_frame(self, self.address, frame)
+        except Exception as e:
+            server6.log.error(f"[-] General error: {str(e)}")
+            self.transport.close()
+
+    def connection_lost(self, exc):
+        server6.log.info(f"[*] Connection closed: {self.address}")
+        if self._write_paused_since is not None:
+            self.resume_writing()
+        server6.remove_client(self.address)
+
+    @property
+    def reading_paused(self):
+        """True while the relay holds off reading; the client's silence then means nothing."""
+        return bool(self._pause_reasons)
+
+    def pause_reading(self, reason):
+        """Stops reading from this client until every pause reason is lifted."""
+        if not self._pause_reasons and not self.transport.is_closing():
+            self.transport.pause_reading()
+        self._pause_reasons.add(reason)
+
+    def resume_reading(self, reason):
+        if reason not in self._pause_reasons:
+            return
+        self._pause_reasons.discard(reason)
+        if not self._pause_reasons and not self.transport.is_closing():
+            self.transport.resume_reading()
+
+    def _sender(self):
+        sender_addr = server6.paired_clients.get(self.address)
+        return sender_addr, server6.clients.get(sender_addr)
+
+    def pause_writing(self):
+        """Called by the transport when this client stops keeping up."""
+        self._write_paused_since = time.monotonic()
+        sender_addr, sender = self._sender()
+        if sender is not None:
+            sender.pause_reading("receiver")
+
+    def resume_writing(self):
+        """Called by the transport once this client has drained its buffer."""
+        sender_addr, sender = self._sender()
+        if self._write_paused_since is not None and sender_addr is not None:
+            server6.get_flow(sender_addr).add_receiver_blocked(time.monotonic() - self._write_paused_since)
+        self._write_paused_since = None
+        if sender is not None:
+            sender.resume_reading("receiver")
+
+    def sendall(self, data):
+        """Queues data on the transport; never blocks the event loop.
+
+        Payloads are often views of a FrameDecoder's buffer, which is reused
+        for the next read, and the transport may keep what it is given
+        (Python 3.12+ does, views included), so anything but bytes is copied.
+        """
+        if self.transport.is_closing():
+            raise ConnectionError("Transport is closed")
+        self.transport.write(data if type(data) is bytes else bytes(data))
+
+    def sendall_buffers(self, buffers):
+        # One copy joins them; a single write also applies the write buffer
+        # limits, which writelines skips on Python 3.12+
+        self.sendall(b"".join(buffers))
+
+    def send_nowait(self, data):
+        # Transport writes are buffered and never wait
+        if self.transport.is_closing():
+            return False
+        self.transport.write(data if type(data) is bytes else bytes(data))
+        return True
+
+    def close(self):
+        self.transport.close()
+
+    def abort(self):
+        """Closes at once, dropping whatever is still buffered for the client."""
+        self.transport.abort()
+
+
+def raise_fd_limit():
+    """Lifts the open-file soft limit to the hard limit, where supported."""
+    try:
+        import resource
+    except ImportError:
+        return None
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+            soft = hard
+        except (ValueError, OSError):
+            pass
+    return soft
+
+
+async def advance_timers(wheel):
+    """Advances the relay's timer wheel every tick, so its callbacks run on the loop."""
+    while True:
+        await asyncio.sleep(wheel.tick)
+        wheel.advance()
+
+
+async def serve(host="0.0.0.0", port=12345):
+    """Runs the relay on the current event loop until cancelled."""
+    loop = asyncio.get_running_loop()
+    timers = loop.create_task(advance_timers(server6.start_timers(thread=False)))
+    server = await loop.create_server(
+        RelayProtocol, host, port, backlog=LISTEN_BACKLOG, reuse_address=True
+    )
+
+    server6.log.info(f"[*] Listening on {host}:{port} (asyncio engine)")
+    server6.log.info("[*] No encryption key needed - using built-in XOR encryption")
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        timers.cancel()
+
+
+def start_server(host="0.0.0.0", port=12345):
+    """Starts the asyncio engine and blocks until interrupted."""
+    limit = raise_fd_limit()
+    if limit is not None:
+        server6.log.info(f"[*] Open file limit: {limit}")
+    try:
+        asyncio.run(serve(host, port))
+    except KeyboardInterrupt:
+        print("\n[*] Server shutting down.")
+
+
+if __name__ == "__main__":
+    start_server()
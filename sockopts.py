@@ -0,0 +1,119 @@
+import socket
+import threading
+from collections import namedtuple
+
+# Traffic profiles a connection can be switched between
+INTERACTIVE = "interactive"    # Chat and control messages: each write leaves at once
+BULK = "bulk"                  # File data: large buffers, a short queue of unsent bytes
+BULK_CORKED = "bulk-corked"    # BULK for a sender that pushes before it waits for replies
+PROFILES = (INTERACTIVE, BULK, BULK_CORKED)
+
+# Socket buffer size while bulk data moves: room for a 4 MB window, the
+# default transfer.SendWindow, to be in flight
+BULK_BUFFER = 4 * 1024 * 1024
+
+# Settings of one profile; None leaves an option as it is
+Profile = namedtuple("Profile", ["nodelay", "cork", "sndbuf", "rcvbuf", "notsent_lowat"])
+
+PROFILE_OPTIONS = {
+    # No Nagle, so a small write is not held back until the previous one is
+    # acknowledged (which delayed ACK can stretch to 40ms), and little data
+    # queued unsent in the kernel in front of the next message
+    INTERACTIVE: Profile(nodelay=True, cork=False, sndbuf=None, rcvbuf=None, notsent_lowat=16 * 1024),
+    # Buffers big enough to keep the link busy; unsent data is still capped
+    # (in-flight data is not), so a message written mid-transfer waits
+    # behind at most this much file data
+    BULK: Profile(nodelay=True, cork=False, sndbuf=BULK_BUFFER, rcvbuf=BULK_BUFFER, notsent_lowat=256 * 1024),
+    # Also corked: frame tails are merged into full segments instead of
+    # going out as small ones. The kernel holds back a partial segment for
+    # up to 200ms, so the writer must ``push`` before waiting on its peer
+    BULK_CORKED: Profile(nodelay=True, cork=True, sndbuf=BULK_BUFFER, rcvbuf=BULK_BUFFER,
+                         notsent_lowat=256 * 1024),
+}
+
+# Not every platform has these
+TCP_CORK = getattr(socket, "TCP_CORK", None)
+TCP_NOTSENT_LOWAT = getattr(socket, "TCP_NOTSENT_LOWAT", None)
+
+
+def _set(sock, level, option, value):
+    if option is None:
+        return False
+    try:
+        sock.setsockopt(level, option, value)
+        return True
+    except OSError:
+        # Closed already, or not a TCP socket (e.g. a socketpair in tests)
+        return False
+
+
+def apply_profile(sock, profile):
+    """Sets the options of ``profile`` (a name from PROFILES) on ``sock``."""
+    options = PROFILE_OPTIONS[profile]
+    if options.nodelay is not None:
+        _set(sock, socket.IPPROTO_TCP, socket.TCP_NODELAY, int(options.nodelay))
+    if options.sndbuf is not None:
+        _set(sock, socket.SOL_SOCKET, socket.SO_SNDBUF, options.sndbuf)
+    if options.rcvbuf is not None:
+        _set(sock, socket.SOL_SOCKET, socket.SO_RCVBUF, options.rcvbuf)
+    if options.notsent_lowat is not None:
+        _set(sock, socket.IPPROTO_TCP, TCP_NOTSENT_LOWAT, options.notsent_lowat)
+    if options.cork is not None:
+        # Uncorking sends whatever the cork held back
+        _set(sock, socket.IPPROTO_TCP, TCP_CORK, int(options.cork))
+
+
+class Tuner:
+    """Switches one connection's socket options as transfers on it start and end.
+
+    Each transfer calls ``start(profile)`` and ``finish(profile)``; while any
+    is running the connection uses the strongest profile among them
+    (BULK_CORKED over BULK), and INTERACTIVE once all are done. Buffers
+    grown for bulk data stay grown: shrinking them would gain nothing, and
+    the unsent-data cap is what keeps interactive writes quick.
+
+    A corked connection should be ``push``ed whenever its writer is about
+    to wait for the peer or has written something the peer waits for.
+    """
+
+    def __init__(self, sock, profile=INTERACTIVE):
+        self.sock = sock
+        self.profile = None
+        self._active = {BULK: 0, BULK_CORKED: 0}
+        self._lock = threading.Lock()
+        self._use(profile)
+
+    def _use(self, profile):
+        if profile != self.profile:
+            apply_profile(self.sock, profile)
+            self.profile = profile
+
+    def _update(self):
+        if self._active[BULK_CORKED]:
+            self._use(BULK_CORKED)
+        elif self._active[BULK]:
+            self._use(BULK)
+        else:
+            self._use(INTERACTIVE)
+
+    def start(self, profile=BULK):
+        with self._lock:
+            self._active[profile] += 1
+            self._update()
+
+    def finish(self, profile=BULK):
+        with self._lock:
+            if self._active[profile]:
+                self._active[profile] -= 1
+            self._update()
+
+    @property
+    def corked(self):
+        return self.profile == BULK_CORKED and TCP_CORK is not None
+
+    def push(self):
+        """Sends out anything the cork is holding back; the connection stays corked."""
+        with self._lock:
+            if self.corked:
+                _set(self.sock, socket.IPPROTO_TCP, TCP_CORK, 0)
+                _set(self.sock, socket.IPPROTO_TCP, TCP_CORK, 1)
@@ -0,0 +1,160 @@
+import threading
+import time
+
+# Resolution of the wheel; timers fire up to one tick late
+DEFAULT_TICK = 0.1
+# Slots per level, as a power of two, and the number of levels: 64**4 ticks
+# of 0.1s cover about 19 days
+SLOT_BITS = 6
+LEVELS = 4
+
+
+def _report_error(timer, error):
+    print(f"[-] Timer callback {timer.callback.__name__} failed: {error}")
+
+
+class Timer:
+    """A callback scheduled on a TimerWheel; pass it to ``cancel`` or ``reschedule``."""
+
+    __slots__ = ("expires", "callback", "args", "slot")
+
+    def __init__(self, expires, callback, args):
+        self.expires = expires
+        self.callback = callback
+        self.args = args
+        # The set it is filed in, or None once it fired or was cancelled
+        self.slot = None
+
+    @property
+    def active(self):
+        return self.slot is not None
+
+
+class TimerWheel:
+    """Hierarchical timing wheel for many coarse timeouts.
+
+    Level 0 has one slot per tick; each slot of level ``n`` spans a whole
+    turn of level ``n - 1``. A timer is filed in the lowest level whose
+    range covers its expiry and moves down a level each time the level
+    below wraps around to it, so scheduling, cancelling and rescheduling
+    are O(1) however many timers are pending, and a tick only touches the
+    timers that fire in it plus those cascading down. Timeouts longer than
+    the wheel's range are clamped to it.
+
+    Timers may be scheduled and cancelled from any thread. Callbacks run on
+    whichever thread calls ``advance``: the wheel's own thread after
+    ``start``, or e.g. an event loop that calls it every tick. They run
+    outside the wheel's lock, so they may schedule and cancel timers.
+    """
+
+    def __init__(self, tick=DEFAULT_TICK, slot_bits=SLOT_BITS, levels=LEVELS, on_error=None):
+        self.tick = tick
+        # Called with (timer, exception) when a callback raises
+        self.on_error = on_error or _report_error
+        self._bits = slot_bits
+        self._mask = (1 << slot_bits) - 1
+        self._range = 1 << (slot_bits * levels)
+        self._wheels = [[set() for _ in range(1 << slot_bits)] for _ in range(levels)]
+        self._origin = time.monotonic()
+        self._current = 0
+        self._count = 0
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+
+    def __len__(self):
+        return self._count
+
+    def schedule(self, delay, callback, *args):
+        """Calls ``callback(*args)`` in ``delay`` seconds; returns its Timer."""
+        timer = Timer(0, callback, args)
+        with self._lock:
+            self._file(timer, self._expiry(delay))
+            self._count += 1
+        return timer
+
+    def cancel(self, timer):
+        """Stops ``timer`` from firing; does nothing if it already fired."""
+        with self._lock:
+            if timer.slot is not None:
+                timer.slot.discard(timer)
+                timer.slot = None
+                self._count -= 1
+
+    def reschedule(self, timer, delay):
+        """Makes ``timer`` fire in ``delay`` seconds instead, even if it already fired."""
+        with self._lock:
+            if timer.slot is not None:
+                timer.slot.discard(timer)
+            else:
+                self._count += 1
+            self._file(timer, self._expiry(delay))
+
+    def _expiry(self, delay):
+        # Counted from now rather than from the last tick, and rounded up,
+        # so a timer never fires early
+        expires = -int(-(time.monotonic() - self._origin + delay) // self.tick)
+        return min(max(expires, self._current + 1), self._current + self._range - 1)
+
+    def _file(self, timer, expires):
+        timer.expires = expires
+        remaining = expires - self._current
+        level = 0
+        while remaining >> (self._bits * (level + 1)) and level + 1 < len(self._wheels):
+            level += 1
+        slot = self._wheels[level][(expires >> (self._bits * level)) & self._mask]
+        slot.add(timer)
+        timer.slot = slot
+
+    def advance(self, now=None):
+        """Fires every timer due by ``now`` (default: the current time); returns how many fired."""
+        if now is None:
+            now = time.monotonic()
+        target = int((now - self._origin) / self.tick)
+        fired = 0
+        while True:
+            with self._lock:
+                if self._current >= target:
+                    break
+                due = self._step()
+            for timer in due:
+                # A failing callback must not keep the others from firing
+                try:
+                    timer.callback(*timer.args)
+                except Exception as e:
+                    self.on_error(timer, e)
+            fired += len(due)
+        return fired
+
+    def _step(self):
+        """Moves the wheel one tick on; returns the timers that fire in it."""
+        self._current += 1
+        current = self._current
+        # Each level whose lower levels just wrapped hands its current slot down
+        for level in range(1, len(self._wheels)):
+            if current & ((1 << (self._bits * level)) - 1):
+                break
+            slot = self._wheels[level][(current >> (self._bits * level)) & self._mask]
+            timers = list(slot)
+            slot.clear()
+            for timer in timers:
+                self._file(timer, timer.expires)
+        slot = self._wheels[0][current & self._mask]
+        due = list(slot)
+        slot.clear()
+        for timer in due:
+            timer.slot = None
+        self._count -= len(due)
+        return due
+
+    def start(self, name="timer-wheel"):
+        """Advances the wheel every tick on a daemon thread of its own."""
+        thread = threading.Thread(target=self._run, name=name, daemon=True)
+        thread.start()
+        return thread
+
+    def _run(self):
+        while not self._stopped.wait(self.tick):
+            self.advance()
+
+    def stop(self):
+        self._stopped.set()
@@ -0,0 +1,173 @@
+import threading
+import time
+
+# Default number of unacknowledged bytes a sender keeps in flight
+DEFAULT_WINDOW = 4 * 1024 * 1024
+
+
+class TransferAborted(Exception):
+    """Raised to a waiting sender when its transfer can no longer complete."""
+
+
+class TransferDisconnected(TransferAborted):
+    """Raised when the connection a transfer was sent over is lost; it may be sent again once back."""
+
+
+class SendWindow:
+    """Flow control for one outgoing windowed transfer.
+
+    The sending thread calls ``wait_for_room`` before each chunk and ``sent``
+    after it; the network thread feeds in the receiver's cumulative ACKs with
+    ``ack``. Up to ``window_size`` bytes may be unacknowledged at once, so
+    the link stays busy for a full round trip instead of one chunk per RTT.
+    """
+
+    def __init__(self, window_size=DEFAULT_WINDOW, start=0):
+        self.window_size = window_size
+        # Offsets are absolute, so a resumed transfer starts part way in
+        self.sent_bytes = start
+        self.acked_bytes = start
+        self.error = None
+        self._error_type = TransferAborted
+        self._cond = threading.Condition()
+
+    def in_flight(self):
+        """Bytes sent but not yet acknowledged by the receiver."""
+        return self.sent_bytes - self.acked_bytes
+
+    def _wait(self, predicate, timeout):
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while not predicate():
+                if self.error is not None:
+                    raise self._error_type(self.error)
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise TimeoutError(f"No ACK from receiver for {timeout} seconds")
+                self._cond.wait(remaining)
+            if self.error is not None:
+                raise self._error_type(self.error)
+
+    def has_room(self, nbytes):
+        """True if ``nbytes`` more can be sent now without overrunning the window.
+
+        A chunk larger than the whole window is let through once the window
+        has fully drained, so small windows cannot deadlock.
+        """
+        in_flight = self.in_flight()
+        return in_flight == 0 or in_flight + nbytes <= self.window_size
+
+    def wait_for_room(self, nbytes, timeout=30):
+        """Blocks until ``has_room(nbytes)``."""
+        self._wait(lambda: self.has_room(nbytes), timeout)
+
+    def sent(self, nbytes):
+        with self._cond:
+            self.sent_bytes += nbytes
+
+    def ack(self, offset):
+        """Records a cumulative ACK covering every byte before ``offset``."""
+        with self._cond:
+            if offset > self.acked_bytes:
+                self.acked_bytes = offset
+                self._cond.notify_all()
+
+    def wait_all_acked(self, timeout=30):
+        """Blocks until the receiver has acknowledged everything sent."""
+        self._wait(lambda: self.acked_bytes >= self.sent_bytes, timeout)
+
+    def abort(self, reason, error=TransferAborted):
+        """Wakes the sender with ``error``, TransferAborted or a subclass of it (e.g. on disconnect)."""
+        with self._cond:
+            self.error = reason
+            self._error_type = error
+            self._cond.notify_all()
+
+
+# Parallel transfers open one stream per MIN_RANGE bytes of file, up to MAX_STREAMS
+MIN_RANGE = 64 * 1024 * 1024
+MAX_STREAMS = 8
+
+
+def auto_streams(size):
+    """Returns how many parallel streams are worth opening for ``size`` bytes."""
+    return max(1, min(MAX_STREAMS, size // MIN_RANGE))
+
+
+def split_ranges(size, streams):
+    """Splits ``size`` bytes into ``streams`` contiguous ``(offset, length)`` ranges."""
+    base, extra = divmod(size, streams)
+    ranges = []
+    offset = 0
+    for i in range(streams):
+        length = base + (1 if i < extra else 0)
+        ranges.append((offset, length))
+        offset += length
+    return ranges
+
+
+def format_ranges(ranges):
+    """Encodes ``{stream_id: (offset, length)}`` for a RANGES: message."""
+    return ",".join(f"{stream_id}@{offset}+{length}" for stream_id, (offset, length) in ranges.items())
+
+
+def parse_ranges(text):
+    """Inverse of ``format_ranges``; raises ValueError on malformed input."""
+    ranges = {}
+    for item in text.split(","):
+        stream_id, _, span = item.partition("@")
+        offset, _, length = span.partition("+")
+        ranges[int(stream_id)] = (int(offset), int(length))
+    return ranges
+
+
+class ReceivedRanges:
+    """Progress of a file arriving as byte ranges, one per stream.
+
+    Chunks of a stream arrive in order, but the streams interleave freely,
+    so the receiver asks ``position`` where each chunk belongs and writes
+    it there. ``add`` returns how many payload bytes the stream has
+    delivered, as they crossed the wire (compressed or not), which is what
+    the receiver acknowledges for it.
+    """
+
+    def __init__(self, ranges, size):
+        # Together the ranges must cover the file exactly once
+        expected = 0
+        for offset, length in sorted(ranges.values()):
+            if offset != expected or length < 0:
+                raise ValueError("Ranges do not cover the file exactly")
+            expected += length
+        if expected != size:
+            raise ValueError(f"Ranges cover {expected} of {size} bytes")
+        # stream id -> [offset, length, received, payload bytes received]
+        self._ranges = {stream_id: [offset, length, 0, 0] for stream_id, (offset, length) in ranges.items()}
+        self.received = 0
+
+    def __contains__(self, stream_id):
+        return stream_id in self._ranges
+
+    def __len__(self):
+        return len(self._ranges)
+
+    def position(self, stream_id):
+        """Returns the file offset of the next chunk of ``stream_id``."""
+        offset, _, received, _ = self._ranges[stream_id]
+        return offset + received
+
+    def add(self, stream_id, nbytes, payload_bytes):
+        """Counts ``nbytes`` written for ``stream_id``, which arrived as ``payload_bytes``.
+
+        Raises ValueError past the end of the stream's range.
+        """
+        state = self._ranges[stream_id]
+        if state[2] + nbytes > state[1]:
+            raise ValueError(f"Stream {stream_id} sent more than its {state[1]} bytes")
+        state[2] += nbytes
+        state[3] += payload_bytes
+        self.received += nbytes
+        return state[3]
+
+    @property
+    def complete(self):
+        return all(received == length for _, length, received, _ in self._ranges.values())
@@ -0,0 +1,64 @@
+import threading
+from collections import namedtuple
+
+# How many times per second the GUI applies batched updates
+FRAME_RATE = 30
+
+# What the GUI applies in one frame; progress and status are None if unchanged
+Batch = namedtuple("Batch", ["lines", "progress", "status"])
+
+
+class UpdateBatcher:
+    """Collects UI updates from other threads until the GUI's next frame.
+
+    The network thread's signals are connected to these methods directly
+    rather than queued, so a chunk costs a lock and a list append instead
+    of a cross-thread Qt event per signal. FRAME_RATE times a second the
+    GUI takes everything with ``drain`` and applies it at once: only the
+    latest progress and status survive, lines are appended together, and
+    debug lines are collapsed to the last one per key with a count of the
+    ones dropped.
+    """
+
+    def __init__(self):
+        self._lines = []
+        # key -> [latest line, lines since the last frame]
+        self._debug = {}
+        self._progress = None
+        self._status = None
+        self._lock = threading.Lock()
+
+    def add_line(self, line):
+        with self._lock:
+            self._lines.append(line)
+
+    def add_debug(self, key, line):
+        with self._lock:
+            entry = self._debug.get(key)
+            if entry is None:
+                self._debug[key] = [line, 1]
+            else:
+                entry[0] = line
+                entry[1] += 1
+
+    def set_progress(self, value, status):
+        with self._lock:
+            self._progress = (value, status)
+
+    def set_status(self, status):
+        """Shows ``status`` in the status label and as a System: line."""
+        with self._lock:
+            self._status = status
+            self._lines.append(f"System: {status}")
+
+    def drain(self):
+        """Returns and clears everything collected since the last call."""
+        with self._lock:
+            lines, self._lines = self._lines, []
+            debug, self._debug = self._debug, {}
+            progress, self._progress = self._progress, None
+            status, self._status = self._status, None
+        # Collapsed debug lines go first: they describe chunks that arrived
+        # before whatever completed them
+        summary = [line if count == 1 else f"{line} (+{count - 1} similar)" for line, count in debug.values()]
+        return Batch(summary + lines, progress, status)
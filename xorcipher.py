@@ -0,0 +1,47 @@
+class XorCipher:
+    """Whole-buffer XOR against a repeating key.
+
+    Produces exactly the bytes of the old per-byte loop
+    (``data[i] ^ key[(offset + i) % len(key)]``) but XORs the buffer in one
+    big-integer operation against a precomputed key stream, so the work is
+    done in C rather than once per byte in Python. ``offset`` is the
+    position of ``data[0]`` in the logical stream, which lets a caller keep
+    the key phase running across chunks; pass 0 to restart the key.
+    """
+
+    # Number of (phase, length) key streams kept as ready-made integers
+    CACHE_SIZE = 64
+
+    def __init__(self, key):
+        if not key:
+            raise ValueError("XOR key must not be empty")
+        self.key = bytes(key)
+        self._tiled = b""
+        self._int_cache = {}
+
+    def _key_int(self, phase, length):
+        """Returns the key stream for ``length`` bytes starting at ``phase`` as an integer."""
+        cached = self._int_cache.get((phase, length))
+        if cached is not None:
+            return cached
+        if len(self._tiled) < phase + length:
+            repeats = (phase + length) // len(self.key) + 1
+            self._tiled = self.key * repeats
+        value = int.from_bytes(self._tiled[phase:phase + length], "big")
+        if len(self._int_cache) >= self.CACHE_SIZE:
+            self._int_cache.clear()
+        self._int_cache[(phase, length)] = value
+        return value
+
+    def apply(self, data, offset=0):
+        """Returns ``data`` XORed with the key stream starting at ``offset``."""
+        length = len(data)
+        if not length:
+            return b""
+        phase = offset % len(self.key)
+        value = int.from_bytes(data, "big") ^ self._key_int(phase, length)
+        return value.to_bytes(length, "big")
+
+    # XOR is its own inverse
+    encrypt = apply
+    decrypt = apply